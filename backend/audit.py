@@ -0,0 +1,211 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import event
+from models import db, AuditLog
+
+logger = logging.getLogger(__name__)
+
+# 'async' queues entries for the background writer; 'sync' writes them in the request transaction
+AUDIT_LOG_MODE = os.getenv('AUDIT_LOG_MODE', 'async')
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', '10000'))
+# A flush happens when this many entries are waiting or AUDIT_FLUSH_INTERVAL seconds have passed
+AUDIT_FLUSH_SIZE = int(os.getenv('AUDIT_FLUSH_SIZE', '500'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1.0'))
+
+_PENDING_KEY = 'pending_audit_logs'
+
+def _to_spool(row):
+    return dict(row, created_at=row['created_at'].isoformat())
+
+def _from_spool(row):
+    return dict(row, created_at=datetime.fromisoformat(row['created_at']))
+
+class AuditWriter:
+    """Write-behind audit log writer.
+
+    Committed entries go into a bounded in-process queue; a background thread
+    drains it with multi-row INSERTs once AUDIT_FLUSH_SIZE entries are waiting
+    or AUDIT_FLUSH_INTERVAL has passed. Entries that do not fit in the queue,
+    or whose insert fails, are appended to a JSON-lines spool file and
+    replayed on a later flush, so a full queue or a database outage never
+    drops audit history.
+    """
+
+    def __init__(self, app, spool_path, queue_size=AUDIT_QUEUE_SIZE,
+                 flush_size=AUDIT_FLUSH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL):
+        self.app = app
+        self.spool_path = spool_path
+        self.queue_size = queue_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._spool_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+
+    def submit(self, rows):
+        """Queue committed entries; never blocks the request"""
+        self._ensure_started()
+        overflow = []
+        for row in rows:
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                overflow.append(row)
+        if overflow:
+            logger.warning('Audit queue full; spooling %d entries to %s', len(overflow), self.spool_path)
+            self._spool(overflow)
+
+    def flush(self):
+        """Write everything queued and any spooled entries now; returns the number of rows written"""
+        written = 0
+        while True:
+            batch = self._take(block=False)
+            if not batch:
+                break
+            written += self._write(batch)
+        return written + self.replay_spool()
+
+    def stop(self, timeout=5):
+        """Stop the background thread and write whatever is still queued"""
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        self.flush()
+
+    def _ensure_started(self):
+        # Threads do not survive fork, so a pre-forked worker starts its own writer on first use
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=self.queue_size)
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='audit-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                batch = self._take(block=True)
+                if batch:
+                    self._write(batch)
+                self.replay_spool()
+            except Exception:
+                logger.exception('Audit writer iteration failed')
+
+    def _take(self, block):
+        """Collect up to flush_size entries, waiting at most flush_interval for the batch to fill"""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            try:
+                if block:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _insert(self, rows):
+        with self.app.app_context():
+            try:
+                for start in range(0, len(rows), self.flush_size):
+                    db.session.execute(db.insert(AuditLog), rows[start:start + self.flush_size])
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def _write(self, rows):
+        try:
+            self._insert(rows)
+            return len(rows)
+        except Exception:
+            logger.exception('Audit insert failed; spooling %d entries to %s', len(rows), self.spool_path)
+            self._spool(rows)
+            return 0
+
+    def _spool(self, rows):
+        with self._spool_lock:
+            os.makedirs(os.path.dirname(self.spool_path) or '.', exist_ok=True)
+            with open(self.spool_path, 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(_to_spool(row)) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def replay_spool(self):
+        """Insert spooled entries; the file is renamed first so concurrent spooling starts a fresh one"""
+        replay_path = f'{self.spool_path}.{os.getpid()}.replay'
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return 0
+            os.replace(self.spool_path, replay_path)
+        with open(replay_path) as f:
+            rows = [_from_spool(json.loads(line)) for line in f if line.strip()]
+        try:
+            if rows:
+                self._insert(rows)
+        except Exception:
+            logger.exception('Audit spool replay failed; keeping %d entries in %s', len(rows), self.spool_path)
+            self._spool(rows)
+            rows = []
+        os.remove(replay_path)
+        return len(rows)
+
+def record_audit_logs(rows):
+    """Record audit entries (dicts with expense_id, user_id, action, details) for the current unit of work.
+
+    In sync mode they are inserted inside the caller's transaction. In async
+    mode they are held on the session and handed to the AuditWriter only once
+    that transaction commits, so a rolled-back request leaves no audit trail
+    and the request itself never waits on the audit insert.
+    """
+    if not rows:
+        return
+    now = datetime.utcnow()
+    rows = [dict(row, details=row.get('details') or {}, created_at=now) for row in rows]
+    if current_app.config.get('AUDIT_LOG_MODE', AUDIT_LOG_MODE) == 'sync':
+        db.session.execute(db.insert(AuditLog), rows)
+    else:
+        db.session.info.setdefault(_PENDING_KEY, []).extend(rows)
+
+def _after_commit(session):
+    rows = session.info.pop(_PENDING_KEY, None)
+    if rows:
+        current_app.extensions['audit_writer'].submit(rows)
+
+def _after_rollback(session):
+    session.info.pop(_PENDING_KEY, None)
+
+def init_audit(app):
+    """Attach an AuditWriter to the app and hook it to session commits"""
+    app.config.setdefault('AUDIT_LOG_MODE', AUDIT_LOG_MODE)
+    spool_path = app.config.get('AUDIT_SPOOL_PATH') or os.getenv('AUDIT_SPOOL_PATH') or os.path.join(app.instance_path, 'audit_spool.jsonl')
+    writer = AuditWriter(app, spool_path)
+    app.extensions['audit_writer'] = writer
+    if not event.contains(db.session, 'after_commit', _after_commit):
+        event.listen(db.session, 'after_commit', _after_commit)
+        event.listen(db.session, 'after_rollback', _after_rollback)
+    # Drain the queue on interpreter shutdown so a clean stop loses nothing
+    atexit.register(writer.stop)
+    return writer
@@ -0,0 +1,237 @@
+"""Per-endpoint latency percentiles and queries per request on a synthetic organisation.
+
+Generates a deterministic organisation (see datagen.py), then drives the
+main endpoints through the Flask test client as an admin, a first-level
+manager, a leaf employee and the first flow approver. Each scenario
+reports p50/p95/p99 latency and the number of SQL statements per request,
+and is compared with the stored baseline for the preset:
+
+- more statements per request than the baseline fails the run
+- p95 above baseline * (1 + --latency-tolerance) + --slack-ms fails the run
+
+Statement counts are portable; latencies depend on the machine, so refresh
+the baseline with --update-baseline on the machine that runs the check.
+
+    cd backend
+    python benchmarks/api_benchmark.py                          # small preset vs benchmarks/baseline.json
+    python benchmarks/api_benchmark.py --preset large --requests 50
+    python benchmarks/api_benchmark.py --depth 5 --fanout 8 --flow-rule specific --no-compare
+    python benchmarks/api_benchmark.py --update-baseline
+    python benchmarks/api_benchmark.py --database-url postgresql://.../bench_db   # an empty database
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, replace
+from typing import Callable, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def percentile(samples, p):
+    """Nearest-rank percentile"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p * len(ordered) / 100) - 1)]
+
+@dataclass
+class Scenario:
+    name: str
+    run: Callable  # (context) -> response
+    setup: Optional[Callable] = None  # (context) -> None, before warm-up
+    ok: tuple = (200,)
+
+class Context:
+    """Client, auth headers and per-scenario state shared by the scenarios"""
+
+    def __init__(self, client, actors, headers):
+        self.client = client
+        self.actors = actors
+        self.headers = headers
+        self.pending = list(actors.pending_expense_ids)
+        self.etag = None
+
+def _remember_etag(ctx):
+    ctx.etag = ctx.client.get('/expenses?limit=50', headers=ctx.headers['admin']).headers['ETag']
+
+def _approve_next(ctx):
+    expense_id = ctx.pending.pop(0)
+    return ctx.client.post(f'/expenses/{expense_id}/approve', json={'decision': 'approved'}, headers=ctx.headers['approver'])
+
+# Read scenarios run before the writes so every run reads the same data
+SCENARIOS = (
+    Scenario('list_expenses_admin_page', lambda ctx: ctx.client.get('/expenses?limit=50', headers=ctx.headers['admin'])),
+    Scenario('list_expenses_admin_filtered', lambda ctx: ctx.client.get(
+        '/expenses?limit=50&from=2024-07-01&to=2024-10-01&min_amount=500&sort=-amount_converted', headers=ctx.headers['admin'])),
+    Scenario('list_expenses_manager_page', lambda ctx: ctx.client.get('/expenses?limit=50', headers=ctx.headers['manager'])),
+    Scenario('list_expenses_employee_all', lambda ctx: ctx.client.get('/expenses', headers=ctx.headers['employee'])),
+    Scenario('list_expenses_poll_not_modified', lambda ctx: ctx.client.get(
+        '/expenses?limit=50', headers={**ctx.headers['admin'], 'If-None-Match': ctx.etag}), setup=_remember_etag, ok=(304,)),
+    Scenario('search_expenses', lambda ctx: ctx.client.get('/expenses/search?q=taxi+air', headers=ctx.headers['manager'])),
+    Scenario('expense_stats', lambda ctx: ctx.client.get('/expenses/stats?group_by=status,month', headers=ctx.headers['admin'])),
+    Scenario('expense_summary', lambda ctx: ctx.client.get('/expenses/summary', headers=ctx.headers['admin'])),
+    Scenario('list_users', lambda ctx: ctx.client.get('/users', headers=ctx.headers['admin'])),
+    Scenario('approvals_inbox', lambda ctx: ctx.client.get('/approvals/pending?limit=50', headers=ctx.headers['approver'])),
+    Scenario('approve_expense', _approve_next),
+    Scenario('create_expense', lambda ctx: ctx.client.post('/expenses', json={
+        'amount': 42.5, 'currency_code': 'USD', 'description': 'benchmark taxi'}, headers=ctx.headers['employee']), ok=(201,)),
+)
+
+def login(client, user_id):
+    from models import db, User
+    from benchmarks.datagen import BENCHMARK_PASSWORD
+    email = db.session.get(User, user_id).email
+    res = client.post('/auth/login', json={'email': email, 'password': BENCHMARK_PASSWORD})
+    assert res.status_code == 200, res.get_json()
+    return {'Authorization': f"Bearer {res.get_json()['access_token']}"}
+
+def run_scenarios(app, actors, requests, warmup, only=None):
+    """{scenario: {p50_ms, p95_ms, p99_ms, queries}} for each scenario, in SCENARIOS order"""
+    from sqlalchemy import event
+    from models import db
+    client = app.test_client()
+    with app.app_context():
+        headers = {
+            'admin': login(client, actors.admin_id),
+            'manager': login(client, actors.manager_id),
+            'employee': login(client, actors.employee_id),
+            'approver': login(client, actors.approver_ids[0]) if actors.approver_ids else None,
+        }
+        engine = db.engine
+    ctx = Context(client, actors, headers)
+    statements = []
+    listener = lambda *args: statements.append(1)
+    event.listen(engine, 'before_cursor_execute', listener)
+    results = {}
+    try:
+        for scenario in SCENARIOS:
+            if only and scenario.name not in only:
+                continue
+            if scenario.name == 'approve_expense' and (headers['approver'] is None or len(ctx.pending) < warmup + requests):
+                print(f'skipping {scenario.name}: not enough pending expenses')
+                continue
+            if scenario.setup:
+                scenario.setup(ctx)
+            for _ in range(warmup):
+                scenario.run(ctx)
+            latencies, counts = [], []
+            for _ in range(requests):
+                statements.clear()
+                started = time.perf_counter()
+                res = scenario.run(ctx)
+                latencies.append((time.perf_counter() - started) * 1000)
+                counts.append(len(statements))
+                if res.status_code not in scenario.ok:
+                    raise RuntimeError(f'{scenario.name}: HTTP {res.status_code} {res.get_data(as_text=True)[:200]}')
+            results[scenario.name] = {
+                'p50_ms': round(statistics.median(latencies), 2),
+                'p95_ms': round(percentile(latencies, 95), 2),
+                'p99_ms': round(percentile(latencies, 99), 2),
+                'queries': max(counts),
+            }
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return results
+
+def compare_to_baseline(results, baseline, latency_tolerance, slack_ms):
+    """Human-readable regressions of results against a baseline's scenarios"""
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result['queries'] > expected['queries']:
+            failures.append(f"{name}: {result['queries']} statements per request, baseline {expected['queries']}")
+        limit = expected['p95_ms'] * (1 + latency_tolerance) + slack_ms
+        if result['p95_ms'] > limit:
+            failures.append(f"{name}: p95 {result['p95_ms']:.2f} ms, baseline {expected['p95_ms']:.2f} ms (limit {limit:.2f} ms)")
+    return failures
+
+def main():
+    from benchmarks.datagen import PRESETS, FLOW_RULES
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='small')
+    for name, kind in (('companies', int), ('depth', int), ('fanout', int), ('expenses-per-user', int), ('flow-steps', int), ('seed', int)):
+        parser.add_argument(f'--{name}', type=kind, default=None, help='override the preset')
+    parser.add_argument('--flow-rule', choices=FLOW_RULES, default=None, help='override the preset')
+    parser.add_argument('--requests', type=int, default=30, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=3, help='unmeasured requests per scenario')
+    parser.add_argument('--scenario', action='append', help='run only this scenario (repeatable)')
+    parser.add_argument('--database-url', default=None, help='empty database to use (default: a temporary SQLite file)')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--latency-tolerance', type=float, default=0.5, help='allowed p95 growth as a fraction (default 0.5)')
+    parser.add_argument('--slack-ms', type=float, default=2.0, help='allowed p95 growth in ms on top of the fraction')
+    parser.add_argument('--update-baseline', action='store_true', help='store these results as the baseline for the preset')
+    parser.add_argument('--no-compare', action='store_true')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    overrides = {
+        name: getattr(args, name) for name in ('companies', 'depth', 'fanout', 'expenses_per_user', 'flow_steps', 'flow_rule', 'seed')
+        if getattr(args, name) is not None
+    }
+    params = replace(PRESETS[args.preset], **overrides)
+
+    db_file = None
+    url = args.database_url
+    if url is None:
+        db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        db_file.close()
+        url = f'sqlite:///{db_file.name}'
+    from app import create_app
+    from models import db
+    from benchmarks.datagen import generate_org
+    # Audit entries are written in the request so statement counts are deterministic
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'AUDIT_LOG_MODE': 'sync'}, with_migrations=False)
+
+    try:
+        with app.app_context():
+            db.create_all()
+            started = time.perf_counter()
+            actors = generate_org(params)[0]
+            print(f'generated {params} in {time.perf_counter() - started:.1f}s')
+        results = run_scenarios(app, actors, args.requests, args.warmup, args.scenario)
+    finally:
+        if db_file:
+            os.unlink(db_file.name)
+
+    print(f'{"scenario":<34} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}')
+    for name, result in results.items():
+        print(f"{name:<34} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['queries']:>8}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'preset': args.preset, 'params': asdict(params), 'scenarios': results}, f, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.update_baseline:
+        baselines[args.preset] = {'params': asdict(params), 'scenarios': results}
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'baseline for {args.preset} written to {args.baseline}')
+        return
+    if args.no_compare:
+        return
+    baseline = baselines.get(args.preset)
+    if baseline is None:
+        print(f'no baseline for {args.preset}; run with --update-baseline to record one')
+        return
+    if baseline['params'] != asdict(params):
+        sys.exit(f'baseline for {args.preset} was recorded with {baseline["params"]}; pass --no-compare for other parameters')
+    failures = compare_to_baseline(results, baseline['scenarios'], args.latency_tolerance, args.slack_ms)
+    for failure in failures:
+        print(f'REGRESSION {failure}')
+    if failures:
+        sys.exit(1)
+    print('no regressions against the baseline')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""Deterministic synthetic organisations for benchmarks.
+
+Builds companies whose users form a tree of the given depth and fan-out
+under an admin, an approval flow of flow_steps approver admins, and
+expenses spread over one year with a fixed mix of statuses. The same
+parameters and seed always produce the same rows, so numbers from two
+runs are comparable.
+
+Rows go in with multi-row INSERTs; the hierarchy closure table and the
+expense rollups are then rebuilt from them, as the CLI commands would.
+"""
+import random
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from models import db, Company, User, Expense, Approval, ApprovalFlow, AuditLog, UserRole, ExpenseStatus, ApprovalDecision
+from passwords import hash_password
+from utils import rebuild_hierarchy, rebuild_rollups
+
+BENCHMARK_PASSWORD = 'benchmark'
+# Expenses are dated within the year before this instant, never relative to now
+ANCHOR = datetime(2025, 1, 1)
+INSERT_BATCH_SIZE = 5000
+
+WORDS = (
+    'taxi', 'airport', 'hotel', 'dinner', 'client', 'lunch', 'train', 'conference', 'parking', 'fuel',
+    'software', 'license', 'laptop', 'office', 'supplies', 'flight', 'team', 'offsite', 'coffee', 'books',
+)
+# Submission currency -> amount_converted per unit, in the company's USD
+RATES = {'USD': Decimal('1'), 'EUR': Decimal('1.10'), 'GBP': Decimal('1.27'), 'INR': Decimal('0.012')}
+# Share of expenses per final status; pending ones wait on the first approver
+STATUS_MIX = ((ExpenseStatus.approved, 0.6), (ExpenseStatus.rejected, 0.1), (ExpenseStatus.pending, 0.3))
+FLOW_RULES = ('none', 'percentage', 'specific')
+
+@dataclass
+class OrgParams:
+    companies: int = 1
+    depth: int = 4
+    fanout: int = 5
+    expenses_per_user: int = 20
+    flow_steps: int = 2
+    flow_rule: str = 'percentage'
+    seed: int = 42
+
+PRESETS = {
+    'small': OrgParams(),
+    # ~9.3k users per company in a 6-level tree, ~930k expenses
+    'large': OrgParams(depth=6, fanout=6, expenses_per_user=100),
+}
+
+@dataclass
+class CompanyActors:
+    """Ids the benchmark scenarios act as"""
+    company_id: int
+    admin_id: int
+    approver_ids: list
+    manager_id: int  # a first-level manager, with the largest subtree
+    employee_id: int  # a leaf
+    pending_expense_ids: list = field(default_factory=list)
+
+def _insert(model, rows, returning=None):
+    """Multi-row INSERT in batches; returns the `returning` column values in row order"""
+    values = []
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        batch = rows[start:start + INSERT_BATCH_SIZE]
+        if returning is None:
+            db.session.execute(db.insert(model), batch)
+        else:
+            values += db.session.execute(
+                db.insert(model).returning(returning, sort_by_parameter_order=True), batch
+            ).scalars().all()
+    return values
+
+def _generate_users(company_id, params, password_hash):
+    """Admin, approvers and the tree, level by level; returns (admin id, approver ids, [[ids per level]])"""
+    def user(email, name, role, manager_id):
+        return {
+            'company_id': company_id, 'email': email, 'password_hash': password_hash,
+            'full_name': name, 'role': role, 'manager_id': manager_id,
+        }
+    (admin_id,) = _insert(User, [user(f'admin@c{company_id}.bench', 'Admin', UserRole.admin, None)], User.id)
+    approver_ids = _insert(User, [
+        user(f'approver{n}@c{company_id}.bench', f'Approver {n}', UserRole.admin, admin_id) for n in range(params.flow_steps)
+    ], User.id)
+    levels = [[admin_id]]
+    for level in range(1, params.depth):
+        role = UserRole.employee if level == params.depth - 1 else UserRole.manager
+        rows = [
+            user(f'u{level}-{n}@c{company_id}.bench', f'User {level}-{n}', role, parent_id)
+            for n, parent_id in enumerate(parent for parent in levels[-1] for _ in range(params.fanout))
+        ]
+        levels.append(_insert(User, rows, User.id))
+    return admin_id, approver_ids, levels
+
+def _generate_expenses(rng, company_id, submitter_ids, params):
+    rows = []
+    for submitter_id in submitter_ids:
+        for _ in range(params.expenses_per_user):
+            currency = rng.choices(tuple(RATES), weights=(70, 15, 10, 5))[0]
+            amount = Decimal(rng.randint(100, 150000)) / 100
+            status = rng.choices([s for s, _ in STATUS_MIX], weights=[w for _, w in STATUS_MIX])[0]
+            created_at = ANCHOR - timedelta(seconds=rng.randrange(365 * 24 * 3600))
+            rows.append({
+                'company_id': company_id,
+                'submitter_id': submitter_id,
+                'amount': amount,
+                'currency_code': currency,
+                'amount_converted': (amount * RATES[currency]).quantize(Decimal('0.01')),
+                'description': ' '.join(rng.sample(WORDS, 3)),
+                'status': status,
+                'created_at': created_at,
+                'updated_at': created_at,
+            })
+    # Insert in time order so ids follow created_at, as they would in production
+    rows.sort(key=lambda row: row['created_at'])
+    return rows, _insert(Expense, rows, Expense.id)
+
+def generate_org(params):
+    """Create params.companies companies and return a CompanyActors for each"""
+    rng = random.Random(params.seed)
+    if params.flow_rule not in FLOW_RULES:
+        raise ValueError(f"flow_rule must be one of {', '.join(FLOW_RULES)}")
+    # One hash shared by every user keeps generation fast; logins still pay a full verify
+    password_hash = hash_password(BENCHMARK_PASSWORD)
+    companies = []
+    for n in range(params.companies):
+        company = Company(name=f'Bench {n}', country_code='US', currency_code='USD')
+        db.session.add(company)
+        db.session.flush()
+        admin_id, approver_ids, levels = _generate_users(company.id, params, password_hash)
+
+        rules = {}
+        if params.flow_rule == 'percentage':
+            rules['percentage'] = 1.0
+        elif params.flow_rule == 'specific' and approver_ids:
+            rules['specific'] = approver_ids[-1]
+        db.session.add(ApprovalFlow(company_id=company.id, config={'sequence': approver_ids, 'rules': rules}, created_by=admin_id))
+
+        submitter_ids = [user_id for level in levels[1:] for user_id in level]
+        rows, expense_ids = _generate_expenses(rng, company.id, submitter_ids, params)
+        approvals, audit_logs, pending = [], [], []
+        for row, expense_id in zip(rows, expense_ids):
+            audit_logs.append({'expense_id': expense_id, 'user_id': row['submitter_id'], 'action': 'expense_created',
+                               'details': {'amount': str(row['amount']), 'currency': row['currency_code']}, 'created_at': row['created_at']})
+            if not approver_ids:
+                continue
+            if row['status'] == ExpenseStatus.pending:
+                pending.append(expense_id)
+                approvals.append({'expense_id': expense_id, 'approver_id': approver_ids[0], 'decision': ApprovalDecision.pending,
+                                  'created_at': row['created_at']})
+            elif row['status'] == ExpenseStatus.approved:
+                approvals += [{'expense_id': expense_id, 'approver_id': approver_id, 'decision': ApprovalDecision.approved,
+                               'acted_at': row['created_at'], 'created_at': row['created_at']} for approver_id in approver_ids]
+            else:
+                approvals.append({'expense_id': expense_id, 'approver_id': approver_ids[0], 'decision': ApprovalDecision.rejected,
+                                  'acted_at': row['created_at'], 'created_at': row['created_at']})
+        _insert(Approval, approvals)
+        _insert(AuditLog, audit_logs)
+        companies.append(CompanyActors(
+            company_id=company.id,
+            admin_id=admin_id,
+            approver_ids=approver_ids,
+            manager_id=levels[1][0] if len(levels) > 2 else admin_id,
+            employee_id=levels[-1][-1],
+            pending_expense_ids=pending,
+        ))
+    db.session.commit()
+    rebuild_hierarchy()
+    rebuild_rollups()
+    return companies
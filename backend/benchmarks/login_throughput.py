@@ -0,0 +1,92 @@
+"""Login throughput per core for a given password hash method.
+
+Runs POST /auth/login through the Flask test client from several client
+threads against a throwaway SQLite database and reports logins per second,
+per core, latency percentiles and how many requests were shed with 503.
+
+    cd backend
+    python benchmarks/login_throughput.py --method scrypt --clients 1,2,4,8
+    python benchmarks/login_throughput.py --method pbkdf2:sha256:600000 --workers 2
+"""
+import argparse
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def percentile(samples, p):
+    """Nearest-rank percentile"""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(p * len(ordered) / 100) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', default=None, help='werkzeug hash method (default: PASSWORD_HASH_METHOD)')
+    parser.add_argument('--workers', type=int, default=None, help='hashing pool size (default: PASSWORD_HASH_WORKERS)')
+    parser.add_argument('--clients', default='1,2,4,8', help='comma-separated concurrent client counts')
+    parser.add_argument('--requests', type=int, default=200, help='logins per client count')
+    parser.add_argument('--users', type=int, default=50)
+    args = parser.parse_args()
+
+    db_file = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    db_file.close()
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_file.name}'
+    os.environ.setdefault('AUDIT_LOG_MODE', 'sync')
+
+    import passwords
+    from app import create_app
+    from models import db, Company, User, UserRole
+    app = create_app()
+
+    kwargs = {}
+    if args.method:
+        kwargs['method'] = args.method
+    if args.workers:
+        kwargs['max_workers'] = args.workers
+        kwargs['max_pending'] = args.workers * 4
+    hasher = passwords._hasher = passwords.PasswordHasher(**kwargs)
+    cores = min(os.cpu_count() or 1, hasher._executor._max_workers)
+
+    with app.app_context():
+        db.create_all()
+        company = Company(name='Bench', country_code='US', currency_code='USD')
+        db.session.add(company)
+        db.session.flush()
+        # One hash shared by every user keeps setup fast; each login still pays a full verify
+        password_hash = hasher.hash('secret')
+        db.session.add_all([
+            User(company_id=company.id, email=f'user{n}@bench.test', password_hash=password_hash,
+                 full_name=f'User {n}', role=UserRole.employee)
+            for n in range(args.users)
+        ])
+        db.session.commit()
+
+    def login(n):
+        with app.test_client() as client:
+            started = time.perf_counter()
+            res = client.post('/auth/login', json={'email': f'user{n % args.users}@bench.test', 'password': 'secret'})
+            return res.status_code, time.perf_counter() - started
+
+    print(f'method={hasher.prefix} hash workers={hasher._executor._max_workers} cores used={cores}')
+    print(f'{"clients":>8} {"logins/s":>10} {"per core":>10} {"p50 ms":>8} {"p95 ms":>8} {"shed":>6}')
+    try:
+        for clients in [int(c) for c in args.clients.split(',')]:
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as pool:
+                results = list(pool.map(login, range(args.requests)))
+            elapsed = time.perf_counter() - started
+            ok = [latency for status, latency in results if status == 200]
+            shed = sum(1 for status, _ in results if status == 503)
+            rate = len(ok) / elapsed
+            print(f'{clients:>8} {rate:>10.1f} {rate / cores:>10.1f} '
+                  f'{statistics.median(ok) * 1000:>8.1f} {percentile(ok, 95) * 1000:>8.1f} {shed:>6}')
+    finally:
+        os.unlink(db_file.name)
+
+if __name__ == '__main__':
+    main()
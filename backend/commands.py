@@ -0,0 +1,153 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+@click.command('rebuild-hierarchy')
+@with_appcontext
+def rebuild_hierarchy_command():
+    """Recompute the reporting-tree closure table from users.manager_id"""
+    from utils import rebuild_hierarchy
+    rows = rebuild_hierarchy()
+    print(f"Rebuilt user hierarchy: {rows} rows")
+
+@click.command('rebuild-rollups')
+@click.option('--verify-only', is_flag=True, help='Report drift without rewriting the table')
+@with_appcontext
+def rebuild_rollups_command(verify_only):
+    """Recompute expense_rollups from the expenses table and report buckets that had drifted"""
+    from utils import rebuild_rollups
+    drift = rebuild_rollups(verify_only=verify_only)
+    for (company_id, status, period), (stored, expected) in sorted(drift.items(), key=lambda item: (item[0][0], item[0][1].value, item[0][2])):
+        print(f"Drift in company {company_id} {status.value} {period}: stored {stored}, expected {expected}")
+    if verify_only:
+        if drift:
+            raise SystemExit(1)
+        print("Expense rollups match the expenses table")
+    else:
+        print(f"Rebuilt expense rollups ({len(drift)} buckets corrected)")
+
+@click.command('load-exchange-rates')
+@click.argument('path')
+@with_appcontext
+def load_exchange_rates_command(path):
+    """Load exchange rates from a CSV or JSON file (base_currency, quote_currency, rate, effective_date)"""
+    from currency import load_exchange_rates
+    rows = load_exchange_rates(path)
+    print(f"Loaded {rows} exchange rates from {path}")
+
+@click.command('refresh-country-currencies')
+@click.option('--timeout', type=float, default=None, help='Seconds to wait for the RestCountries API')
+@with_appcontext
+def refresh_country_currencies_command(timeout):
+    """Rebuild data/country_currencies.json from the RestCountries API"""
+    from currency import refresh_country_currencies
+    count = refresh_country_currencies(timeout=timeout)
+    print(f"Refreshed currencies for {count} countries")
+
+@click.command('flush-audit-log')
+@with_appcontext
+def flush_audit_log_command():
+    """Insert any audit entries left in the overflow spool file"""
+    rows = current_app.extensions['audit_writer'].replay_spool()
+    print(f"Replayed {rows} spooled audit entries")
+
+@click.command('prune-receipts')
+@click.option('--grace-seconds', type=int, default=None, help='Keep unreferenced files younger than this (default: 3600)')
+@with_appcontext
+def prune_receipts_command(grace_seconds):
+    """Delete stored receipt files that no expense references any more"""
+    from models import db, Expense
+    from receipts import PRUNE_GRACE_SECONDS
+    referenced = {digest for (digest,) in db.session.query(Expense.receipt_sha256).filter(Expense.receipt_sha256.isnot(None)).distinct()}
+    removed = current_app.extensions['receipt_store'].prune(
+        referenced, PRUNE_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    )
+    print(f"Removed {removed} unreferenced receipt files")
+
+@click.command('import-expenses')
+@click.argument('path')
+@click.option('--company-id', type=int, default=None, help='Company to import into (not needed with --resume)')
+@click.option('--resume', 'job_id', type=int, default=None, help='Continue this import job after its last committed chunk')
+@click.option('--chunk-size', type=int, default=None, help='Rows per transaction (default: IMPORT_CHUNK_SIZE, 5000)')
+@with_appcontext
+def import_expenses_command(path, company_id, job_id, chunk_size):
+    """Stream a CSV of historical expenses into a company, keeping their statuses"""
+    import os
+    from models import db, Company, ImportJob
+    from expense_import import IMPORT_CHUNK_SIZE, InvalidImport, create_import_job, run_import
+    if job_id is not None:
+        job = db.session.get(ImportJob, job_id)
+        if job is None:
+            raise click.UsageError(f"No import job {job_id}")
+    elif company_id is None or db.session.get(Company, company_id) is None:
+        raise click.UsageError("--company-id must name an existing company")
+    else:
+        job = create_import_job(company_id, filename=os.path.basename(path))
+    progress = lambda job: print(f"Import {job.id}: {job.rows_done} rows read, {job.imported_rows} imported")
+    try:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            run_import(job, f, chunk_size or IMPORT_CHUNK_SIZE, on_chunk=progress)
+    except Exception as e:
+        print(f"Import {job.id} stopped: {e}")
+        # Rows up to the last committed chunk are in; a rerun with --resume continues after them
+        if not isinstance(e, InvalidImport):
+            print(f"Resume with: flask --app app import-expenses {path} --resume {job.id}")
+        raise SystemExit(1)
+    for error in job.errors or []:
+        print(f"Line {error['line']}: {error['error']}")
+    print(f"Import {job.id} completed: {job.imported_rows} expenses imported, {job.failed_rows} rows rejected")
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """EXPLAIN the hot-path route queries and fail if any falls back to a sequential scan"""
+    from query_plans import check_query_plans
+    failures = check_query_plans()
+    for name, plan in failures.items():
+        print(f"Sequential scan in {name}:")
+        for line in plan:
+            print(f"    {line}")
+    if failures:
+        raise SystemExit(1)
+    print("All hot-path queries use an index")
+
+@click.command('check-schema')
+@with_appcontext
+def check_schema_command():
+    """Fail if the database is not at the latest migration or differs from the models"""
+    from alembic.autogenerate import compare_metadata
+    from alembic.runtime.migration import MigrationContext
+    from alembic.script import ScriptDirectory
+    from models import db
+    config = current_app.extensions['migrate'].migrate.get_config()
+    heads = set(ScriptDirectory.from_config(config).get_heads())
+    with db.engine.connect() as connection:
+        # Same comparison options as autogenerate (e.g. which objects to ignore)
+        context = MigrationContext.configure(connection, opts=dict(current_app.extensions['migrate'].configure_args))
+        current = set(context.get_current_heads())
+        diffs = compare_metadata(context, db.metadata)
+    problems = []
+    if current != heads:
+        problems.append(f"Database is at revision {', '.join(sorted(current)) or 'none'}, latest is {', '.join(sorted(heads))}; run `flask db upgrade`")
+    problems += [f"Schema differs from models: {diff}" for diff in diffs]
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(1)
+    print("Database schema is up to date")
+
+COMMANDS = (
+    rebuild_hierarchy_command,
+    rebuild_rollups_command,
+    load_exchange_rates_command,
+    refresh_country_currencies_command,
+    flush_audit_log_command,
+    prune_receipts_command,
+    import_expenses_command,
+    check_query_plans_command,
+    check_schema_command,
+)
+
+def register_commands(app):
+    for command in COMMANDS:
+        app.cli.add_command(command)
@@ -0,0 +1,33 @@
+import gzip
+import os
+from flask import request
+
+# Responses smaller than this are sent as-is; below about a kilobyte gzip saves little and costs a header
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))
+# zlib level 1-9; 6 is zlib's default trade-off between CPU and size
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', '6'))
+COMPRESS_MIMETYPES = ('application/json', 'text/csv', 'application/x-ndjson', 'text/plain')
+
+def _compress_response(response):
+    """gzip buffered text responses for clients that accept it.
+
+    Streamed and file responses (exports, receipts) are passed through
+    untouched, as are 304s and other bodiless replies.
+    """
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    # Caches must key on Accept-Encoding whether or not this response ends up compressed
+    response.vary.add('Accept-Encoding')
+    if request.accept_encodings.quality('gzip') <= 0:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    # mtime=0 keeps the output deterministic for identical bodies
+    response.set_data(gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def init_compression(app):
+    app.after_request(_compress_response)
@@ -0,0 +1,195 @@
+import csv
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from models import db, ExchangeRate
+from cache import TTLCache
+from utils import upsert
+
+# Bundled ISO 3166-1 alpha-2 -> ISO 4217 table used at signup
+COUNTRY_CURRENCIES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'country_currencies.json')
+RESTCOUNTRIES_TIMEOUT = float(os.getenv('RESTCOUNTRIES_TIMEOUT', '5'))
+
+CENTS = Decimal('0.01')
+# Rates older than this are looked up again, so newly loaded files are picked up by every worker
+RATE_CACHE_TTL = float(os.getenv('EXCHANGE_RATE_CACHE_TTL', '300'))
+RATE_CACHE_SIZE = 4096
+# Currency most rate files quote against; used to triangulate pairs with no direct rate
+PIVOT_CURRENCY = os.getenv('EXCHANGE_RATE_PIVOT', 'USD')
+
+class CurrencyConversionError(ValueError):
+    """No exchange rate is known for a currency pair"""
+
+_rate_cache = TTLCache(RATE_CACHE_TTL, RATE_CACHE_SIZE)
+_country_currencies = None
+
+def load_country_currencies(path=COUNTRY_CURRENCIES_PATH):
+    """(Re)load the country -> currency table into memory"""
+    global _country_currencies
+    with open(path) as f:
+        _country_currencies = {country.upper(): currency.upper() for country, currency in json.load(f).items()}
+    return _country_currencies
+
+def get_currency_from_country(country_code):
+    """Currency code for an ISO 3166-1 alpha-2 country code, or None if the country is unknown"""
+    if not isinstance(country_code, str):
+        return None
+    table = _country_currencies if _country_currencies is not None else load_country_currencies()
+    return table.get(country_code.strip().upper())
+
+def refresh_country_currencies(api_url=None, timeout=None, path=COUNTRY_CURRENCIES_PATH):
+    """Rebuild the bundled table from the RestCountries API.
+
+    Optional maintenance step; signup never calls it. Raises on network errors,
+    timeouts or an unusable response and leaves the existing file untouched.
+    """
+    import requests
+    api_url = api_url or os.getenv('RESTCOUNTRIES_API_URL', 'https://restcountries.com/v3.1')
+    response = requests.get(
+        f"{api_url}/all",
+        params={'fields': 'cca2,currencies'},
+        timeout=timeout if timeout is not None else RESTCOUNTRIES_TIMEOUT
+    )
+    response.raise_for_status()
+    table = {}
+    for country in response.json():
+        currencies = country.get('currencies') or {}
+        if country.get('cca2') and currencies:
+            # First listed currency, as the old per-signup lookup did
+            table[country['cca2'].upper()] = next(iter(currencies)).upper()
+    if not table:
+        raise ValueError('RestCountries returned no usable country currencies')
+    # Write atomically so a crash mid-write never leaves a truncated table behind
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(sorted(table.items())), f, indent=2)
+        f.write('\n')
+    os.replace(tmp_path, path)
+    load_country_currencies(path)
+    return len(table)
+
+def _latest_rates(currencies, on):
+    """Latest rate on or before `on` for every stored pair among the given currencies, in one query"""
+    latest = db.session.query(
+        ExchangeRate.base_currency,
+        ExchangeRate.quote_currency,
+        db.func.max(ExchangeRate.effective_date).label('effective_date')
+    ).filter(
+        ExchangeRate.base_currency.in_(currencies),
+        ExchangeRate.quote_currency.in_(currencies),
+        ExchangeRate.effective_date <= on
+    ).group_by(ExchangeRate.base_currency, ExchangeRate.quote_currency).subquery()
+    rows = db.session.query(ExchangeRate.base_currency, ExchangeRate.quote_currency, ExchangeRate.rate).join(
+        latest, db.and_(
+            ExchangeRate.base_currency == latest.c.base_currency,
+            ExchangeRate.quote_currency == latest.c.quote_currency,
+            ExchangeRate.effective_date == latest.c.effective_date
+        )
+    )
+    return {(base, quote): Decimal(rate) for base, quote, rate in rows}
+
+def _pair_rate(rates, from_currency, to_currency):
+    """Direct or inverse rate for a pair, or None"""
+    if from_currency == to_currency:
+        return Decimal(1)
+    if (from_currency, to_currency) in rates:
+        return rates[(from_currency, to_currency)]
+    inverse = rates.get((to_currency, from_currency))
+    if inverse:
+        return Decimal(1) / inverse
+    return None
+
+def _resolve_rate(rates, from_currency, to_currency):
+    """Direct, inverse, or triangulated through PIVOT_CURRENCY"""
+    rate = _pair_rate(rates, from_currency, to_currency)
+    if rate is None:
+        to_pivot = _pair_rate(rates, from_currency, PIVOT_CURRENCY)
+        from_pivot = _pair_rate(rates, PIVOT_CURRENCY, to_currency)
+        if to_pivot is not None and from_pivot is not None:
+            rate = to_pivot * from_pivot
+    return rate
+
+def get_rates(from_currencies, to_currency, on=None):
+    """Rates from each source currency into to_currency; one query covers every cache miss.
+
+    Currencies with no known rate map to None.
+    """
+    on = on or datetime.utcnow().date()
+    to_currency = to_currency.upper()
+    result = {}
+    missing = set()
+    for currency in set(from_currencies):
+        hit, rate = _rate_cache.get((currency.upper(), to_currency, on))
+        if hit:
+            result[currency] = rate
+        else:
+            missing.add(currency)
+    if missing:
+        codes = {currency.upper() for currency in missing}
+        rates = _latest_rates(codes | {to_currency, PIVOT_CURRENCY}, on)
+        for currency in missing:
+            rate = _resolve_rate(rates, currency.upper(), to_currency)
+            # Misses are cached too so unknown currencies do not hit the database on every call
+            _rate_cache.set((currency.upper(), to_currency, on), rate)
+            result[currency] = rate
+    return result
+
+def get_rate(from_currency, to_currency, on=None):
+    rate = get_rates([from_currency], to_currency, on)[from_currency]
+    if rate is None:
+        raise CurrencyConversionError(f'No exchange rate from {from_currency} to {to_currency}')
+    return rate
+
+def convert_currency(amount, from_currency, to_currency, on=None):
+    """Convert an amount with Decimal arithmetic, rounded half-up to cents"""
+    return (Decimal(str(amount)) * get_rate(from_currency, to_currency, on)).quantize(CENTS, rounding=ROUND_HALF_UP)
+
+def convert_amounts(amounts, currencies, to_currency, on=None):
+    """Convert parallel lists of amounts and currency codes into to_currency.
+
+    Rates are resolved once per distinct currency, so a report or re-conversion
+    job over many rows costs one lookup rather than one per row. Entries whose
+    currency has no known rate come back as None.
+    """
+    rates = get_rates(currencies, to_currency, on)
+    return [
+        (Decimal(str(amount)) * rates[currency]).quantize(CENTS, rounding=ROUND_HALF_UP)
+        if rates[currency] is not None else None
+        for amount, currency in zip(amounts, currencies)
+    ]
+
+def _read_rate_file(path):
+    if path.endswith('.json'):
+        with open(path) as f:
+            return json.load(f)
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+def load_exchange_rates(path):
+    """Load rates from a CSV or JSON file with base_currency, quote_currency, rate and effective_date (YYYY-MM-DD).
+
+    Existing rates for the same pair and date are overwritten. Returns the number of rows loaded.
+    """
+    rows = []
+    for line, record in enumerate(_read_rate_file(path), start=1):
+        try:
+            rate = Decimal(str(record['rate']))
+            effective_date = date.fromisoformat(str(record['effective_date']))
+            base_currency = record['base_currency'].strip().upper()
+            quote_currency = record['quote_currency'].strip().upper()
+        except (KeyError, AttributeError, InvalidOperation, ValueError):
+            raise ValueError(f'{path}: invalid exchange rate record {line}')
+        if rate <= 0 or len(base_currency) != 3 or len(quote_currency) != 3:
+            raise ValueError(f'{path}: invalid exchange rate record {line}')
+        rows.append({
+            'base_currency': base_currency,
+            'quote_currency': quote_currency,
+            'rate': rate,
+            'effective_date': effective_date
+        })
+    if rows:
+        upsert(ExchangeRate, rows, ['base_currency', 'quote_currency', 'effective_date'])
+    db.session.commit()
+    _rate_cache.clear()
+    return len(rows)
@@ -0,0 +1,103 @@
+import os
+from functools import wraps
+from flask import current_app, g, has_request_context, request
+from flask_jwt_extended import get_jwt_identity
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from cache import TTLCache
+
+# After a write, the same client reads from the primary for this long so it sees its own changes
+REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', '5'))
+STICKY_COOKIE = 'read_primary'
+
+# user id -> True while their reads stick to the primary (per worker; the cookie covers browsers across workers)
+_recent_writers = TTLCache(REPLICA_STICKY_SECONDS, 10000)
+
+def engine_options(url, statement_timeout_ms):
+    """Pool and timeout settings for one database URL, from DB_* environment variables"""
+    options = {'pool_pre_ping': True}
+    if make_url(url).get_backend_name() == 'sqlite':
+        # SQLite engines use a single-connection or per-thread pool; sizing does not apply
+        return options
+    options.update(
+        pool_size=int(os.getenv('DB_POOL_SIZE', '10')),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '20')),
+        pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', '1800')),
+    )
+    if make_url(url).get_backend_name() == 'postgresql' and statement_timeout_ms:
+        options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout_ms}'}
+    return options
+
+def _sticky_key():
+    """The authenticated user id, if the request carried a verified token"""
+    try:
+        return get_jwt_identity()
+    except RuntimeError:
+        return None
+
+def _recently_wrote():
+    if request.cookies.get(STICKY_COOKIE):
+        return True
+    key = _sticky_key()
+    return key is not None and _recent_writers.get(key)[0]
+
+def _use_replica():
+    return has_request_context() and g.get('_use_replica', False)
+
+class RoutingSession(Session):
+    """Session that sends SELECTs to the read replica while a read_only view runs.
+
+    Flushes, DML and anything outside a read_only view keep using the primary,
+    as does every statement when no replica is configured.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and getattr(clause, 'is_select', False) and _use_replica():
+            engine = current_app.extensions.get('replica_engine')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def read_only(view):
+    """Route a view's queries to the read replica, unless the caller wrote within REPLICA_STICKY_SECONDS"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g._use_replica = not _recently_wrote()
+        return view(*args, **kwargs)
+    return wrapper
+
+def _mark_write(session):
+    if has_request_context():
+        g._db_wrote = True
+
+def _remember_write(response):
+    """Make the writer's next reads sticky to the primary (cookie for browsers, user id for API clients)"""
+    if g.get('_db_wrote'):
+        response.set_cookie(STICKY_COOKIE, '1', max_age=int(REPLICA_STICKY_SECONDS) or 1, httponly=True, samesite='Lax')
+        key = _sticky_key()
+        if key is not None:
+            _recent_writers.set(key, True)
+    return response
+
+def init_database(app, db):
+    """Configure pooling, timeouts and the optional read replica, then initialise Flask-SQLAlchemy.
+
+    The replica is a plain engine rather than a Flask-SQLAlchemy bind: it mirrors
+    the default bind, so no models or migrations are attached to it.
+    """
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))
+    ))
+    app.config.setdefault('SQLALCHEMY_REPLICA_URI', os.getenv('DATABASE_REPLICA_URL'))
+    db.init_app(app)
+    replica_url = app.config['SQLALCHEMY_REPLICA_URI']
+    if replica_url:
+        # Replica serves the heavy reads (exports, listings), so it gets its own timeout
+        app.extensions['replica_engine'] = create_engine(
+            replica_url, **engine_options(replica_url, int(os.getenv('DB_REPLICA_STATEMENT_TIMEOUT_MS', '120000')))
+        )
+    if not event.contains(db.session, 'after_commit', _mark_write):
+        event.listen(db.session, 'after_commit', _mark_write)
+    app.after_request(_remember_write)
@@ -0,0 +1,258 @@
+import csv
+import hashlib
+import io
+import json
+import os
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from models import db, Company, User, Expense, ImportJob, ImportStatus, ExpenseStatus, MAX_EXPENSE_AMOUNT
+from utils import update_rollups, get_policy, assign_first_approvers
+from currency import convert_amounts, CENTS
+
+# Rows parsed, inserted and committed together; the job's progress is saved with each chunk
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '5000'))
+# Rejected rows kept on the job with their line and reason; beyond this they are only counted
+MAX_IMPORT_ERRORS = 100
+IMPORT_COLUMNS = ('submitter_email', 'amount', 'currency_code', 'created_at', 'status', 'description', 'amount_converted')
+REQUIRED_IMPORT_COLUMNS = ('submitter_email', 'amount', 'currency_code', 'created_at')
+# Columns written by COPY on Postgres, in this order
+COPY_COLUMNS = ('id', 'company_id', 'submitter_id', 'amount', 'currency_code', 'amount_converted', 'description', 'status', 'created_at', 'updated_at')
+
+class InvalidImport(ValueError):
+    """The file or job cannot be imported; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def _digest_record(digest, record):
+    # JSON keeps field boundaries unambiguous whatever the fields contain
+    digest.update(json.dumps(record).encode() + b'\n')
+
+def _parse_decimal(text, field):
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f'{field} must be a number')
+    if not value.is_finite() or value <= 0:
+        raise ValueError(f'{field} must be a positive number')
+    if value > MAX_EXPENSE_AMOUNT:
+        raise ValueError(f'{field} is too large')
+    return value
+
+def _parse_timestamp(text):
+    value = datetime.fromisoformat(text)
+    if value.tzinfo is not None:
+        # Stored timestamps are naive UTC
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def parse_import_record(record, company_id, submitters):
+    """Expense row for one CSV record (a dict keyed by column); ValueError says what is wrong with it.
+
+    amount_converted is left as None when the file does not give it.
+    """
+    email = record['submitter_email'].strip().lower()
+    submitter_id = submitters.get(email)
+    if submitter_id is None:
+        raise ValueError(f'no user {email} in this company')
+    amount = _parse_decimal(record['amount'].strip(), 'amount')
+    currency_code = record['currency_code'].strip().upper()
+    if len(currency_code) != 3 or not currency_code.isalpha():
+        raise ValueError('currency_code must be a 3-letter code')
+    try:
+        created_at = _parse_timestamp(record['created_at'].strip())
+    except ValueError:
+        raise ValueError('created_at must be an ISO date or datetime')
+    status = (record.get('status') or '').strip().lower() or ExpenseStatus.pending.value
+    try:
+        status = ExpenseStatus(status)
+    except ValueError:
+        raise ValueError(f"status must be one of {', '.join(s.value for s in ExpenseStatus)}")
+    amount_converted = (record.get('amount_converted') or '').strip()
+    return {
+        'company_id': company_id,
+        'submitter_id': submitter_id,
+        'amount': amount,
+        'currency_code': currency_code,
+        'amount_converted': _parse_decimal(amount_converted, 'amount_converted').quantize(CENTS) if amount_converted else None,
+        'description': (record.get('description') or '').strip() or None,
+        'status': status,
+        'created_at': created_at,
+        'updated_at': created_at,
+    }
+
+def _convert_missing(rows, company_currency):
+    """Fill in amount_converted at the rate in force on each expense's date; rows without a rate keep None"""
+    by_date = {}
+    for row in rows:
+        if row['amount_converted'] is None:
+            by_date.setdefault(row['created_at'].date(), []).append(row)
+    # One rate lookup per date and currency, cached across chunks
+    for on, dated in by_date.items():
+        converted = convert_amounts([row['amount'] for row in dated], [row['currency_code'] for row in dated], company_currency, on)
+        for row, amount_converted in zip(dated, converted):
+            row['amount_converted'] = amount_converted
+
+def _copy_expenses(rows):
+    """COPY rows into expenses on Postgres; ids are drawn from the sequence first so pending rows can be routed"""
+    ids = sorted(db.session.execute(
+        db.text("SELECT nextval(pg_get_serial_sequence('expenses', 'id')) FROM generate_series(1, :n)"), {'n': len(rows)}
+    ).scalars())
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for expense_id, row in zip(ids, rows):
+        # An unquoted empty field is NULL in COPY's CSV format, which is what csv.writer makes of None
+        writer.writerow([expense_id] + [
+            row[column].value if column == 'status' else row[column] for column in COPY_COLUMNS[1:]
+        ])
+    buffer.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY expenses ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+    return ids
+
+def insert_expenses(rows):
+    """Insert expense rows with the database's bulk path and return their ids in row order"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return _copy_expenses(rows)
+    # Batched multi-row INSERT ... RETURNING elsewhere
+    return db.session.execute(
+        db.insert(Expense).returning(Expense.id, sort_by_parameter_order=True), rows
+    ).scalars().all()
+
+def create_import_job(company_id, created_by=None, filename=None):
+    job = ImportJob(company_id=company_id, created_by=created_by, filename=filename, status=ImportStatus.running)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def _read_header(reader):
+    try:
+        header = next(reader, None)
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise InvalidImport(f'Unreadable CSV header: {e}')
+    if not header:
+        raise InvalidImport('CSV file is empty')
+    columns = [name.strip().lower() for name in header]
+    missing = [column for column in REQUIRED_IMPORT_COLUMNS if column not in columns]
+    if missing:
+        raise InvalidImport(f"Missing columns: {', '.join(missing)}")
+    unknown = [column for column in columns if column not in IMPORT_COLUMNS]
+    if unknown:
+        raise InvalidImport(f"Unknown columns: {', '.join(unknown)}")
+    return header, columns
+
+def _import_chunk(job, chunk, columns, submitters, company_currency, digest):
+    """Insert one chunk and record the job's progress, all in one transaction"""
+    rows, rejected = [], []
+    for line, record in chunk:
+        _digest_record(digest, record)
+        if not record:
+            continue
+        try:
+            if len(record) != len(columns):
+                raise ValueError(f'expected {len(columns)} fields, found {len(record)}')
+            rows.append((line, parse_import_record(dict(zip(columns, record)), job.company_id, submitters)))
+        except ValueError as e:
+            rejected.append({'line': line, 'error': str(e)})
+
+    _convert_missing([row for _, row in rows], company_currency)
+    accepted = []
+    for line, row in rows:
+        if row['amount_converted'] is None:
+            rejected.append({'line': line, 'error': f"no exchange rate from {row['currency_code']} to {company_currency} on {row['created_at'].date()}"})
+        else:
+            accepted.append(row)
+    rejected.sort(key=lambda error: error['line'])
+
+    if accepted:
+        expense_ids = insert_expenses(accepted)
+        # Imported expenses keep their historical status; only the rollups and the approver inbox need to hear about them
+        update_rollups([(row['company_id'], row['status'], row['created_at'], row['amount_converted'], 1) for row in accepted])
+        assign_first_approvers(get_policy(job.company_id), [
+            expense_id for expense_id, row in zip(expense_ids, accepted) if row['status'] == ExpenseStatus.pending
+        ])
+
+    # Guarded on rows_done so two runs resuming the same job cannot both commit the same chunk
+    result = db.session.execute(db.update(ImportJob).where(
+        ImportJob.id == job.id, ImportJob.rows_done == job.rows_done
+    ).values(
+        rows_done=ImportJob.rows_done + len(chunk),
+        imported_rows=ImportJob.imported_rows + len(accepted),
+        failed_rows=ImportJob.failed_rows + len(rejected),
+        errors=((job.errors or []) + rejected)[:MAX_IMPORT_ERRORS],
+        checkpoint_sha256=digest.hexdigest()
+    ))
+    if result.rowcount != 1:
+        db.session.rollback()
+        raise InvalidImport(f'Import {job.id} is being run elsewhere', 409)
+    db.session.commit()
+
+def _stop(job, message):
+    db.session.rollback()
+    job.status = ImportStatus.failed
+    job.error = message
+    db.session.commit()
+
+def run_import(job, lines, chunk_size=IMPORT_CHUNK_SIZE, on_chunk=None):
+    """Stream CSV text lines into job's company, chunk_size rows at a time, continuing after job.rows_done.
+
+    Only one chunk of rows is held in memory. Each chunk's expenses, rollup
+    updates, first-approver assignments and the job's progress commit
+    together, so after any interruption the job records exactly which rows
+    are in and a later run over the same file picks up from there. Rows that
+    fail validation are counted and reported on the job, not fatal.
+    on_chunk(job) is called after every committed chunk.
+    """
+    if job.status == ImportStatus.completed:
+        raise InvalidImport(f'Import {job.id} has already completed', 409)
+    reader = csv.reader(lines)
+    header, columns = _read_header(reader)
+    numbered = ((reader.line_num, record) for record in reader)
+    digest = hashlib.sha256()
+    _digest_record(digest, header)
+
+    try:
+        # Skip what earlier runs committed, checking that it is the same file
+        skipped = 0
+        for _, record in islice(numbered, job.rows_done):
+            _digest_record(digest, record)
+            skipped += 1
+        if skipped != job.rows_done or (job.checkpoint_sha256 and digest.hexdigest() != job.checkpoint_sha256):
+            raise InvalidImport(f'This file does not start with the {job.rows_done} rows import {job.id} has already read', 409)
+
+        # Every submitter is resolved from memory; one query per import, not per row
+        submitters = {
+            email.lower(): user_id
+            for user_id, email in db.session.query(User.id, User.email).filter(User.company_id == job.company_id)
+        }
+        company_currency = db.session.query(Company.currency_code).filter(Company.id == job.company_id).scalar()
+        job.status = ImportStatus.running
+        job.error = None
+        db.session.commit()
+
+        while True:
+            chunk = list(islice(numbered, chunk_size))
+            if not chunk:
+                break
+            _import_chunk(job, chunk, columns, submitters, company_currency, digest)
+            if on_chunk:
+                on_chunk(job)
+        job.status = ImportStatus.completed
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+    except InvalidImport:
+        db.session.rollback()
+        raise
+    except (UnicodeDecodeError, csv.Error) as e:
+        _stop(job, f'Unreadable CSV after line {reader.line_num}: {e}')
+        raise InvalidImport(job.error)
+    except Exception as e:
+        _stop(job, str(e))
+        raise
+    return job
@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+
+# Load the app once in the master; workers fork with imports, mappers and
+# lookup tables already in memory, so scaling out costs a fork, not a boot.
+preload_app = True
+
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = int(os.getenv('WEB_CONCURRENCY', str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then to bound slow memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = 200
+accesslog = '-'
+
+def post_fork(server, worker):
+    """Drop database connections inherited from the master; each worker opens its own"""
+    from wsgi import app
+    from models import db
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    replica = app.extensions.get('replica_engine')
+    if replica is not None:
+        replica.dispose(close=False)
@@ -0,0 +1,68 @@
+import os
+from dataclasses import dataclass
+from flask import g
+from flask_jwt_extended import create_access_token, get_jwt, get_jwt_identity
+from models import db, User, UserRole
+from cache import TTLCache
+
+# Seconds a user's identity record is reused across requests in one worker.
+# Role changes, password changes and deletions made on another worker take effect within this window.
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', '60'))
+IDENTITY_CACHE_SIZE = 10000
+
+@dataclass(frozen=True)
+class Identity:
+    """The parts of a user every route needs for authorization and scoping"""
+    id: int
+    company_id: int
+    role: UserRole
+    token_version: int
+
+# user_id -> Identity, or None for a user known to be deleted
+_identity_cache = TTLCache(IDENTITY_CACHE_TTL, IDENTITY_CACHE_SIZE)
+
+def issue_token(user):
+    """Access token carrying role, company_id and token version (tv) as claims"""
+    return create_access_token(identity=str(user.id), additional_claims={
+        'role': user.role.value,
+        'company_id': user.company_id,
+        'tv': user.token_version
+    })
+
+def load_identity(user_id, fresh=False):
+    """Identity for a user id from the TTL cache, or one primary-key query on a miss (or when fresh)"""
+    hit, identity = (False, None) if fresh else _identity_cache.get(user_id)
+    if not hit:
+        # Always the primary: a lagging replica can still hold a revoked token_version
+        row = db.session.execute(
+            db.select(User.id, User.company_id, User.role, User.token_version).where(User.id == user_id),
+            bind_arguments={'bind': db.engine}
+        ).one_or_none()
+        identity = Identity(*row) if row else None
+        _identity_cache.set(user_id, identity)
+    return identity
+
+def refresh_identity(user):
+    """Replace the cached identity after a committed change to the user"""
+    _identity_cache.set(user.id, Identity(user.id, user.company_id, user.role, user.token_version))
+
+def forget_identity(user_id):
+    """Remember a deleted user so this worker rejects their tokens straight away"""
+    _identity_cache.set(user_id, None)
+
+def get_current_user(fresh=False):
+    """Identity of the caller checked against the database (through the cache).
+
+    Loaded at most once per request. Returns None if the user no longer exists
+    or the token predates a token_version bump. Every route authorizes through
+    this, reads included: the token's role and company claims are only a copy
+    of the record and are never trusted on their own. fresh skips the cache
+    and reads the record from the primary, so a change made on another worker
+    applies straight away instead of within IDENTITY_CACHE_TTL.
+    """
+    if fresh or '_current_identity' not in g:
+        identity = load_identity(int(get_jwt_identity()), fresh)
+        if identity is not None and identity.token_version != get_jwt().get('tv', 0):
+            identity = None
+        g._current_identity = identity
+    return g._current_identity
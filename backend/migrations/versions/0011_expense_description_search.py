@@ -0,0 +1,60 @@
+"""expense description search
+
+Revision ID: 0011
+Revises: 0010
+Create Date: 2026-10-17 06:40:12.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0011'
+down_revision = '0010'
+branch_labels = None
+depends_on = None
+
+# Kept in step with search.py, which creates the same objects for db.create_all
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # The generated column is filled for existing rows as part of the ALTER
+        op.execute(
+            "ALTER TABLE expenses ADD COLUMN description_tsv tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('english', coalesce(description, ''))) STORED"
+        )
+        op.execute("CREATE INDEX ix_expenses_description_tsv ON expenses USING gin (description_tsv)")
+    elif dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE expenses_fts USING fts5("
+            "description, content='expenses', content_rowid='id', tokenize='porter unicode61')"
+        )
+        op.execute(
+            "CREATE TRIGGER expenses_fts_ai AFTER INSERT ON expenses BEGIN "
+            "INSERT INTO expenses_fts(rowid, description) VALUES (new.id, new.description); END"
+        )
+        op.execute(
+            "CREATE TRIGGER expenses_fts_ad AFTER DELETE ON expenses BEGIN "
+            "INSERT INTO expenses_fts(expenses_fts, rowid, description) VALUES ('delete', old.id, old.description); END"
+        )
+        op.execute(
+            "CREATE TRIGGER expenses_fts_au AFTER UPDATE OF description ON expenses BEGIN "
+            "INSERT INTO expenses_fts(expenses_fts, rowid, description) VALUES ('delete', old.id, old.description); "
+            "INSERT INTO expenses_fts(rowid, description) VALUES (new.id, new.description); END"
+        )
+        # Index the rows that already exist
+        op.execute("INSERT INTO expenses_fts(expenses_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("DROP INDEX ix_expenses_description_tsv")
+        op.execute("ALTER TABLE expenses DROP COLUMN description_tsv")
+    elif dialect == 'sqlite':
+        for trigger in ('expenses_fts_ai', 'expenses_fts_ad', 'expenses_fts_au'):
+            op.execute(f"DROP TRIGGER {trigger}")
+        op.execute("DROP TABLE expenses_fts")
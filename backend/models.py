@@ -1,8 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from decimal import Decimal
 import enum
+from database import RoutingSession
 
-db = SQLAlchemy()
+# RoutingSession sends read-only views' SELECTs to the read replica when one is configured
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class UserRole(enum.Enum):
     admin = "admin"
@@ -19,6 +22,11 @@ class ApprovalDecision(enum.Enum):
     rejected = "rejected"
     pending = "pending"
 
+class ImportStatus(enum.Enum):
+    running = "running"
+    completed = "completed"
+    failed = "failed"
+
 class Company(db.Model):
     __tablename__ = 'companies'
     
@@ -43,13 +51,35 @@ class User(db.Model):
     full_name = db.Column(db.String(255), nullable=False)
     role = db.Column(db.Enum(UserRole), nullable=False)
     manager_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # Embedded in issued JWTs; bumping it revokes every token issued before the change
+    token_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped by every UPDATE of the row; list validators (ETags) are built from it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=db.literal_column('version', db.Integer) + 1)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
     
     # Relationships
     manager = db.relationship('User', remote_side=[id], backref='subordinates')
     submitted_expenses = db.relationship('Expense', backref='submitter', lazy=True)
     approvals = db.relationship('Approval', backref='approver', lazy=True)
     audit_logs = db.relationship('AuditLog', backref='user', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_users_company_id', 'company_id'),
+        db.Index('ix_users_manager_id', 'manager_id'),
+    )
+
+class UserHierarchy(db.Model):
+    """Closure table of the reporting tree: one row per (ancestor, descendant) pair, including self"""
+    __tablename__ = 'user_hierarchy'
+    
+    ancestor_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    descendant_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    depth = db.Column(db.Integer, nullable=False)  # 0 for the self row, 1 for direct reports
+    
+    __table_args__ = (
+        db.Index('ix_user_hierarchy_descendant', 'descendant_id', 'ancestor_id'),
+    )
 
 class Expense(db.Model):
     __tablename__ = 'expenses'
@@ -62,13 +92,59 @@ class Expense(db.Model):
     amount_converted = db.Column(db.Numeric(12, 2))  # company currency
     description = db.Column(db.Text)
     status = db.Column(db.Enum(ExpenseStatus), default=ExpenseStatus.pending)
-    receipt_path = db.Column(db.Text)
+    receipt_path = db.Column(db.Text)  # free text from older clients; uploads use the receipt_* columns
+    # Uploaded receipt: file content lives in the receipt store under its SHA-256 (see receipts.py)
+    receipt_sha256 = db.Column(db.String(64))
+    receipt_size = db.Column(db.Integer)
+    receipt_content_type = db.Column(db.String(100))
+    receipt_filename = db.Column(db.String(255))
+    # Bumped by every UPDATE of the row; list validators (ETags) are built from it
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=db.literal_column('version', db.Integer) + 1)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
     updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
     
     # Relationships
     approvals = db.relationship('Approval', backref='expense', lazy=True, cascade='all, delete-orphan')
     audit_logs = db.relationship('AuditLog', backref='expense', lazy=True, cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        db.Index('ix_expenses_company_submitter_status_created', 'company_id', 'submitter_id', 'status', 'created_at'),
+        # One submitter's expenses in date order; without it SQLite walks the company-wide date index instead
+        db.Index('ix_expenses_company_submitter_created', 'company_id', 'submitter_id', 'created_at', 'id'),
+        # Company-wide listings: date ranges and the default order, amount ranges and sort, currency and status filters
+        db.Index('ix_expenses_company_created', 'company_id', 'created_at', 'id'),
+        db.Index('ix_expenses_company_amount', 'company_id', 'amount_converted', 'id'),
+        db.Index('ix_expenses_company_currency_created', 'company_id', 'currency_code', 'created_at'),
+        db.Index('ix_expenses_company_status_created', 'company_id', 'status', 'created_at'),
+    )
+
+# Largest amount expenses.amount and amount_converted (Numeric(12, 2)) can hold
+MAX_EXPENSE_AMOUNT = Decimal('9999999999.99')
+
+class ExpenseRollup(db.Model):
+    """Expense count and amount_converted total per company, status and month, kept up to date incrementally"""
+    __tablename__ = 'expense_rollups'
+    
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), primary_key=True)
+    status = db.Column(db.Enum(ExpenseStatus), primary_key=True)
+    period = db.Column(db.String(7), primary_key=True)  # YYYY-MM of expenses.created_at
+    expense_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Numeric(14, 2), nullable=False, default=0)
+
+class ExchangeRate(db.Model):
+    """1 unit of base_currency = rate units of quote_currency, from effective_date onwards"""
+    __tablename__ = 'exchange_rates'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    base_currency = db.Column(db.String(3), nullable=False)
+    quote_currency = db.Column(db.String(3), nullable=False)
+    rate = db.Column(db.Numeric(18, 8), nullable=False)
+    effective_date = db.Column(db.Date, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.UniqueConstraint('base_currency', 'quote_currency', 'effective_date', name='uq_exchange_rates_pair_date'),
+    )
 
 class ApprovalFlow(db.Model):
     __tablename__ = 'approval_flows'
@@ -77,10 +153,16 @@ class ApprovalFlow(db.Model):
     company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=False)
     config = db.Column(db.JSON, nullable=False)  # { "sequence":[2,5,7], "rules":{...} }
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Bumped whenever the flow is replaced; GET /flows uses (id, version) as its ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1', onupdate=db.literal_column('version', db.Integer) + 1)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
     
     # Relationships
     creator = db.relationship('User', backref='created_flows', lazy=True)
+    
+    __table_args__ = (
+        db.Index('ix_approval_flows_company_id', 'company_id'),
+    )
 
 class Approval(db.Model):
     __tablename__ = 'approvals'
@@ -92,14 +174,49 @@ class Approval(db.Model):
     comments = db.Column(db.Text)
     acted_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
+    
+    __table_args__ = (
+        db.Index('ix_approvals_expense_approver_decision', 'expense_id', 'approver_id', 'decision'),
+        db.Index('ix_approvals_approver_decision_created', 'approver_id', 'decision', 'created_at'),
+    )
+
+class ImportJob(db.Model):
+    """One bulk CSV import of expenses; progress is committed with each chunk so a stopped import can resume"""
+    __tablename__ = 'import_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('companies.id'), nullable=False)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))  # NULL when started from the CLI
+    filename = db.Column(db.String(255))
+    status = db.Column(db.Enum(ImportStatus), nullable=False, default=ImportStatus.running)
+    # Data rows consumed so far (imported or rejected); a resumed run skips this many
+    rows_done = db.Column(db.Integer, nullable=False, default=0)
+    imported_rows = db.Column(db.Integer, nullable=False, default=0)
+    failed_rows = db.Column(db.Integer, nullable=False, default=0)
+    # SHA-256 over the header and the first rows_done rows; a resumed run must present the same prefix
+    checkpoint_sha256 = db.Column(db.String(64))
+    errors = db.Column(db.JSON)  # [{"line": n, "error": "..."}], the first MAX_IMPORT_ERRORS rejected rows
+    error = db.Column(db.Text)  # why the last run stopped, when it failed
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_import_jobs_company_id', 'company_id'),
+    )
 
 class AuditLog(db.Model):
     __tablename__ = 'audit_logs'
     
     id = db.Column(db.Integer, primary_key=True)
     expense_id = db.Column(db.Integer, db.ForeignKey('expenses.id'), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))  # NULL for system (policy engine) events
     action = db.Column(db.String(50), nullable=False)
     details = db.Column(db.JSON)  # Additional action details
     created_at = db.Column(db.DateTime, server_default=db.func.now())
-
+    
+    __table_args__ = (
+        db.Index('ix_audit_logs_expense_created', 'expense_id', 'created_at'),
+        # Company-wide export walks the log in time order over a date range
+        db.Index('ix_audit_logs_created_at', 'created_at'),
+    )
@@ -0,0 +1,85 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# werkzeug method string, e.g. "scrypt" or "pbkdf2:sha256:600000"; changing it rehashes users as they log in
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD', 'scrypt')
+# Hashes computed at once; hashlib releases the GIL, so threads use one core each
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', str(os.cpu_count() or 1)))
+# Hashes allowed in flight (running + waiting) before new requests are turned away; 0 means no limit
+PASSWORD_HASH_MAX_PENDING = int(os.getenv('PASSWORD_HASH_MAX_PENDING', str(PASSWORD_HASH_WORKERS * 4)))
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', '10'))
+
+class PasswordHasherBusy(RuntimeError):
+    """Too many password hashes are already queued, or one did not finish within the timeout; the caller should retry later"""
+
+class PasswordHasher:
+    """Runs password hashing on a bounded thread pool.
+
+    Each hash is a deliberately slow key-derivation run. Capping concurrent runs
+    at the core count keeps a login burst from starving every other request,
+    and rejecting work beyond max_pending fails fast instead of letting
+    requests queue until they time out. max_pending=0 disables the limit.
+    """
+
+    def __init__(self, method=PASSWORD_HASH_METHOD, max_workers=PASSWORD_HASH_WORKERS,
+                 max_pending=PASSWORD_HASH_MAX_PENDING, timeout=PASSWORD_HASH_TIMEOUT):
+        self.method = method
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(max_pending) if max_pending > 0 else None
+        # Hashes are "method$salt$hash"; hashing once normalises the method to the prefix werkzeug writes
+        self.prefix = generate_password_hash('', method).split('$', 1)[0]
+
+    def _wait(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Drop it if it never started; a hash already running finishes in the background
+            future.cancel()
+            raise PasswordHasherBusy('Password operation timed out, retry shortly')
+
+    def _run(self, fn, *args):
+        if self._slots is None:
+            return self._wait(self._executor.submit(fn, *args))
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy('Too many password operations in progress, retry shortly')
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is held until the hash actually finishes, even if this caller stops waiting
+        future.add_done_callback(lambda _: self._slots.release())
+        return self._wait(future)
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with a different method or work factor than the configured one"""
+        return password_hash.split('$', 1)[0] != self.prefix
+
+_hasher = None
+_hasher_lock = threading.Lock()
+
+def get_hasher():
+    global _hasher
+    if _hasher is None:
+        with _hasher_lock:
+            if _hasher is None:
+                _hasher = PasswordHasher()
+    return _hasher
+
+def hash_password(password):
+    return get_hasher().hash(password)
+
+def verify_password(password_hash, password):
+    return get_hasher().verify(password_hash, password)
+
+def needs_rehash(password_hash):
+    return get_hasher().needs_rehash(password_hash)
@@ -0,0 +1,99 @@
+from models import db, User, UserHierarchy, Expense, Approval, ApprovalFlow, AuditLog, ExpenseStatus, ApprovalDecision
+from utils import subtree_ids_query
+from datetime import datetime
+
+def hot_path_queries(company_id=1, user_id=1, expense_id=1):
+    """Representative statements for the main route queries, keyed by a readable name"""
+    from routes import expense_list_query
+    from search import search_expenses
+    expenses = expense_list_query().order_by(Expense.created_at.desc(), Expense.id.desc())
+    return {
+        'list_expenses (admin)': expenses.filter(Expense.company_id == company_id),
+        'list_expenses (manager)': expenses.filter(
+            Expense.company_id == company_id,
+            Expense.submitter_id.in_(subtree_ids_query(user_id))
+        ),
+        'list_expenses (employee)': expenses.filter(
+            Expense.company_id == company_id,
+            Expense.submitter_id == user_id
+        ),
+        'list_expenses (employee, status)': expenses.filter(
+            Expense.company_id == company_id,
+            Expense.submitter_id == user_id,
+            Expense.status == ExpenseStatus.pending
+        ),
+        'list_expenses (admin, created range)': expenses.filter(
+            Expense.company_id == company_id,
+            Expense.created_at >= datetime(2025, 1, 1),
+            Expense.created_at < datetime(2025, 4, 1)
+        ),
+        'list_expenses (admin, amount range by amount)': expense_list_query().filter(
+            Expense.company_id == company_id,
+            Expense.amount_converted >= 500
+        ).order_by(Expense.amount_converted.desc(), Expense.id.desc()),
+        'list_expenses (admin, currency)': expenses.filter(
+            Expense.company_id == company_id,
+            Expense.currency_code == 'EUR'
+        ),
+        'list_expenses (admin, status)': expenses.filter(
+            Expense.company_id == company_id,
+            Expense.status == ExpenseStatus.approved
+        ),
+        'search_expenses': search_expenses(expense_list_query().filter(Expense.company_id == company_id), ['taxi']),
+        'list_users': db.session.query(User.id, User.full_name).filter(User.company_id == company_id),
+        'direct_reports': db.session.query(User.id).filter(User.manager_id == user_id),
+        'subtree_membership': db.session.query(UserHierarchy.depth).filter(
+            UserHierarchy.ancestor_id == user_id,
+            UserHierarchy.descendant_id == user_id
+        ),
+        'pending_approval_for_approver': Approval.query.filter_by(
+            expense_id=expense_id,
+            approver_id=user_id,
+            decision=ApprovalDecision.pending
+        ),
+        'approver_inbox': Approval.query.filter_by(
+            approver_id=user_id,
+            decision=ApprovalDecision.pending
+        ).order_by(Approval.created_at, Approval.id),
+        'policy_approvals': Approval.query.filter_by(expense_id=expense_id),
+        'company_flow': ApprovalFlow.query.filter_by(company_id=company_id),
+        'audit_history': AuditLog.query.filter_by(expense_id=expense_id).order_by(AuditLog.created_at.desc()),
+        'audit_export': db.session.query(AuditLog.id).join(Expense, AuditLog.expense_id == Expense.id).filter(
+            Expense.company_id == company_id,
+            AuditLog.created_at >= datetime(2000, 1, 1)
+        ).order_by(AuditLog.created_at, AuditLog.id),
+    }
+
+def explain(query):
+    """Return the plan lines the current dialect reports for a query"""
+    dialect = db.engine.dialect.name
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if dialect == 'postgresql':
+        # Tiny tables make a seq scan the cheapest plan; disable it to see whether an index is usable at all
+        db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+        rows = db.session.execute(db.text('EXPLAIN ' + sql)).all()
+        return [row[0] for row in rows]
+    if dialect == 'sqlite':
+        rows = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + sql)).all()
+        return [row[-1] for row in rows]
+    raise NotImplementedError(f'EXPLAIN check is not supported on {dialect}')
+
+def is_sequential_scan(line):
+    line = line.strip()
+    if 'Seq Scan on' in line:
+        return True
+    # SQLite reports full table scans as "SCAN <table>" with no index clause; FTS5 lookups are "VIRTUAL TABLE INDEX"
+    return line.startswith('SCAN ') and 'USING' not in line and 'VIRTUAL TABLE INDEX' not in line
+
+def check_query_plans():
+    """EXPLAIN every hot-path query; returns {name: plan lines} for those that fall back to a sequential scan"""
+    failures = {}
+    try:
+        for name, query in hot_path_queries().items():
+            plan = explain(query)
+            if any(is_sequential_scan(line) for line in plan):
+                failures[name] = plan
+    finally:
+        db.session.rollback()
+    return failures
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import tempfile
+import time
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
+
+# Largest receipt accepted, in bytes
+RECEIPT_MAX_BYTES = int(os.getenv('RECEIPT_MAX_BYTES', str(10 * 1024 * 1024)))
+# Bytes read from the request body per step while streaming an upload to disk
+RECEIPT_CHUNK_SIZE = 64 * 1024
+RECEIPT_FIELD = 'file'
+# Most bytes the multipart decoder may hold at once (part headers and other form fields are buffered, file data is not)
+MULTIPART_BUFFER_BYTES = 256 * 1024
+
+# Leading bytes -> content type. The type is sniffed rather than taken from the
+# client so a receipt can never be served back as HTML or script.
+RECEIPT_SIGNATURES = (
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+SNIFF_BYTES = 12
+# prune leaves files younger than this alone; they may belong to an upload that has not committed yet
+PRUNE_GRACE_SECONDS = 3600
+
+class InvalidReceipt(ValueError):
+    """The upload is not an acceptable receipt; status is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def sniff_content_type(head):
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, content_type in RECEIPT_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+class ReceiptStore:
+    """Content-addressed receipt files under root, named by their SHA-256.
+
+    Uploads are written to a temporary file in chunks while being hashed, then
+    renamed into place, so identical receipts are stored once however often
+    they are uploaded and a partial upload is never visible under a digest.
+    """
+
+    def __init__(self, root, max_bytes=RECEIPT_MAX_BYTES, chunk_size=RECEIPT_CHUNK_SIZE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+
+    def path_for(self, digest):
+        # Two-character fan-out keeps directories small
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def exists(self, digest):
+        return os.path.exists(self.path_for(digest))
+
+    def save_upload(self, stream, content_type, content_length=None):
+        """Stream the RECEIPT_FIELD part of a multipart body to the store.
+
+        Returns a dict with sha256, size, content_type and filename. Other
+        parts are read past without being kept. Raises InvalidReceipt for a
+        malformed, oversized or unsupported upload.
+        """
+        mimetype, options = parse_options_header(content_type or '')
+        boundary = options.get('boundary')
+        if mimetype != 'multipart/form-data' or not boundary:
+            raise InvalidReceipt('Upload must be multipart/form-data with a "file" part')
+        if content_length is not None and content_length > self.max_bytes + self.chunk_size:
+            raise InvalidReceipt(f'Receipt must be at most {self.max_bytes} bytes', 413)
+
+        os.makedirs(os.path.join(self.root, 'tmp'), exist_ok=True)
+        decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=MULTIPART_BUFFER_BYTES)
+        temp = tempfile.NamedTemporaryFile(dir=os.path.join(self.root, 'tmp'), delete=False)
+        digest = hashlib.sha256()
+        size = 0
+        head = b''
+        filename = None
+        in_file = done = False
+        try:
+            with temp:
+                while True:
+                    chunk = stream.read(self.chunk_size)
+                    # None tells the decoder the body has ended
+                    decoder.receive_data(chunk or None)
+                    event = decoder.next_event()
+                    while not isinstance(event, (NeedData, Epilogue)):
+                        if isinstance(event, File):
+                            in_file = event.name == RECEIPT_FIELD and not done
+                            if in_file:
+                                filename = os.path.basename(event.filename or '') or None
+                        elif isinstance(event, Field):
+                            in_file = False
+                        elif isinstance(event, Data) and in_file:
+                            size += len(event.data)
+                            if size > self.max_bytes:
+                                raise InvalidReceipt(f'Receipt must be at most {self.max_bytes} bytes', 413)
+                            if len(head) < SNIFF_BYTES:
+                                head += event.data[:SNIFF_BYTES - len(head)]
+                            digest.update(event.data)
+                            temp.write(event.data)
+                            if not event.more_data:
+                                in_file = False
+                                done = True
+                        event = decoder.next_event()
+                    if isinstance(event, Epilogue) or not chunk:
+                        break
+                if not done:
+                    raise InvalidReceipt('Upload must be multipart/form-data with a "file" part')
+                if size == 0:
+                    raise InvalidReceipt('Receipt file is empty')
+                detected = sniff_content_type(head)
+                if detected is None:
+                    raise InvalidReceipt('Receipt must be a PDF, PNG, JPEG, GIF or WebP file', 415)
+                temp.flush()
+                os.fsync(temp.fileno())
+            sha256 = digest.hexdigest()
+            path = self.path_for(sha256)
+            if os.path.exists(path):
+                # Already stored by an earlier upload of the same bytes; touch it so prune sees it as fresh
+                os.unlink(temp.name)
+                os.utime(path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp.name, path)
+        except BaseException as e:
+            if os.path.exists(temp.name):
+                os.unlink(temp.name)
+            if isinstance(e, (ValueError, RequestEntityTooLarge)) and not isinstance(e, InvalidReceipt):
+                # The decoder rejects malformed bodies with ValueError and oversized form fields with 413
+                status = 413 if isinstance(e, RequestEntityTooLarge) else 400
+                raise InvalidReceipt('Malformed or oversized multipart body', status) from e
+            raise
+        return {'sha256': sha256, 'size': size, 'content_type': detected, 'filename': filename}
+
+    def prune(self, referenced, grace_seconds=PRUNE_GRACE_SECONDS):
+        """Delete stored files whose digest is not in referenced; returns how many were removed"""
+        cutoff = time.time() - grace_seconds
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        for prefix in os.listdir(self.root):
+            directory = os.path.join(self.root, prefix)
+            if len(prefix) != 2 or not os.path.isdir(directory):
+                continue
+            for rest in os.listdir(directory):
+                path = os.path.join(directory, rest)
+                if prefix + rest not in referenced and os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+def init_receipts(app):
+    """Attach the ReceiptStore; files live in RECEIPT_STORAGE_DIR, by default instance/receipts"""
+    root = app.config.get('RECEIPT_STORAGE_DIR') or os.getenv('RECEIPT_STORAGE_DIR') or os.path.join(app.instance_path, 'receipts')
+    store = ReceiptStore(root, max_bytes=app.config.get('RECEIPT_MAX_BYTES', RECEIPT_MAX_BYTES))
+    app.extensions['receipt_store'] = store
+    return store
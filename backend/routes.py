@@ -1,9 +1,26 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, Company, User, Expense, Approval, ApprovalFlow, AuditLog, UserRole, ExpenseStatus, ApprovalDecision
-from utils import get_currency_from_country, create_audit_log, evaluate_policy, convert_currency
+from flask import Blueprint, Response, current_app, request, jsonify, send_file, stream_with_context
+from flask_jwt_extended import jwt_required
+from models import db, Company, User, Expense, ExpenseRollup, Approval, ApprovalFlow, AuditLog, ImportJob, UserRole, ExpenseStatus, ApprovalDecision, MAX_EXPENSE_AMOUNT
+from utils import (
+    create_audit_log, evaluate_policy,
+    subtree_ids_query, is_in_subtree, subtree_members, add_to_hierarchy, move_in_hierarchy, remove_from_hierarchy,
+    encode_cursor, decode_cursor, cursor_value, keyset_after, compile_policy, invalidate_policy, month_bucket,
+    get_policy, assign_first_approvers, evaluate_policies, update_rollups
+)
+from currency import convert_currency, convert_amounts, CurrencyConversionError, get_currency_from_country, CENTS
+from audit import record_audit_logs
+from passwords import hash_password, verify_password, needs_rehash, PasswordHasherBusy
+from database import read_only
+from identity import issue_token, get_current_user, refresh_identity, forget_identity
+from receipts import InvalidReceipt
+from search import search_terms, search_expenses
+from expense_import import InvalidImport, create_import_job, run_import
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
+import csv
+import hashlib
+import io
+import json
 import os
 
 # Create blueprints
@@ -12,6 +29,377 @@ users_bp = Blueprint('users', __name__, url_prefix='/users')
 expenses_bp = Blueprint('expenses', __name__, url_prefix='/expenses')
 flows_bp = Blueprint('flows', __name__, url_prefix='/flows')
 audit_bp = Blueprint('audit', __name__, url_prefix='/audit')
+approvals_bp = Blueprint('approvals', __name__, url_prefix='/approvals')
+
+# Page size limits for keyset-paginated listings
+MAX_PAGE_SIZE = 200
+# Largest number of items accepted by the batch endpoints
+MAX_BATCH_SIZE = 1000
+# Rows fetched per round trip from the server-side cursor when streaming
+STREAM_BATCH_SIZE = 500
+# Sort keys accepted by GET /expenses (a leading '-' sorts descending); each has a company-wide index
+EXPENSE_SORT_KEYS = ('created_at', 'amount_converted')
+# Results returned by GET /expenses/search unless limit says otherwise
+SEARCH_PAGE_SIZE = 20
+
+def validate_expense_payload(data):
+    """Return an error message for an invalid expense submission, or None"""
+    if not isinstance(data, dict):
+        return 'expense must be a JSON object'
+    required_fields = ['amount', 'currency_code', 'description']
+    for field in required_fields:
+        if not data.get(field):
+            return f'{field} is required'
+    try:
+        amount = Decimal(str(data['amount']))
+    except InvalidOperation:
+        return 'amount must be a number'
+    if not amount.is_finite() or amount <= 0:
+        return 'amount must be positive'
+    # Anything the columns cannot hold is caught here, so one bad batch item never fails the INSERT for the rest
+    if amount > MAX_EXPENSE_AMOUNT:
+        return f'amount must be at most {MAX_EXPENSE_AMOUNT}'
+    currency_code = data['currency_code']
+    if not isinstance(currency_code, str) or len(currency_code) != 3 or not (currency_code.isascii() and currency_code.isalpha()):
+        return 'currency_code must be a 3-letter code'
+    if not isinstance(data['description'], str):
+        return 'description must be a string'
+    if data.get('receipt_path') is not None and not isinstance(data['receipt_path'], str):
+        return 'receipt_path must be a string'
+    return None
+
+def expense_list_query():
+    """Column-projected expense rows with the submitter name joined in (no ORM hydration)"""
+    return db.session.query(
+        Expense.id,
+        Expense.amount,
+        Expense.currency_code,
+        Expense.amount_converted,
+        Expense.description,
+        Expense.status,
+        Expense.submitter_id,
+        User.full_name.label('submitter_name'),
+        User.version.label('submitter_version'),
+        Expense.receipt_sha256,
+        Expense.version,
+        Expense.created_at,
+        Expense.updated_at
+    ).join(User, Expense.submitter_id == User.id)
+
+def serialize_expense(row):
+    return {
+        'id': row.id,
+        'amount': str(row.amount),
+        'currency_code': row.currency_code,
+        'amount_converted': str(row.amount_converted),
+        'description': row.description,
+        'status': row.status.value,
+        'submitter_id': row.submitter_id,
+        'submitter_name': row.submitter_name,
+        'receipt_sha256': row.receipt_sha256,
+        'created_at': row.created_at.isoformat()
+    }
+
+def filter_expenses(query):
+    """Apply the created_at, amount_converted and currency_code filters in the query string.
+
+    from is inclusive and to exclusive (ISO date or datetime); min_amount and
+    max_amount are inclusive bounds in company currency; currency_code may be
+    repeated. Raises ValueError with a client-facing message.
+    """
+    for param in ('from', 'to'):
+        if request.args.get(param):
+            try:
+                bound = datetime.fromisoformat(request.args[param])
+            except ValueError:
+                raise ValueError(f'invalid {param} date')
+            query = query.filter(Expense.created_at >= bound if param == 'from' else Expense.created_at < bound)
+    for param in ('min_amount', 'max_amount'):
+        if request.args.get(param):
+            try:
+                bound = Decimal(request.args[param])
+            except InvalidOperation:
+                raise ValueError(f'{param} must be a number')
+            if not bound.is_finite():
+                raise ValueError(f'{param} must be a number')
+            query = query.filter(Expense.amount_converted >= bound if param == 'min_amount' else Expense.amount_converted <= bound)
+    currencies = [code.upper() for code in request.args.getlist('currency_code') if code]
+    if currencies:
+        query = query.filter(Expense.currency_code.in_(currencies))
+    return query
+
+def parse_expense_sort():
+    """(column name, descending) from the sort query param, default newest first; raises ValueError"""
+    sort = request.args.get('sort', '-created_at')
+    descending = sort.startswith('-')
+    key = sort[1:] if descending else sort
+    if key not in EXPENSE_SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(EXPENSE_SORT_KEYS)}, optionally prefixed with -")
+    return key, descending
+
+def scope_expenses(query, current_user):
+    """Restrict an expense query to what the user may see.
+
+    - admin: sees all company expenses
+    - manager: sees own expenses and those of direct and indirect reports
+    - employee: sees only their own expenses
+    """
+    query = query.filter(Expense.company_id == current_user.company_id)
+    if current_user.role == UserRole.manager:
+        # subtree (including the manager) comes from the hierarchy closure table
+        return query.filter(Expense.submitter_id.in_(subtree_ids_query(current_user.id)))
+    if current_user.role != UserRole.admin:
+        return query.filter(Expense.submitter_id == current_user.id)
+    return query
+
+STATS_GROUPS = ('status', 'submitter', 'currency', 'month')
+STATS_PERCENTILES = (50, 90, 95)
+
+def stats_group_columns(group_by):
+    """Labelled GROUP BY expressions for the requested stats dimensions"""
+    columns = []
+    for name in group_by:
+        if name == 'status':
+            columns.append(Expense.status.label('status'))
+        elif name == 'submitter':
+            columns += [Expense.submitter_id.label('submitter_id'), User.full_name.label('submitter_name')]
+        elif name == 'currency':
+            columns.append(Expense.currency_code.label('currency_code'))
+        elif name == 'month':
+            columns.append(month_bucket(Expense.created_at).label('month'))
+    return columns
+
+def expense_stats_query(current_user, group_by):
+    """Count, total, average, min, max and nearest-rank percentiles of amount_converted per group, in one statement.
+
+    Postgres computes the percentiles with percentile_disc; other databases get the
+    same values from row_number/count windows over the amount column.
+    """
+    columns = stats_group_columns(group_by)
+    amount = Expense.amount_converted
+    if db.session.get_bind().dialect.name == 'postgresql':
+        query = db.session.query(
+            *columns,
+            db.func.count().label('count'),
+            db.func.sum(amount).label('total'),
+            db.func.avg(amount).label('average'),
+            db.func.min(amount).label('min'),
+            db.func.max(amount).label('max'),
+            *[db.func.percentile_disc(p / 100).within_group(amount).label(f'p{p}') for p in STATS_PERCENTILES]
+        )
+        if 'submitter' in group_by:
+            query = query.join(User, Expense.submitter_id == User.id)
+        return scope_expenses(query, current_user).group_by(*columns).order_by(*columns)
+    
+    partition = [column.element for column in columns] or None
+    ranked = db.session.query(
+        *columns,
+        amount.label('amount'),
+        db.func.row_number().over(partition_by=partition, order_by=amount).label('rank'),
+        db.func.count().over(partition_by=partition).label('size')
+    )
+    if 'submitter' in group_by:
+        ranked = ranked.join(User, Expense.submitter_id == User.id)
+    ranked = scope_expenses(ranked, current_user).subquery()
+    groups = [ranked.c[column.name] for column in columns]
+    # The p-th percentile is the smallest amount whose rank reaches p% of the group
+    return db.session.query(
+        *groups,
+        db.func.count().label('count'),
+        db.func.sum(ranked.c.amount).label('total'),
+        db.func.avg(ranked.c.amount).label('average'),
+        db.func.min(ranked.c.amount).label('min'),
+        db.func.max(ranked.c.amount).label('max'),
+        *[db.func.min(db.case((ranked.c.rank * 100 >= p * ranked.c.size, ranked.c.amount))).label(f'p{p}') for p in STATS_PERCENTILES]
+    ).group_by(*groups).order_by(*groups)
+
+def format_amount(value):
+    return str(Decimal(str(value)).quantize(CENTS)) if value is not None else None
+
+def serialize_expense_stats(row, group_by):
+    result = {}
+    if 'status' in group_by:
+        result['status'] = row.status.value if isinstance(row.status, ExpenseStatus) else row.status
+    if 'submitter' in group_by:
+        result.update(submitter_id=row.submitter_id, submitter_name=row.submitter_name)
+    if 'currency' in group_by:
+        result['currency_code'] = row.currency_code
+    if 'month' in group_by:
+        result['month'] = row.month
+    result['count'] = row.count
+    for key in ('total', 'average', 'min', 'max') + tuple(f'p{p}' for p in STATS_PERCENTILES):
+        result[key] = format_amount(getattr(row, key))
+    return result
+
+def audit_log_query():
+    """Column-projected audit rows with the acting user's name joined in (NULL user = system event)"""
+    return db.session.query(
+        AuditLog.id,
+        AuditLog.expense_id,
+        AuditLog.action,
+        AuditLog.details,
+        AuditLog.user_id,
+        User.full_name.label('user_name'),
+        AuditLog.created_at
+    ).outerjoin(User, AuditLog.user_id == User.id)
+
+def serialize_audit_log(row):
+    return {
+        'id': row.id,
+        'expense_id': row.expense_id,
+        'action': row.action,
+        'details': row.details,
+        'user_id': row.user_id,
+        'user_name': row.user_name or 'System',
+        'created_at': row.created_at.isoformat()
+    }
+
+def serialize_import_job(job):
+    return {
+        'id': job.id,
+        'filename': job.filename,
+        'status': job.status.value,
+        'rows_done': job.rows_done,
+        'imported_rows': job.imported_rows,
+        'failed_rows': job.failed_rows,
+        'errors': job.errors or [],
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+AUDIT_EXPORT_COLUMNS = ['id', 'expense_id', 'action', 'details', 'user_id', 'user_name', 'created_at']
+
+def stream_audit_export(rows, export_format):
+    """Stream audit rows as NDJSON or CSV, one line per row"""
+    def generate_ndjson():
+        for row in rows:
+            yield json.dumps(serialize_audit_log(row)) + '\n'
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(AUDIT_EXPORT_COLUMNS)
+        for row in rows:
+            record = serialize_audit_log(row)
+            record['details'] = json.dumps(record['details'])
+            writer.writerow([record[column] for column in AUDIT_EXPORT_COLUMNS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    if export_format == 'csv':
+        body, mimetype = generate_csv(), 'text/csv'
+    else:
+        body, mimetype = generate_ndjson(), 'application/x-ndjson'
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename=audit_export.{export_format}'
+    })
+
+def parse_page_args(order, default_limit=MAX_PAGE_SIZE):
+    """Read limit/cursor query params; raises ValueError with a client-facing message.
+
+    order names the listing's sort (e.g. '-created_at'); a cursor issued for another
+    order is refused. Returns (limit, after), after being the cursor's
+    (sort value, id) or None on the first page.
+    """
+    try:
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        raise ValueError('invalid limit')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise ValueError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    after = None
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            cursor_order, sort_value, last_id = decode_cursor(cursor)
+            last_id = int(last_id)
+        except (TypeError, ValueError):
+            raise ValueError('Invalid cursor')
+        if cursor_order != order:
+            raise ValueError(f'cursor belongs to sort={cursor_order}, not sort={order}')
+        after = (sort_value, last_id)
+    return limit, after
+
+def fetch_page(query, limit, order, sort_key, id_key='id'):
+    """Fetch one keyset page (limit + 1 rows tells whether another page exists).
+
+    The cursor carries the order and the last row's sort value and id.
+    """
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(order, cursor_value(getattr(rows[-1], sort_key)), getattr(rows[-1], id_key))
+    return rows, next_cursor
+
+def stream_json_list(key, rows, serializer):
+    """Stream {"<key>": [...]} one row at a time instead of building the whole list"""
+    def generate():
+        yield '{"%s": [' % key
+        separator = ''
+        for row in rows:
+            yield separator + json.dumps(serializer(row))
+            separator = ','
+        yield ']}'
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def collection_validator(rows, joined_version=None):
+    """(count, max id, sum of versions) of fetched rows and their latest updated_at.
+
+    Any insert raises the max id or the count, any delete lowers the count and
+    any update bumps a version, so the triple changes with every change to
+    the rows, even several within one timestamp tick. joined_version names a
+    row attribute holding the version of a joined row whose columns are also
+    returned (the submitter behind submitter_name); its sum is added so
+    editing that row changes the validator too.
+    """
+    validator = (len(rows), max((row.id for row in rows), default=None), sum(row.version for row in rows))
+    if joined_version:
+        validator += (sum(getattr(row, joined_version) for row in rows),)
+    return validator, max((row.updated_at for row in rows if row.updated_at), default=None)
+
+def collection_validator_query(query, model, joined_version=None):
+    """collection_validator of everything the query would return, in one aggregate statement.
+
+    joined_version is the version column of the joined table, e.g. User.version.
+    """
+    columns = [
+        db.func.count(model.id),
+        db.func.max(model.id),
+        db.func.coalesce(db.func.sum(model.version), 0),
+        db.func.max(model.updated_at)
+    ]
+    if joined_version is not None:
+        columns.append(db.func.coalesce(db.func.sum(joined_version), 0))
+    count, max_id, versions, updated_at, *joined = query.order_by(None).with_entities(*columns).one()
+    return (count, max_id, versions, *joined), updated_at
+
+def listing_etag(current_user, validator, *extra):
+    """Weak ETag for a listing as seen by this caller with this query string"""
+    key = json.dumps([current_user.id, current_user.role.value, sorted(request.args.items(multi=True)), validator, *extra], default=str)
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def with_validators(response, etag, last_modified=None):
+    """Attach ETag/Last-Modified and make clients revalidate before reusing their copy.
+
+    Only If-None-Match produces a 304: If-Modified-Since has one-second
+    resolution and cannot see deletions, so it is not trusted on its own.
+    """
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+def not_modified(etag, last_modified=None):
+    """Empty 304 response, or None if the client's copy does not match etag"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
 
 # Auth routes
 @auth_bp.route('/signup', methods=['POST'])
@@ -29,8 +417,13 @@ def signup():
         if User.query.filter_by(email=data['email']).first():
             return jsonify({'error': 'User already exists'}), 400
         
-        # Get currency from country
+        # Get currency from country (bundled table, no network call)
         currency_code = get_currency_from_country(data['country_code'])
+        if not currency_code:
+            return jsonify({'error': 'Unknown country_code'}), 400
+        
+        # Hash before opening the transaction so no locks are held during the slow part
+        password_hash = hash_password(data['password'])
         
         # Create company
         company = Company(
@@ -45,15 +438,17 @@ def signup():
         user = User(
             company_id=company.id,
             email=data['email'],
-            password_hash=generate_password_hash(data['password']),
+            password_hash=password_hash,
             full_name=data['full_name'],
             role=UserRole.admin
         )
         db.session.add(user)
+        db.session.flush()
+        add_to_hierarchy(user)
         db.session.commit()
 
         # Create access token (ensure identity is a string so JWT 'sub' is a string)
-        access_token = create_access_token(identity=str(user.id))
+        access_token = issue_token(user)
 
         return jsonify({
             'message': 'User and company created successfully',
@@ -67,6 +462,8 @@ def signup():
             }
         }), 201
         
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -81,10 +478,15 @@ def login():
         
         user = User.query.filter_by(email=data['email']).first()
         
-        if not user or not check_password_hash(user.password_hash, data['password']):
+        if not user or not verify_password(user.password_hash, data['password']):
             return jsonify({'error': 'Invalid credentials'}), 401
+        
+        # Upgrade hashes made with an older method or work factor while the plaintext is at hand
+        if needs_rehash(user.password_hash):
+            user.password_hash = hash_password(data['password'])
+            db.session.commit()
 
-        access_token = create_access_token(identity=str(user.id))
+        access_token = issue_token(user)
 
         return jsonify({
             'access_token': access_token,
@@ -97,6 +499,8 @@ def login():
             }
         }), 200
         
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -106,8 +510,7 @@ def login():
 def create_user():
     try:
         print(1)
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -133,16 +536,27 @@ def create_user():
         except ValueError:
             return jsonify({'error': 'Invalid role'}), 400
         
-        # Create user
+        # Validate manager belongs to the same company
+        manager_id = data.get('manager_id')
+        if manager_id is not None:
+            if not isinstance(manager_id, int) or isinstance(manager_id, bool):
+                return jsonify({'error': 'manager_id must be an integer'}), 400
+            manager = User.query.get(manager_id)
+            if not manager or manager.company_id != current_user.company_id:
+                return jsonify({'error': 'Invalid manager_id'}), 400
+        
+        # Create user (password hashed on the bounded hashing pool)
         user = User(
             company_id=current_user.company_id,
             email=data['email'],
-            password_hash=generate_password_hash(data['password']),
+            password_hash=hash_password(data['password']),
             full_name=data['full_name'],
             role=role,
-            manager_id=data.get('manager_id')
+            manager_id=manager_id
         )
         db.session.add(user)
+        db.session.flush()
+        add_to_hierarchy(user)
         db.session.commit()
         
         return jsonify({
@@ -156,23 +570,36 @@ def create_user():
             }
         }), 201
         
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @users_bp.route('', methods=['GET'])
 @jwt_required()
+@read_only
 def list_users():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
         
-        users = User.query.filter_by(company_id=current_user.company_id).all()
+        query = db.session.query(
+            User.id, User.email, User.full_name, User.role, User.manager_id, User.version, User.created_at, User.updated_at
+        ).filter(User.company_id == current_user.company_id)
         
-        return jsonify({
+        # A poll with a matching ETag is answered from one aggregate query, without fetching rows
+        if request.if_none_match:
+            validator, last_modified = collection_validator_query(query, User)
+            response = not_modified(listing_etag(current_user, validator), last_modified)
+            if response:
+                return response
+        
+        users = query.all()
+        validator, last_modified = collection_validator(users)
+        response = jsonify({
             'users': [{
                 'id': user.id,
                 'email': user.email,
@@ -181,7 +608,8 @@ def list_users():
                 'manager_id': user.manager_id,
                 'created_at': user.created_at.isoformat()
             } for user in users]
-        }), 200
+        })
+        return with_validators(response, listing_etag(current_user, validator), last_modified), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -191,8 +619,7 @@ def list_users():
 @jwt_required()
 def update_user(user_id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
 
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -211,17 +638,35 @@ def update_user(user_id):
             user.email = data['email']
         if data.get('full_name'):
             user.full_name = data['full_name']
-        if data.get('manager_id') is not None:
-            user.manager_id = data.get('manager_id')
+        manager_id = data.get('manager_id')
+        if manager_id is not None and (not isinstance(manager_id, int) or isinstance(manager_id, bool)):
+            return jsonify({'error': 'manager_id must be an integer'}), 400
+        if manager_id is not None and manager_id != user.manager_id:
+            manager = User.query.get(manager_id)
+            if not manager or manager.company_id != current_user.company_id:
+                return jsonify({'error': 'Invalid manager_id'}), 400
+            # A user cannot report to themselves or to anyone in their own subtree
+            if is_in_subtree(user.id, manager_id):
+                return jsonify({'error': 'manager_id would create a reporting cycle'}), 400
+            user.manager_id = manager_id
+            move_in_hierarchy(user.id, manager_id)
+        revoke_tokens = False
         if data.get('role'):
             try:
-                user.role = UserRole(data['role'])
+                role = UserRole(data['role'])
             except ValueError:
                 return jsonify({'error': 'Invalid role'}), 400
+            revoke_tokens = role != user.role
+            user.role = role
         if data.get('password'):
-            user.password_hash = generate_password_hash(data['password'])
+            user.password_hash = hash_password(data['password'])
+            revoke_tokens = True
+        if revoke_tokens:
+            # Outstanding tokens carry the old role claim or were issued under the old password
+            user.token_version = User.token_version + 1
 
         db.session.commit()
+        refresh_identity(user)
 
         return jsonify({'message': 'User updated successfully', 'user': {
             'id': user.id,
@@ -232,6 +677,8 @@ def update_user(user_id):
             'manager_id': user.manager_id
         }}), 200
 
+    except PasswordHasherBusy:
+        raise
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -241,8 +688,7 @@ def update_user(user_id):
 @jwt_required()
 def delete_user(user_id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
 
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -258,8 +704,10 @@ def delete_user(user_id):
         if user.id == current_user.id:
             return jsonify({'error': 'Cannot delete yourself'}), 400
 
+        remove_from_hierarchy(user.id)
         db.session.delete(user)
         db.session.commit()
+        forget_identity(user_id)
 
         return jsonify({'message': 'User deleted successfully'}), 200
 
@@ -272,8 +720,7 @@ def delete_user(user_id):
 @jwt_required()
 def create_expense():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -281,18 +728,20 @@ def create_expense():
         data = request.get_json()
         
         # Validate required fields
-        required_fields = ['amount', 'currency_code', 'description']
-        for field in required_fields:
-            if not data.get(field):
-                return jsonify({'error': f'{field} is required'}), 400
+        error = validate_expense_payload(data)
+        if error:
+            return jsonify({'error': error}), 400
         
         # Convert amount to company currency
         company = Company.query.get(current_user.company_id)
-        amount_converted = convert_currency(
-            data['amount'], 
-            data['currency_code'], 
-            company.currency_code
-        )
+        try:
+            amount_converted = convert_currency(
+                data['amount'], 
+                data['currency_code'], 
+                company.currency_code
+            )
+        except CurrencyConversionError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Create expense
         expense = Expense(
@@ -305,7 +754,8 @@ def create_expense():
             receipt_path=data.get('receipt_path')
         )
         db.session.add(expense)
-        db.session.commit()
+        db.session.flush()  # Get expense ID and created_at (INSERT ... RETURNING)
+        update_rollups([(expense.company_id, expense.status, expense.created_at, expense.amount_converted, 1)])
         
         # Create audit log
         create_audit_log(expense.id, current_user.id, 'expense_created', {
@@ -314,7 +764,10 @@ def create_expense():
         })
         
         # Evaluate policy to assign first approver
-        evaluate_policy(expense.id)
+        evaluate_policy(expense)
+        
+        # Expense, audit entries and first approval land in a single commit
+        db.session.commit()
         
         return jsonify({
             'message': 'Expense created successfully',
@@ -333,12 +786,173 @@ def create_expense():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@expenses_bp.route('/batch', methods=['POST'])
+@jwt_required()
+def create_expenses_batch():
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        data = request.get_json() or {}
+        items = data.get('expenses')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'expenses must be a non-empty list'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'at most {MAX_BATCH_SIZE} expenses per batch'}), 400
+        
+        company = Company.query.get(current_user.company_id)
+        
+        # Validate every item up front; invalid items are reported, valid ones still go in
+        results = []
+        valid = []
+        for index, item in enumerate(items):
+            result = {'index': index}
+            results.append(result)
+            error = validate_expense_payload(item)
+            if error:
+                result.update(status='error', error=error)
+            else:
+                valid.append((result, item))
+        
+        # Convert the whole batch with one rate lookup per distinct currency
+        converted = convert_amounts(
+            [item['amount'] for _, item in valid],
+            [item['currency_code'] for _, item in valid],
+            company.currency_code
+        )
+        rows = []
+        for (result, item), amount_converted in zip(valid, converted):
+            if amount_converted is None:
+                result.update(status='error', error=f"No exchange rate from {item['currency_code']} to {company.currency_code}")
+                continue
+            result['status'] = 'created'
+            rows.append({
+                'company_id': current_user.company_id,
+                'submitter_id': current_user.id,
+                'amount': Decimal(str(item['amount'])),
+                'currency_code': item['currency_code'],
+                'amount_converted': amount_converted,
+                'description': item['description'],
+                'status': ExpenseStatus.pending,
+                'receipt_path': item.get('receipt_path')
+            })
+        
+        if rows:
+            # One multi-row INSERT ... RETURNING for the expenses, one each for their rollups and audit entries
+            inserted = db.session.execute(
+                db.insert(Expense).returning(Expense.id, Expense.created_at, sort_by_parameter_order=True), rows
+            ).all()
+            expense_ids = [row.id for row in inserted]
+            update_rollups([
+                (current_user.company_id, ExpenseStatus.pending, row.created_at, values['amount_converted'], 1)
+                for row, values in zip(inserted, rows)
+            ])
+            record_audit_logs([{
+                'expense_id': expense_id,
+                'user_id': current_user.id,
+                'action': 'expense_created',
+                'details': {'amount': str(row['amount']), 'currency': row['currency_code'], 'batch': True}
+            } for expense_id, row in zip(expense_ids, rows)])
+            
+            # Assign the first approver for the whole batch at once
+            assign_first_approvers(get_policy(current_user.company_id), expense_ids)
+            db.session.commit()
+            
+            created = iter(expense_ids)
+            for result in results:
+                if result['status'] == 'created':
+                    result['expense_id'] = next(created)
+        
+        if not rows:
+            status_code = 400
+        elif len(rows) < len(items):
+            status_code = 207
+        else:
+            status_code = 201
+        return jsonify({
+            'created': len(rows),
+            'failed': len(items) - len(rows),
+            'results': results
+        }), status_code
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@expenses_bp.route('/import', methods=['POST'])
+@jwt_required()
+def import_expenses():
+    job = None
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        if current_user.role != UserRole.admin:
+            return jsonify({'error': 'Only admins can import expenses'}), 403
+        
+        if request.mimetype != 'text/csv':
+            return jsonify({'error': 'Send the CSV file as the request body with Content-Type: text/csv'}), 415
+        
+        # ?job_id= resumes an earlier import of the same file after its last committed chunk
+        if request.args.get('job_id'):
+            job = ImportJob.query.filter_by(
+                id=request.args.get('job_id', type=int), company_id=current_user.company_id
+            ).first()
+            if not job:
+                return jsonify({'error': 'Import not found'}), 404
+        else:
+            job = create_import_job(current_user.company_id, current_user.id, request.args.get('filename'))
+        
+        # The body is decoded and parsed as it arrives; only one chunk of rows is held at a time
+        run_import(job, io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline=''))
+        
+        return jsonify({'import': serialize_import_job(job)}), 200
+        
+    except InvalidImport as e:
+        db.session.rollback()
+        body = {'error': str(e)}
+        if job is not None:
+            body['import'] = serialize_import_job(job)
+        return jsonify(body), e.status
+    except Exception as e:
+        db.session.rollback()
+        body = {'error': str(e)}
+        if job is not None:
+            body['import'] = serialize_import_job(job)
+        return jsonify(body), 500
+
+@expenses_bp.route('/import/<int:job_id>', methods=['GET'])
+@jwt_required()
+@read_only
+def get_import(job_id):
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        if current_user.role != UserRole.admin:
+            return jsonify({'error': 'Access denied'}), 403
+        
+        job = ImportJob.query.filter_by(id=job_id, company_id=current_user.company_id).first()
+        if not job:
+            return jsonify({'error': 'Import not found'}), 404
+        
+        return jsonify({'import': serialize_import_job(job)}), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @expenses_bp.route('', methods=['GET'])
 @jwt_required()
+@read_only
 def list_expenses():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -346,37 +960,13 @@ def list_expenses():
         # Get query parameters
         status = request.args.get('status')
         user_id = request.args.get('user_id')
-        print(current_user.role)
-        print(current_user.id)
-        # Build base company query
-        # Role-based scoping:
-        # - admin: sees all company expenses
-        # - manager: sees own expenses and those of direct reports
-        # - employee: sees only their own expenses
-        if current_user.role == UserRole.admin:
-            query = Expense.query.filter_by(company_id=current_user.company_id)
-        elif current_user.role == UserRole.manager:
-            # collect subordinate ids recursively (include indirect reports)
-            subordinates = []
-            queue = [current_user.id]
-            while queue:
-                mid = queue.pop(0)
-                children = User.query.filter_by(manager_id=mid).all()
-                for c in children:
-                    if c.id not in subordinates:
-                        subordinates.append(c.id)
-                        queue.append(c.id)
-            allowed_ids = subordinates + [current_user.id]
-            print(allowed_ids)
-            query = Expense.query.filter(Expense.company_id == current_user.company_id, Expense.submitter_id.in_(allowed_ids))
-        else:
-            # employee
-            query = Expense.query.filter_by(company_id=current_user.company_id, submitter_id=current_user.id)
+        # Build base company query with role-based scoping
+        query = scope_expenses(expense_list_query(), current_user)
         
         if status:
             try:
                 status_enum = ExpenseStatus(status)
-                query = query.filter_by(status=status_enum)
+                query = query.filter(Expense.status == status_enum)
             except ValueError:
                 return jsonify({'error': 'Invalid status'}), 400
         
@@ -389,54 +979,293 @@ def list_expenses():
 
             # Admin can query any user in company
             if current_user.role == UserRole.admin:
-                query = query.filter_by(submitter_id=uid)
+                query = query.filter(Expense.submitter_id == uid)
             elif current_user.role == UserRole.manager:
                 # manager may query only themselves or their (direct or indirect) subordinates
-                # build subordinate set
-                subordinates = []
-                queue = [current_user.id]
-                while queue:
-                    mid = queue.pop(0)
-                    children = User.query.filter_by(manager_id=mid).all()
-                    for c in children:
-                        if c.id not in subordinates:
-                            subordinates.append(c.id)
-                            queue.append(c.id)
-
-                if uid != current_user.id and uid not in subordinates:
+                if not is_in_subtree(current_user.id, uid):
                     return jsonify({'error': 'Access denied'}), 403
-                query = query.filter_by(submitter_id=uid)
+                query = query.filter(Expense.submitter_id == uid)
             else:
                 # employee may only query their own
                 if uid != current_user.id:
                     return jsonify({'error': 'Access denied'}), 403
-                query = query.filter_by(submitter_id=uid)
+                query = query.filter(Expense.submitter_id == uid)
+        
+        # Range filters and sort run in the database, each backed by a company-wide composite index
+        try:
+            query = filter_expenses(query)
+            sort_key, descending = parse_expense_sort()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        sort_column = getattr(Expense, sort_key)
+        # Cursors record the order they were issued for
+        order = f"-{sort_key}" if descending else sort_key
+        if descending:
+            query = query.order_by(sort_column.desc(), Expense.id.desc())
+        else:
+            query = query.order_by(sort_column.asc(), Expense.id.asc())
+        
+        # Streamed mode: rows come off a server-side cursor in batches
+        if request.args.get('stream') in ('1', 'true'):
+            return stream_json_list('expenses', query.yield_per(STREAM_BATCH_SIZE), serialize_expense)
+        
+        # Keyset pagination on (sort key, id); without limit/cursor the full list is returned
+        if request.args.get('limit') is None and request.args.get('cursor') is None:
+            # A poll with a matching ETag is answered from one aggregate query, without fetching rows
+            if request.if_none_match:
+                validator, last_modified = collection_validator_query(query, Expense, User.version)
+                response = not_modified(listing_etag(current_user, validator), last_modified)
+                if response:
+                    return response
+            expenses = query.all()
+            validator, last_modified = collection_validator(expenses, 'submitter_version')
+            response = jsonify({'expenses': [serialize_expense(e) for e in expenses]})
+            return with_validators(response, listing_etag(current_user, validator), last_modified), 200
+        
+        try:
+            limit, after = parse_page_args(order)
+            if after is not None:
+                query = query.filter(keyset_after(Expense, sort_key, *after, descending))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        expenses, next_cursor = fetch_page(query, limit, order, sort_key)
+        # Pages are bounded, so they are validated from their own rows
+        validator, last_modified = collection_validator(expenses, 'submitter_version')
+        etag = listing_etag(current_user, validator, next_cursor)
+        response = not_modified(etag, last_modified)
+        if response:
+            return response
+        
+        response = jsonify({
+            'expenses': [serialize_expense(e) for e in expenses],
+            'next_cursor': next_cursor
+        })
+        return with_validators(response, etag, last_modified), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@expenses_bp.route('/summary', methods=['GET'])
+@jwt_required()
+@read_only
+def expense_summary():
+    try:
+        # Company-wide reports check role and token version on the primary every time, not the cache
+        current_user = get_current_user(fresh=True)
         
-        expenses = query.order_by(Expense.created_at.desc()).all()
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        # Rollups are company-wide, so only admins can read them
+        if current_user.role != UserRole.admin:
+            return jsonify({'error': 'Access denied'}), 403
+        
+        # Optional inclusive YYYY-MM period range
+        query = db.session.query(
+            ExpenseRollup.period,
+            ExpenseRollup.status,
+            ExpenseRollup.expense_count,
+            ExpenseRollup.total_amount
+        ).filter(ExpenseRollup.company_id == current_user.company_id)
+        bounds = {}
+        for param in ('from', 'to'):
+            if request.args.get(param):
+                try:
+                    bounds[param] = datetime.strptime(request.args[param], '%Y-%m').strftime('%Y-%m')
+                except ValueError:
+                    return jsonify({'error': f'{param} must be YYYY-MM'}), 400
+        if 'from' in bounds:
+            query = query.filter(ExpenseRollup.period >= bounds['from'])
+        if 'to' in bounds:
+            query = query.filter(ExpenseRollup.period <= bounds['to'])
+        
+        # Reads the pre-aggregated rows only: cost follows the number of months, not of expenses
+        rows = query.order_by(ExpenseRollup.period, ExpenseRollup.status).all()
+        totals = {status.value: {'count': 0, 'total': Decimal(0)} for status in ExpenseStatus}
+        periods = []
+        for row in rows:
+            if not row.expense_count:
+                continue
+            totals[row.status.value]['count'] += row.expense_count
+            totals[row.status.value]['total'] += Decimal(str(row.total_amount))
+            periods.append({
+                'period': row.period,
+                'status': row.status.value,
+                'count': row.expense_count,
+                'total': format_amount(row.total_amount)
+            })
+        currency_code = db.session.query(Company.currency_code).filter(Company.id == current_user.company_id).scalar()
         
         return jsonify({
-            'expenses': [{
-                'id': expense.id,
-                'amount': str(expense.amount),
-                'currency_code': expense.currency_code,
-                'amount_converted': str(expense.amount_converted),
-                'description': expense.description,
-                'status': expense.status.value,
-                'submitter_id': expense.submitter_id,
-                'submitter_name': expense.submitter.full_name,
-                'created_at': expense.created_at.isoformat()
-            } for expense in expenses]
+            'currency_code': currency_code,
+            'statuses': {status: {'count': t['count'], 'total': format_amount(t['total'])} for status, t in totals.items()},
+            'periods': periods
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@expenses_bp.route('/stats', methods=['GET'])
+@jwt_required()
+@read_only
+def expense_stats():
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        # Comma-separated dimensions, e.g. ?group_by=status,month; none gives one overall row
+        group_by = [name.strip() for name in request.args.get('group_by', '').split(',') if name.strip()]
+        unknown = [name for name in group_by if name not in STATS_GROUPS]
+        if unknown:
+            return jsonify({'error': f"group_by must be among {', '.join(STATS_GROUPS)}"}), 400
+        group_by = list(dict.fromkeys(group_by))
+        
+        # Aggregation runs in the database; only one row per group comes back
+        rows = expense_stats_query(current_user, group_by).all()
+        currency_code = db.session.query(Company.currency_code).filter(Company.id == current_user.company_id).scalar()
+        
+        return jsonify({
+            'currency_code': currency_code,
+            'group_by': group_by,
+            'groups': [serialize_expense_stats(row, group_by) for row in rows]
         }), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@expenses_bp.route('/search', methods=['GET'])
+@jwt_required()
+@read_only
+def search_expense_descriptions():
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        terms = search_terms(request.args.get('q'))
+        if not terms:
+            return jsonify({'error': 'q must contain at least one word'}), 400
+        
+        try:
+            limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+        except ValueError:
+            return jsonify({'error': 'invalid limit'}), 400
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            return jsonify({'error': f'limit must be between 1 and {MAX_PAGE_SIZE}'}), 400
+        
+        # Same scoping as GET /expenses, applied inside the full-text query
+        query = scope_expenses(expense_list_query(), current_user)
+        status = request.args.get('status')
+        if status:
+            try:
+                query = query.filter(Expense.status == ExpenseStatus(status))
+            except ValueError:
+                return jsonify({'error': 'Invalid status'}), 400
+        
+        rows = search_expenses(query, terms).limit(limit).all()
+        
+        return jsonify({
+            'terms': terms,
+            'expenses': [dict(serialize_expense(row), rank=round(float(row.rank), 6)) for row in rows]
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@expenses_bp.route('/<int:expense_id>/receipt', methods=['POST'])
+@jwt_required()
+def upload_receipt(expense_id):
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        # Expenses outside the caller's scope look the same as missing ones
+        submitter_id = scope_expenses(
+            db.session.query(Expense.submitter_id).filter(Expense.id == expense_id), current_user
+        ).scalar()
+        if submitter_id is None:
+            return jsonify({'error': 'Expense not found'}), 404
+        
+        if submitter_id != current_user.id and current_user.role != UserRole.admin:
+            return jsonify({'error': 'Only the submitter or an admin can attach a receipt'}), 403
+        
+        # The body is streamed to the store only after the checks above pass
+        receipt = current_app.extensions['receipt_store'].save_upload(
+            request.stream, request.headers.get('Content-Type'), request.content_length
+        )
+        
+        db.session.execute(db.update(Expense).where(Expense.id == expense_id).values(
+            receipt_sha256=receipt['sha256'],
+            receipt_size=receipt['size'],
+            receipt_content_type=receipt['content_type'],
+            receipt_filename=receipt['filename']
+        ))
+        create_audit_log(expense_id, current_user.id, 'receipt_uploaded', {
+            'sha256': receipt['sha256'],
+            'size': receipt['size']
+        })
+        db.session.commit()
+        
+        return jsonify({'message': 'Receipt uploaded successfully', 'receipt': receipt}), 200
+        
+    except InvalidReceipt as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), e.status
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@expenses_bp.route('/<int:expense_id>/receipt', methods=['GET'])
+@jwt_required()
+@read_only
+def download_receipt(expense_id):
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        row = scope_expenses(db.session.query(
+            Expense.receipt_sha256,
+            Expense.receipt_size,
+            Expense.receipt_content_type,
+            Expense.receipt_filename
+        ).filter(Expense.id == expense_id), current_user).one_or_none()
+        if row is None:
+            return jsonify({'error': 'Expense not found'}), 404
+        if row.receipt_sha256 is None:
+            return jsonify({'error': 'No receipt uploaded for this expense'}), 404
+        
+        # send_file hands the open file to the server (sendfile / X-Sendfile) instead of reading it into Python;
+        # the digest is a strong ETag since stored content never changes
+        try:
+            response = send_file(
+                current_app.extensions['receipt_store'].path_for(row.receipt_sha256),
+                mimetype=row.receipt_content_type,
+                download_name=row.receipt_filename or f'receipt-{expense_id}',
+                conditional=True,
+                etag=row.receipt_sha256
+            )
+        except FileNotFoundError:
+            return jsonify({'error': 'Receipt file is missing from storage'}), 404
+        response.cache_control.private = True
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        return response
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @expenses_bp.route('/<int:expense_id>/approve', methods=['POST'])
 @jwt_required()
 def approve_expense(expense_id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -467,24 +1296,14 @@ def approve_expense(expense_id):
             return jsonify({'error': 'Access denied'}), 403
 
         if current_user.role == UserRole.manager:
-            # build subordinate set recursively and check
-            subordinates = []
-            queue = [current_user.id]
-            while queue:
-                mid = queue.pop(0)
-                children = User.query.filter_by(manager_id=mid).all()
-                for c in children:
-                    if c.id not in subordinates:
-                        subordinates.append(c.id)
-                        queue.append(c.id)
-
-            if expense.submitter_id not in subordinates and expense.submitter_id != current_user.id:
+            # submitter must be the manager or someone in their reporting subtree
+            if not is_in_subtree(current_user.id, expense.submitter_id):
                 return jsonify({'error': 'Access denied'}), 403
 
         # Check if there is a pending approval assigned to the current approver
         approval = Approval.query.filter_by(
             expense_id=expense_id,
-            approver_id=current_user_id,
+            approver_id=current_user.id,
             decision=ApprovalDecision.pending
         ).first()
 
@@ -495,7 +1314,6 @@ def approve_expense(expense_id):
         approval.decision = decision
         approval.comments = data.get('comments')
         approval.acted_at = datetime.utcnow()
-        db.session.commit()
         
         # Create audit log
         create_audit_log(expense_id, current_user.id, 'approval_decision', {
@@ -504,7 +1322,10 @@ def approve_expense(expense_id):
         })
         
         # Evaluate policy
-        evaluate_policy(expense_id)
+        evaluate_policy(expense)
+        
+        # Decision, audit entries and resulting status change land in a single commit
+        db.session.commit()
         
         return jsonify({
             'message': f'Expense {decision.value} successfully',
@@ -518,13 +1339,121 @@ def approve_expense(expense_id):
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+@expenses_bp.route('/approve/batch', methods=['POST'])
+@jwt_required()
+def approve_expenses_batch():
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        # Employees cannot approve; checked once for the whole batch
+        if current_user.role == UserRole.employee:
+            return jsonify({'error': 'Access denied'}), 403
+        
+        data = request.get_json() or {}
+        items = data.get('decisions')
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': 'decisions must be a non-empty list'}), 400
+        if len(items) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'at most {MAX_BATCH_SIZE} decisions per batch'}), 400
+        
+        # A malformed id could name the wrong expense, so it rejects the whole batch
+        for index, item in enumerate(items):
+            expense_id = item.get('expense_id') if isinstance(item, dict) else None
+            if not isinstance(expense_id, int) or isinstance(expense_id, bool):
+                return jsonify({'error': f'decisions[{index}].expense_id must be an integer'}), 400
+        
+        # Validate items; results keep request order
+        results = []
+        requested = {}
+        for index, item in enumerate(items):
+            expense_id = item['expense_id']
+            result = {'index': index, 'expense_id': expense_id}
+            results.append(result)
+            try:
+                decision = ApprovalDecision(item.get('decision'))
+            except ValueError:
+                result.update(status='error', error='a valid decision is required')
+                continue
+            if expense_id in requested:
+                result.update(status='error', error='duplicate expense_id in batch')
+                continue
+            requested[expense_id] = (result, decision, item.get('comments'))
+        
+        # One query each for the expenses, the approver's scope and their pending approvals
+        expenses = {}
+        if requested:
+            expenses = {e.id: e for e in Expense.query.filter(
+                Expense.id.in_(list(requested)),
+                Expense.company_id == current_user.company_id
+            )}
+        in_scope = set(expenses)
+        if current_user.role == UserRole.manager and expenses:
+            allowed = subtree_members(current_user.id, {e.submitter_id for e in expenses.values()})
+            in_scope = {expense_id for expense_id, e in expenses.items() if e.submitter_id in allowed}
+        pending = {}
+        if in_scope:
+            pending = {a.expense_id: a.id for a in db.session.query(Approval.id, Approval.expense_id).filter(
+                Approval.expense_id.in_(in_scope),
+                Approval.approver_id == current_user.id,
+                Approval.decision == ApprovalDecision.pending
+            )}
+        
+        acted_at = datetime.utcnow()
+        approval_updates = []
+        audit_rows = []
+        for expense_id, (result, decision, comments) in requested.items():
+            if expense_id not in expenses:
+                result.update(status='error', error='Expense not found')
+            elif expense_id not in in_scope:
+                result.update(status='error', error='Access denied')
+            elif expense_id not in pending:
+                result.update(status='error', error='No pending approval found for this user')
+            else:
+                result.update(status='ok', decision=decision.value)
+                approval_updates.append({'id': pending[expense_id], 'decision': decision, 'comments': comments, 'acted_at': acted_at})
+                audit_rows.append({
+                    'expense_id': expense_id,
+                    'user_id': current_user.id,
+                    'action': 'approval_decision',
+                    'details': {'decision': decision.value, 'comments': comments}
+                })
+        
+        if approval_updates:
+            # Bulk UPDATE by primary key, bulk audit INSERT, then one policy pass over the affected expenses
+            db.session.execute(db.update(Approval), approval_updates)
+            record_audit_logs(audit_rows)
+            evaluate_policies([expenses[row['expense_id']] for row in audit_rows])
+            # Read statuses before commit expires the loaded expenses
+            for expense_id, (result, _, _) in requested.items():
+                if result['status'] == 'ok':
+                    result['expense_status'] = expenses[expense_id].status.value
+            db.session.commit()
+        
+        if not approval_updates:
+            status_code = 400
+        elif len(approval_updates) < len(items):
+            status_code = 207
+        else:
+            status_code = 200
+        return jsonify({
+            'processed': len(approval_updates),
+            'failed': len(items) - len(approval_updates),
+            'results': results
+        }), status_code
+        
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
 # Approval flow routes
 @flows_bp.route('', methods=['POST'])
 @jwt_required()
 def create_flow():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -565,7 +1494,16 @@ def create_flow():
             )
             db.session.add(flow)
         
+        # Reject configs the policy engine cannot compile
+        try:
+            compile_policy(flow)
+        except ValueError as e:
+            db.session.rollback()
+            return jsonify({'error': f'Invalid config: {e}'}), 400
+        
         db.session.commit()
+        # Drop the cached compiled policy so the next evaluation picks up the new flow
+        invalidate_policy(current_user.company_id)
         
         return jsonify({
             'message': 'Approval flow created successfully',
@@ -582,10 +1520,10 @@ def create_flow():
 
 @flows_bp.route('', methods=['GET'])
 @jwt_required()
+@read_only
 def get_flow():
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
@@ -596,16 +1534,23 @@ def get_flow():
         
         flow = ApprovalFlow.query.filter_by(company_id=current_user.company_id).first()
         
+        # (id, version) changes whenever the flow is created or replaced
+        etag = listing_etag(current_user, [flow.id, flow.version] if flow else None)
+        response = not_modified(etag)
+        if response:
+            return response
+        
         if not flow:
-            return jsonify({'flow': None}), 200
+            return with_validators(jsonify({'flow': None}), etag), 200
         
-        return jsonify({
+        response = jsonify({
             'flow': {
                 'id': flow.id,
                 'config': flow.config,
                 'created_at': flow.created_at.isoformat()
             }
-        }), 200
+        })
+        return with_validators(response, etag), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -613,39 +1558,170 @@ def get_flow():
 # Audit routes
 @audit_bp.route('/<int:expense_id>', methods=['GET'])
 @jwt_required()
+@read_only
 def get_audit_logs(expense_id):
     try:
-        current_user_id = get_jwt_identity()
-        current_user = User.query.get(int(current_user_id))
+        current_user = get_current_user()
         
         if not current_user:
             return jsonify({'error': 'User not found'}), 401
         
         # Get expense
-        expense = Expense.query.get(expense_id)
-        if not expense:
+        company_id = db.session.query(Expense.company_id).filter(Expense.id == expense_id).scalar()
+        if company_id is None:
             return jsonify({'error': 'Expense not found'}), 404
         
-        if expense.company_id != current_user.company_id:
+        if company_id != current_user.company_id:
             return jsonify({'error': 'Access denied'}), 403
         
-        # Get audit logs
-        audit_logs = AuditLog.query.filter_by(expense_id=expense_id).order_by(AuditLog.created_at.desc()).all()
+        # Newest first; (created_at, id) keeps the order stable for keyset paging
+        query = audit_log_query().filter(
+            AuditLog.expense_id == expense_id
+        ).order_by(AuditLog.created_at.desc(), AuditLog.id.desc())
+        
+        # Without limit/cursor the full history is returned
+        if request.args.get('limit') is None and request.args.get('cursor') is None:
+            return jsonify({'audit_logs': [serialize_audit_log(log) for log in query.all()]}), 200
+        
+        try:
+            limit, after = parse_page_args('-created_at')
+            if after is not None:
+                query = query.filter(keyset_after(AuditLog, 'created_at', *after))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        audit_logs, next_cursor = fetch_page(query, limit, '-created_at', 'created_at')
         
         return jsonify({
-            'audit_logs': [{
-                'id': log.id,
-                'action': log.action,
-                'details': log.details,
-                'user_id': log.user_id,
-                'user_name': log.user.full_name if log.user else 'System',
-                'created_at': log.created_at.isoformat()
-            } for log in audit_logs]
+            'audit_logs': [serialize_audit_log(log) for log in audit_logs],
+            'next_cursor': next_cursor
         }), 200
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@audit_bp.route('/export', methods=['GET'])
+@jwt_required()
+@read_only
+def export_audit_logs():
+    try:
+        # Company-wide reports check role and token version on the primary every time, not the cache
+        current_user = get_current_user(fresh=True)
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        # Only admins can export the company-wide trail
+        if current_user.role != UserRole.admin:
+            return jsonify({'error': 'Access denied'}), 403
+        
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return jsonify({'error': 'format must be ndjson or csv'}), 400
+        
+        # AuditLog has no company column; scope through the expense
+        query = audit_log_query().join(Expense, AuditLog.expense_id == Expense.id).filter(
+            Expense.company_id == current_user.company_id
+        )
+        
+        # from is inclusive, to is exclusive; both accept an ISO date or datetime
+        bounds = {}
+        for param in ('from', 'to'):
+            if request.args.get(param):
+                try:
+                    bounds[param] = datetime.fromisoformat(request.args[param])
+                except ValueError:
+                    return jsonify({'error': f'invalid {param} date'}), 400
+        if 'from' in bounds:
+            query = query.filter(AuditLog.created_at >= bounds['from'])
+        if 'to' in bounds:
+            query = query.filter(AuditLog.created_at < bounds['to'])
+        
+        actions = request.args.getlist('action')
+        if actions:
+            query = query.filter(AuditLog.action.in_(actions))
+        
+        # Oldest first off a server-side cursor, STREAM_BATCH_SIZE rows at a time
+        query = query.order_by(AuditLog.created_at, AuditLog.id)
+        return stream_audit_export(query.yield_per(STREAM_BATCH_SIZE), export_format)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+# Approver inbox routes
+@approvals_bp.route('/pending', methods=['GET'])
+@jwt_required()
+@read_only
+def list_pending_approvals():
+    try:
+        current_user = get_current_user()
+        
+        if not current_user:
+            return jsonify({'error': 'User not found'}), 401
+        
+        try:
+            limit, after = parse_page_args('created_at', default_limit=50)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Oldest assignment first; served by ix_approvals_approver_decision_created
+        query = db.session.query(
+            Approval.id.label('approval_id'),
+            Approval.created_at.label('assigned_at'),
+            Expense.id.label('expense_id'),
+            Expense.amount,
+            Expense.currency_code,
+            Expense.amount_converted,
+            Expense.description,
+            Expense.status,
+            Expense.created_at,
+            Expense.submitter_id,
+            User.full_name.label('submitter_name')
+        ).join(Expense, Approval.expense_id == Expense.id).join(
+            User, Expense.submitter_id == User.id
+        ).filter(
+            Approval.approver_id == current_user.id,
+            Approval.decision == ApprovalDecision.pending,
+            Expense.company_id == current_user.company_id
+        ).order_by(Approval.created_at, Approval.id)
+        if after is not None:
+            try:
+                query = query.filter(keyset_after(Approval, 'created_at', *after, descending=False))
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
+        rows, next_cursor = fetch_page(query, limit, 'created_at', 'assigned_at', id_key='approval_id')
+        
+        return jsonify({
+            'approvals': [{
+                'approval_id': row.approval_id,
+                'assigned_at': row.assigned_at.isoformat(),
+                'expense': {
+                    'id': row.expense_id,
+                    'amount': str(row.amount),
+                    'currency_code': row.currency_code,
+                    'amount_converted': str(row.amount_converted),
+                    'description': row.description,
+                    'status': row.status.value,
+                    'submitter_id': row.submitter_id,
+                    'submitter_name': row.submitter_name,
+                    'created_at': row.created_at.isoformat()
+                }
+            } for row in rows],
+            'next_cursor': next_cursor
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def password_hasher_busy(e):
+    """Hashing pool is saturated (signup, login, user create/update); shed load instead of queueing behind it.
+
+    Routes re-raise PasswordHasherBusy past their catch-all 500 so it ends up here.
+    """
+    db.session.rollback()
+    return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+
 # Register blueprints
 def register_blueprints(app):
     app.register_blueprint(auth_bp)
@@ -653,4 +1729,6 @@ def register_blueprints(app):
     app.register_blueprint(expenses_bp)
     app.register_blueprint(flows_bp)
     app.register_blueprint(audit_bp)
+    app.register_blueprint(approvals_bp)
+    app.register_error_handler(PasswordHasherBusy, password_hasher_busy)
 
@@ -0,0 +1,78 @@
+import re
+from sqlalchemy import DDL, event
+from models import db, Expense
+
+# Text search configuration for the Postgres index; 'english' stems words, so "taxis" finds "taxi"
+SEARCH_TS_CONFIG = 'english'
+# Terms beyond this are ignored; long queries only get slower without getting more precise
+MAX_SEARCH_TERMS = 8
+
+FTS_TABLE = 'expenses_fts'
+TSV_COLUMN = 'description_tsv'
+TSV_INDEX = 'ix_expenses_description_tsv'
+
+# SQLite: an external-content FTS5 table over expenses.description, kept in step by triggers
+SQLITE_SEARCH_DDL = (
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"description, content='expenses', content_rowid='id', tokenize='porter unicode61')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON expenses BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON expenses BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF description ON expenses BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, description) VALUES ('delete', old.id, old.description); "
+    f"INSERT INTO {FTS_TABLE}(rowid, description) VALUES (new.id, new.description); END",
+)
+
+# Postgres: a stored generated tsvector column, maintained by the database on every write, with a GIN index
+POSTGRES_SEARCH_DDL = (
+    f"ALTER TABLE expenses ADD COLUMN IF NOT EXISTS {TSV_COLUMN} tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_TS_CONFIG}', coalesce(description, ''))) STORED",
+    f"CREATE INDEX IF NOT EXISTS {TSV_INDEX} ON expenses USING gin ({TSV_COLUMN})",
+)
+
+# The search structures live outside the models, so db.create_all/drop_all add and remove them here;
+# migrations create them with the same statements
+for statement in SQLITE_SEARCH_DDL:
+    event.listen(Expense.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in POSTGRES_SEARCH_DDL:
+    event.listen(Expense.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+event.listen(Expense.__table__, 'after_drop', DDL(f"DROP TABLE IF EXISTS {FTS_TABLE}").execute_if(dialect='sqlite'))
+
+def include_schema_object(object, name, type_, reflected, compare_to):
+    """Alembic include_object hook: leave the search index out of autogenerate and check-schema"""
+    if type_ == 'table' and reflected and name.startswith(FTS_TABLE):
+        return False
+    if reflected and compare_to is None and name in (TSV_COLUMN, TSV_INDEX):
+        return False
+    return True
+
+def search_terms(text):
+    """Lower-cased word tokens of a search string, at most MAX_SEARCH_TERMS of them"""
+    return re.findall(r'\w+', (text or '').lower())[:MAX_SEARCH_TERMS]
+
+def search_expenses(query, terms):
+    """Restrict an expense query to rows whose description matches every term, best match first.
+
+    The last term matches as a prefix, so results follow the user while
+    they type. Terms are plain word tokens (see search_terms), which keeps
+    user input out of the FTS query syntax. Adds a `rank` column where
+    higher is better.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        tsquery = db.func.to_tsquery(
+            db.literal_column(f"'{SEARCH_TS_CONFIG}'"),
+            ' & '.join(terms[:-1] + [terms[-1] + ':*'])
+        )
+        tsv = db.literal_column(f'expenses.{TSV_COLUMN}')
+        rank = db.func.ts_rank_cd(tsv, tsquery)
+        return query.add_columns(rank.label('rank')).filter(tsv.op('@@')(tsquery)).order_by(rank.desc(), Expense.id.desc())
+    if dialect == 'sqlite':
+        fts = db.table(FTS_TABLE, db.column('rowid'), db.column('rank'))
+        match = ' '.join([f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*'])
+        # FTS5 rank is bm25, where lower is better
+        return query.add_columns((-fts.c.rank).label('rank')).join(fts, fts.c.rowid == Expense.id).filter(
+            db.literal_column(FTS_TABLE).op('MATCH')(match)
+        ).order_by(fts.c.rank, Expense.id.desc())
+    raise NotImplementedError(f'Full-text search is not supported on {dialect}')
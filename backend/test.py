@@ -1,17 +1,31 @@
+import os
+import json
 import pytest
-from app import app, db
-from models import Company, User, Expense, ApprovalFlow, Approval
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+
+from app import create_app
+from models import db, Company, User, Expense, ApprovalFlow, Approval
+
+# Audit entries go in the request transaction so tests can read them back immediately
+app = create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:", "AUDIT_LOG_MODE": "sync"})
 
 @pytest.fixture
 def client():
-    app.config["TESTING"] = True
-    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
     with app.test_client() as client:
         with app.app_context():
             db.create_all()
         yield client
         with app.app_context():
             db.drop_all()
+    # Company ids restart with every in-memory database
+    from utils import _policy_cache
+    from currency import _rate_cache
+    from identity import _identity_cache
+    _policy_cache.clear()
+    _rate_cache.clear()
+    _identity_cache.clear()
 
 def signup_and_login(client):
     """Helper to create company + admin and return token"""
@@ -105,3 +119,987 @@ def test_approval_flow(client):
         "decision": "approved"
     }, headers={"Authorization": f"Bearer {mgr_token}"})
     assert res.status_code == 200
+
+def create_admin(client, email="owner@test.com"):
+    """Sign up a company and return the admin's auth header"""
+    res = client.post("/auth/signup", json={
+        "email": email,
+        "password": "secret",
+        "full_name": "Owner",
+        "company_name": "TestCo",
+        "country_code": "US"
+    })
+    assert res.status_code == 201
+    return {"Authorization": f"Bearer {res.get_json()['access_token']}"}
+
+def create_member(client, admin_headers, email, role, manager_id=None):
+    """Create a user as admin and return (id, auth header)"""
+    res = client.post("/users", json={
+        "email": email, "password": "secret", "full_name": email.split("@")[0],
+        "role": role, "manager_id": manager_id
+    }, headers=admin_headers)
+    assert res.status_code == 201
+    login = client.post("/auth/login", json={"email": email, "password": "secret"})
+    return res.get_json()["user"]["id"], {"Authorization": f"Bearer {login.get_json()['access_token']}"}
+
+def test_manager_scope_follows_hierarchy(client):
+    admin = create_admin(client)
+    top_id, top = create_member(client, admin, "top@test.com", "manager")
+    mid_id, mid = create_member(client, admin, "mid@test.com", "manager", top_id)
+    emp_id, emp = create_member(client, admin, "emp@test.com", "employee", mid_id)
+
+    client.post("/expenses", json={"amount": 10, "currency_code": "USD", "description": "Lunch"}, headers=emp)
+    assert len(client.get("/expenses", headers=top).get_json()["expenses"]) == 1
+    assert client.get(f"/expenses?user_id={emp_id}", headers=mid).status_code == 200
+
+    # Moving the employee directly under the top manager takes them out of mid's subtree
+    res = client.patch(f"/users/{emp_id}", json={"manager_id": top_id}, headers=admin)
+    assert res.status_code == 200
+    assert client.get(f"/expenses?user_id={emp_id}", headers=mid).status_code == 403
+    assert len(client.get("/expenses", headers=top).get_json()["expenses"]) == 1
+
+    # A manager cannot be moved underneath their own report
+    res = client.patch(f"/users/{top_id}", json={"manager_id": mid_id}, headers=admin)
+    assert res.status_code == 400
+
+    # manager_id must be a user id, not something int() might coerce
+    for bad in ("abc", [], {}, True, 1.5, str(top_id)):
+        res = client.patch(f"/users/{emp_id}", json={"manager_id": bad}, headers=admin)
+        assert res.status_code == 400 and res.get_json()["error"] == "manager_id must be an integer"
+        res = client.post("/users", json={"email": "new@test.com", "password": "secret", "full_name": "New",
+                                          "role": "employee", "manager_id": bad}, headers=admin)
+        assert res.status_code == 400 and res.get_json()["error"] == "manager_id must be an integer"
+
+    # Deleting the middle manager leaves the top manager's remaining subtree intact
+    assert client.delete(f"/users/{mid_id}", headers=admin).status_code == 200
+    assert client.get(f"/expenses?user_id={emp_id}", headers=top).status_code == 200
+
+def test_list_expenses_keyset_pagination_and_stream(client):
+    admin = create_admin(client)
+    for i in range(5):
+        client.post("/expenses", json={"amount": i + 1, "currency_code": "USD", "description": f"e{i}"}, headers=admin)
+
+    seen, cursor = [], None
+    while True:
+        url = "/expenses?limit=2" + (f"&cursor={cursor}" if cursor else "")
+        body = client.get(url, headers=admin).get_json()
+        seen += [e["id"] for e in body["expenses"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    assert seen == sorted(seen, reverse=True) and len(seen) == 5
+
+    streamed = client.get("/expenses?stream=1", headers=admin).get_json()
+    assert [e["id"] for e in streamed["expenses"]] == seen
+    assert client.get("/expenses?cursor=garbage", headers=admin).status_code == 400
+
+    # The cursor carries its own sort value, so deleting the row a page ended on does not end the listing
+    first = client.get("/expenses?limit=2", headers=admin).get_json()
+    with app.app_context():
+        db.session.execute(db.delete(Expense).where(Expense.id == first["expenses"][-1]["id"]))
+        db.session.commit()
+    rest = client.get(f"/expenses?limit=10&cursor={first['next_cursor']}", headers=admin).get_json()
+    assert [e["id"] for e in rest["expenses"]] == seen[2:]
+    # A cursor only continues the order it was issued for
+    res = client.get(f"/expenses?limit=2&sort=amount_converted&cursor={first['next_cursor']}", headers=admin)
+    assert res.status_code == 400 and "sort=-created_at" in res.get_json()["error"]
+
+@contextmanager
+def count_queries():
+    """Collect every SQL statement sent to the database inside the block"""
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+def test_list_endpoints_run_constant_queries(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "boss@test.com", "manager")
+    for n in range(3):
+        _, emp = create_member(client, admin, f"emp{n}@test.com", "employee", manager_id)
+        res = client.post("/expenses", json={"amount": 5, "currency_code": "USD", "description": "Cab"}, headers=emp)
+        expense_id = res.get_json()["expense"]["id"]
+
+    # With the caller's identity cached in the worker: one projected statement, however many rows come back
+    client.get("/expenses", headers=manager)
+    with count_queries() as statements:
+        assert len(client.get("/expenses", headers=admin).get_json()["expenses"]) == 3
+    assert len(statements) == 1
+    with count_queries() as statements:
+        assert len(client.get("/expenses", headers=manager).get_json()["expenses"]) == 3
+    assert len(statements) == 1
+    with count_queries() as statements:
+        assert len(client.get("/users", headers=admin).get_json()["users"]) == 5
+    assert len(statements) == 1
+    with count_queries() as statements:
+        assert client.get(f"/audit/{expense_id}", headers=admin).status_code == 200
+    assert len(statements) == 2
+
+def test_migrations_build_the_schema_with_hot_path_indexes(client):
+    from flask_migrate import upgrade, downgrade, stamp
+    with app.app_context():
+        db.drop_all()
+        upgrade()
+        inspector = db.inspect(db.engine)
+        assert "ix_expenses_company_submitter_status_created" in {i["name"] for i in inspector.get_indexes("expenses")}
+        assert "ix_users_manager_id" in {i["name"] for i in inspector.get_indexes("users")}
+        result = app.test_cli_runner().invoke(args=["check-schema"])
+        assert result.exit_code == 0, result.output
+        downgrade(revision="base")
+        assert "expenses" not in db.inspect(db.engine).get_table_names()
+        db.session.execute(db.text("DROP TABLE alembic_version"))
+        db.create_all()
+        # Tables made by create_all are not stamped, so the schema check refuses them
+        result = app.test_cli_runner().invoke(args=["check-schema"])
+        assert result.exit_code == 1
+        assert "run `flask db upgrade`" in result.output
+
+        # A database from before migrations (the 0001 schema, unstamped, with users) is stamped and upgraded in place
+        db.drop_all()
+        upgrade(revision="0001")
+        db.session.execute(db.text("DROP TABLE alembic_version"))
+        db.session.execute(db.text("INSERT INTO companies (id, name, currency_code) VALUES (1, 'Old', 'USD')"))
+        for user_id, manager_id in ((1, None), (2, 1), (3, 2)):
+            db.session.execute(db.text(
+                "INSERT INTO users (id, company_id, email, password_hash, full_name, role, manager_id) "
+                "VALUES (:id, 1, :email, 'x', 'Old', 'employee', :manager_id)"
+            ), {"id": user_id, "email": f"old{user_id}@test.com", "manager_id": manager_id})
+        db.session.commit()
+        stamp(revision="0001")
+        upgrade()
+        result = app.test_cli_runner().invoke(args=["check-schema"])
+        assert result.exit_code == 0, result.output
+        assert set(db.session.execute(db.text("SELECT ancestor_id, descendant_id, depth FROM user_hierarchy")).all()) == {
+            (1, 1, 0), (2, 2, 0), (3, 3, 0), (1, 2, 1), (2, 3, 1), (1, 3, 2)
+        }
+        downgrade(revision="base")
+        db.session.execute(db.text("DROP TABLE alembic_version"))
+        db.create_all()
+
+def test_wsgi_entry_point_starts_within_budget():
+    import subprocess
+    import sys
+    budget = float(os.getenv("STARTUP_BUDGET_SECONDS", "2.0"))
+    # A fresh interpreter, as a gunicorn master would start; serving must not pull in the migration tooling
+    script = (
+        "import sys, time\n"
+        "started = time.perf_counter()\n"
+        "import wsgi\n"
+        "print(time.perf_counter() - started)\n"
+        "print(sorted(m for m in ('alembic', 'flask_migrate', 'requests') if m in sys.modules))\n"
+    )
+    env = dict(os.environ, DATABASE_URL="sqlite:///:memory:")
+    result = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env=env, capture_output=True, text=True, check=True)
+    elapsed, loaded = result.stdout.strip().splitlines()[-2:]
+    assert float(elapsed) < budget
+    assert loaded == "[]"
+
+def test_hot_path_queries_use_indexes(client):
+    from query_plans import check_query_plans, explain, hot_path_queries
+    from models import Expense
+    with app.app_context():
+        assert check_query_plans() == {}
+        # One person's expenses come off their own index, not a walk over the company's
+        plan = explain(hot_path_queries()["list_expenses (employee)"])
+        assert any("ix_expenses_company_submitter_created" in line for line in plan)
+        # Sanity check the detector itself: an unindexed filter is reported
+        plan = explain(db.session.query(Expense.id).filter(Expense.description == "x"))
+        assert any(line.startswith("SCAN expenses") for line in plan)
+
+@contextmanager
+def count_commits():
+    """Count database transactions committed inside the block"""
+    commits = []
+    with app.app_context():
+        engine = db.engine
+    listener = lambda conn: commits.append(conn)
+    event.listen(engine, "commit", listener)
+    try:
+        yield commits
+    finally:
+        event.remove(engine, "commit", listener)
+
+def test_expense_submission_and_approval_commit_once(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "approver@test.com", "manager")
+    _, emp = create_member(client, admin, "worker@test.com", "employee", manager_id)
+    res = client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id], "rules": {}}}, headers=admin)
+    assert res.status_code == 201
+
+    with count_commits() as commits:
+        res = client.post("/expenses", json={"amount": 20, "currency_code": "USD", "description": "Train"}, headers=emp)
+    assert res.status_code == 201 and len(commits) == 1
+    expense_id = res.get_json()["expense"]["id"]
+
+    with count_commits() as commits:
+        res = client.post(f"/expenses/{expense_id}/approve", json={"decision": "approved"}, headers=manager)
+    assert res.status_code == 200 and len(commits) == 1
+    assert res.get_json()["expense"]["status"] == "approved"
+
+    actions = [log["action"] for log in client.get(f"/audit/{expense_id}", headers=admin).get_json()["audit_logs"]]
+    assert sorted(actions) == ["approval_assigned", "approval_decision", "expense_approved", "expense_created"]
+
+def test_policy_cache_is_invalidated_when_flow_changes(client):
+    from utils import get_policy
+    admin = create_admin(client)
+    second_id, second = create_member(client, admin, "second@test.com", "manager")
+    first_id, first = create_member(client, admin, "first@test.com", "manager", second_id)
+    _, emp = create_member(client, admin, "staff@test.com", "employee", first_id)
+
+    client.post("/flows", json={"user_id": first_id, "config": {"sequence": [first_id, second_id], "rules": {}}}, headers=admin)
+    expense_id = client.post("/expenses", json={"amount": 9, "currency_code": "USD", "description": "Pens"}, headers=emp).get_json()["expense"]["id"]
+    res = client.post(f"/expenses/{expense_id}/approve", json={"decision": "approved"}, headers=first)
+    assert res.get_json()["expense"]["status"] == "pending"
+
+    # Switch to a specific-approver rule; the second approval now settles the expense
+    client.post("/flows", json={"user_id": first_id, "config": {"sequence": [first_id, second_id], "rules": {"specific": second_id}}}, headers=admin)
+    with app.app_context():
+        assert get_policy(1).specific_id == second_id
+    res = client.post(f"/expenses/{expense_id}/approve", json={"decision": "approved"}, headers=second)
+    assert res.get_json()["expense"]["status"] == "approved"
+
+    res = client.post("/flows", json={"user_id": first_id, "config": {"sequence": "nope"}}, headers=admin)
+    assert res.status_code == 400
+
+def test_batch_submission_reports_partial_failures(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "lead@test.com", "manager")
+    _, emp = create_member(client, admin, "card@test.com", "employee", manager_id)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id]}}, headers=admin)
+
+    items = [{"amount": n + 1, "currency_code": "USD", "description": f"Card txn {n}"} for n in range(50)]
+    items[3] = {"amount": "abc", "currency_code": "USD", "description": "Bad"}
+    items[7] = {"currency_code": "USD", "description": "Missing amount"}
+    # Values the columns cannot hold fail their own item, not the INSERT for the whole batch
+    items[10] = {"amount": 5, "currency_code": 7, "description": "Numeric currency"}
+    items[11] = {"amount": 5, "currency_code": "USDX", "description": "Long currency"}
+    items[12] = {"amount": 5, "currency_code": "USD", "description": {"x": 1}}
+    items[13] = {"amount": 1e15, "currency_code": "USD", "description": "Too large"}
+    with count_commits() as commits:
+        res = client.post("/expenses/batch", json={"expenses": items}, headers=emp)
+    assert res.status_code == 207 and len(commits) == 1
+    body = res.get_json()
+    assert body["created"] == 44 and body["failed"] == 6
+    assert body["results"][3] == {"index": 3, "status": "error", "error": "amount must be a number"}
+    assert body["results"][7]["error"] == "amount is required"
+    assert [body["results"][n]["error"] for n in (10, 11, 12, 13)] == [
+        "currency_code must be a 3-letter code",
+        "currency_code must be a 3-letter code",
+        "description must be a string",
+        "amount must be at most 9999999999.99",
+    ]
+
+    # Every created expense is waiting on the first approver
+    expense_id = body["results"][0]["expense_id"]
+    res = client.post(f"/expenses/{expense_id}/approve", json={"decision": "approved"}, headers=manager)
+    assert res.get_json()["expense"]["status"] == "approved"
+
+def test_batch_approval_checks_scope_once_per_request(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "queue@test.com", "manager")
+    other_id, other = create_member(client, admin, "peer@test.com", "manager")
+    _, emp = create_member(client, admin, "team@test.com", "employee", manager_id)
+    _, outsider = create_member(client, admin, "else@test.com", "employee", other_id)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id]}}, headers=admin)
+
+    mine = client.post("/expenses/batch", json={"expenses": [
+        {"amount": n + 1, "currency_code": "USD", "description": f"Item {n}"} for n in range(20)
+    ]}, headers=emp).get_json()["results"]
+    foreign = client.post("/expenses", json={"amount": 3, "currency_code": "USD", "description": "Other team"}, headers=outsider).get_json()["expense"]["id"]
+
+    decisions = [{"expense_id": r["expense_id"], "decision": "approved"} for r in mine]
+    decisions[0]["decision"] = "rejected"
+    decisions.append({"expense_id": foreign, "decision": "approved"})
+    decisions.append({"expense_id": 99999, "decision": "approved"})
+    with count_queries() as statements:
+        res = client.post("/expenses/approve/batch", json={"decisions": decisions}, headers=manager)
+    assert res.status_code == 207
+    body = res.get_json()
+    assert body["processed"] == 20 and body["failed"] == 2
+    assert body["results"][0]["expense_status"] == "rejected"
+    assert body["results"][1]["expense_status"] == "approved"
+    assert body["results"][20]["error"] == "Access denied"
+    assert body["results"][21]["error"] == "Expense not found"
+    # Statement count does not grow with the number of decisions
+    assert len(statements) <= 10
+
+    # An expense_id that is not a JSON integer rejects the whole batch before anything is applied
+    pending = [{"expense_id": foreign, "decision": "approved"}]
+    for bad in ([{"decision": "approved"}], [{"expense_id": 1.5, "decision": "approved"}],
+                [{"expense_id": True, "decision": "approved"}], [{"expense_id": "abc", "decision": "approved"}], ["x"]):
+        res = client.post("/expenses/approve/batch", json={"decisions": pending + bad}, headers=other)
+        assert res.status_code == 400 and res.get_json()["error"] == "decisions[1].expense_id must be an integer"
+    assert [e["status"] for e in client.get("/expenses", headers=outsider).get_json()["expenses"]] == ["pending"]
+
+def test_pending_approvals_inbox_is_paginated(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "inbox@test.com", "manager")
+    _, emp = create_member(client, admin, "filer@test.com", "employee", manager_id)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id]}}, headers=admin)
+    client.post("/expenses/batch", json={"expenses": [
+        {"amount": n + 1, "currency_code": "USD", "description": f"Receipt {n}"} for n in range(5)
+    ]}, headers=emp)
+
+    first = client.get("/approvals/pending?limit=3", headers=manager).get_json()
+    assert [a["expense"]["description"] for a in first["approvals"]] == ["Receipt 0", "Receipt 1", "Receipt 2"]
+    assert first["approvals"][0]["expense"]["submitter_name"] == "filer"
+    second = client.get(f"/approvals/pending?limit=3&cursor={first['next_cursor']}", headers=manager).get_json()
+    assert len(second["approvals"]) == 2 and second["next_cursor"] is None
+
+    expense_id = first["approvals"][0]["expense"]["id"]
+    client.post(f"/expenses/{expense_id}/approve", json={"decision": "approved"}, headers=manager)
+    assert len(client.get("/approvals/pending", headers=manager).get_json()["approvals"]) == 4
+    assert client.get("/approvals/pending", headers=emp).get_json()["approvals"] == []
+
+def test_currency_conversion_uses_loaded_rates(client, tmp_path):
+    from currency import load_exchange_rates, convert_amounts
+    from decimal import Decimal
+    rates = tmp_path / "rates.csv"
+    rates.write_text(
+        "base_currency,quote_currency,rate,effective_date\n"
+        "EUR,USD,1.10000000,2020-01-01\n"
+        "EUR,USD,1.08500000,2024-01-01\n"
+        "USD,INR,83.25000000,2024-01-01\n"
+    )
+    with app.app_context():
+        assert load_exchange_rates(str(rates)) == 3
+        # Latest effective rate, inverse and pivot (EUR -> USD -> INR) lookups
+        assert convert_amounts(["100.00", "108.50", "10", "5"], ["EUR", "USD", "EUR", "GBP"], "USD") == [
+            Decimal("108.50"), Decimal("108.50"), Decimal("10.85"), None
+        ]
+        assert convert_amounts(["100"], ["EUR"], "INR") == [Decimal("9032.63")]
+
+    admin = create_admin(client)
+    res = client.post("/expenses", json={"amount": "19.99", "currency_code": "EUR", "description": "Hotel"}, headers=admin)
+    assert res.get_json()["expense"]["amount_converted"] == "21.69"
+    res = client.post("/expenses", json={"amount": 5, "currency_code": "GBP", "description": "Tea"}, headers=admin)
+    assert res.status_code == 400
+
+    # A non-string country is an unknown country, not a server error
+    res = client.post("/auth/signup", json={"email": "jp@test.com", "password": "secret", "full_name": "JP",
+                                           "company_name": "NumCo", "country_code": 392})
+    assert res.status_code == 400 and res.get_json()["error"] == "Unknown country_code"
+
+def test_country_currency_refresh_against_local_server(tmp_path):
+    import json
+    import threading
+    import time
+    import requests
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from currency import refresh_country_currencies, get_currency_from_country, load_country_currencies
+
+    class StandIn(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/slow/"):
+                time.sleep(1)
+            body = json.dumps([
+                {"cca2": "IN", "currencies": {"INR": {"name": "Indian rupee"}}},
+                {"cca2": "DE", "currencies": {"EUR": {"name": "Euro"}}},
+            ]).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    table = tmp_path / "countries.json"
+    table.write_text('{"US": "USD"}')
+    try:
+        assert refresh_country_currencies(api_url=base, path=str(table)) == 2
+        assert get_currency_from_country("in") == "INR"
+        assert get_currency_from_country("US") is None
+
+        # A stalled upstream fails fast and leaves the table alone
+        with pytest.raises(requests.Timeout):
+            refresh_country_currencies(api_url=f"{base}/slow", timeout=0.2, path=str(table))
+        assert json.loads(table.read_text()) == {"DE": "EUR", "IN": "INR"}
+    finally:
+        server.shutdown()
+        load_country_currencies()
+    assert get_currency_from_country("JP") == "JPY"
+    assert get_currency_from_country(392) is None
+
+def test_async_audit_writer_flushes_after_commit_and_spools_overflow(client, monkeypatch, tmp_path):
+    from audit import AuditWriter, record_audit_logs
+    writer = AuditWriter(app, str(tmp_path / "audit_spool.jsonl"), queue_size=2, flush_size=10)
+    # Drive the writer by hand instead of from its background thread
+    monkeypatch.setattr(writer, "_ensure_started", lambda: None)
+    monkeypatch.setitem(app.extensions, "audit_writer", writer)
+    monkeypatch.setitem(app.config, "AUDIT_LOG_MODE", "async")
+    admin = create_admin(client)
+
+    with count_commits() as commits:
+        ids = [
+            client.post("/expenses", json={"amount": n + 1, "currency_code": "USD", "description": f"Taxi {n}"}, headers=admin).get_json()["expense"]["id"]
+            for n in range(3)
+        ]
+    assert len(commits) == 3
+    # Nothing is written until the writer flushes; the third entry overflowed the queue into the spool
+    assert client.get(f"/audit/{ids[0]}", headers=admin).get_json()["audit_logs"] == []
+    assert len((tmp_path / "audit_spool.jsonl").read_text().splitlines()) == 1
+
+    assert writer.flush() == 3
+    assert not (tmp_path / "audit_spool.jsonl").exists()
+    for expense_id in ids:
+        logs = client.get(f"/audit/{expense_id}", headers=admin).get_json()["audit_logs"]
+        assert [log["action"] for log in logs] == ["expense_created"]
+
+    # Entries from a rolled-back transaction never reach the writer
+    with app.app_context():
+        record_audit_logs([{"expense_id": ids[0], "user_id": None, "action": "discarded"}])
+        db.session.rollback()
+    assert writer.flush() == 0
+
+def test_audit_history_pages_and_company_export_streams(client):
+    import csv
+    admin = create_admin(client)
+    _, emp = create_member(client, admin, "clerk@test.com", "employee")
+    expense_id = client.post("/expenses", json={"amount": 7, "currency_code": "USD", "description": "Stamps"}, headers=emp).get_json()["expense"]["id"]
+    for n in range(4):
+        client.post("/expenses", json={"amount": n + 1, "currency_code": "USD", "description": f"Fuel {n}"}, headers=admin)
+    with app.app_context():
+        from utils import create_audit_log
+        for n in range(4):
+            create_audit_log(expense_id, None, "note", {"n": n})
+        db.session.commit()
+
+    seen, cursor = [], None
+    while True:
+        res = client.get(f"/audit/{expense_id}", query_string={"limit": 2, **({"cursor": cursor} if cursor else {})}, headers=admin)
+        assert res.status_code == 200
+        body = res.get_json()
+        seen += [log["id"] for log in body["audit_logs"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    full = [log["id"] for log in client.get(f"/audit/{expense_id}", headers=admin).get_json()["audit_logs"]]
+    assert seen == full and len(full) == 5
+
+    assert client.get("/audit/export", headers=emp).status_code == 403
+    assert client.get("/audit/export", query_string={"format": "xml"}, headers=admin).status_code == 400
+    res = client.get("/audit/export", headers=admin)
+    assert res.mimetype == "application/x-ndjson" and res.is_streamed
+    lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+    assert len(lines) == 9 and [line["id"] for line in lines] == sorted(line["id"] for line in lines)
+
+    res = client.get("/audit/export", query_string={"format": "csv", "action": "expense_created", "from": "2000-01-01"}, headers=admin)
+    rows = list(csv.DictReader(res.get_data(as_text=True).splitlines()))
+    assert len(rows) == 5 and {row["action"] for row in rows} == {"expense_created"}
+    assert client.get("/audit/export", query_string={"to": "2000-01-01"}, headers=admin).get_data() == b""
+
+def test_expense_stats_group_in_sql_and_follow_scoping(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "lead@test.com", "manager")
+    _, emp = create_member(client, admin, "analyst@test.com", "employee", manager_id)
+    amounts = [3, 14, 15, 92, 65, 35, 89, 79, 32, 38]
+    for amount in amounts:
+        client.post("/expenses", json={"amount": amount, "currency_code": "USD", "description": "Supplies"}, headers=emp)
+    client.post("/expenses", json={"amount": 1000, "currency_code": "USD", "description": "Laptop"}, headers=admin)
+
+    res = client.get("/expenses/stats", query_string={"group_by": "submitter,status"}, headers=admin)
+    assert res.status_code == 200
+    groups = {g["submitter_name"]: g for g in res.get_json()["groups"]}
+    emp_stats = groups["analyst"]
+    ordered = sorted(amounts)
+    assert emp_stats["status"] == "pending" and emp_stats["count"] == 10
+    assert emp_stats["total"] == "462.00" and emp_stats["average"] == "46.20"
+    # Nearest-rank percentiles: the ceil(p * n)-th smallest amount
+    assert (emp_stats["p50"], emp_stats["p90"], emp_stats["p95"]) == (f"{ordered[4]}.00", f"{ordered[8]}.00", f"{ordered[9]}.00")
+    assert groups["Owner"]["count"] == 1
+
+    # A manager only aggregates their subtree; the admin's expense is excluded
+    with count_queries() as statements:
+        res = client.get("/expenses/stats", query_string={"group_by": "month"}, headers=manager)
+    body = res.get_json()
+    assert len(body["groups"]) == 1 and body["groups"][0]["count"] == 10 and body["currency_code"] == "USD"
+    assert len(statements) <= 3
+    assert client.get("/expenses/stats", headers=emp).get_json()["groups"][0]["max"] == "92.00"
+    assert client.get("/expenses/stats", query_string={"group_by": "country"}, headers=admin).status_code == 400
+
+def test_expense_rollups_track_creates_and_status_changes(client):
+    from utils import rebuild_rollups
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "boss@test.com", "manager")
+    _, emp = create_member(client, admin, "rep@test.com", "employee", manager_id)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id], "rules": {}}}, headers=admin)
+
+    first = client.post("/expenses", json={"amount": "12.50", "currency_code": "USD", "description": "Parking"}, headers=emp).get_json()["expense"]["id"]
+    client.post("/expenses/batch", json={"expenses": [
+        {"amount": n + 1, "currency_code": "USD", "description": f"Toll {n}"} for n in range(3)
+    ]}, headers=emp)
+    client.post(f"/expenses/{first}/approve", json={"decision": "approved"}, headers=manager)
+
+    with count_queries() as statements:
+        res = client.get("/expenses/summary", headers=admin)
+    assert res.status_code == 200 and len(statements) <= 3
+    body = res.get_json()
+    assert body["statuses"]["pending"] == {"count": 3, "total": "6.00"}
+    assert body["statuses"]["approved"] == {"count": 1, "total": "12.50"}
+    assert {p["period"] for p in body["periods"]} == {datetime.utcnow().strftime("%Y-%m")}
+    assert client.get("/expenses/summary", headers=manager).status_code == 403
+    assert client.get("/expenses/summary", query_string={"from": "2000-13"}, headers=admin).status_code == 400
+
+    with app.app_context():
+        assert rebuild_rollups(verify_only=True) == {}
+        # Corrupt one bucket; verification reports it and a rebuild repairs it
+        db.session.execute(db.text("UPDATE expense_rollups SET expense_count = 9 WHERE status = 'pending'"))
+        db.session.commit()
+        assert len(rebuild_rollups(verify_only=True)) == 1
+        assert len(rebuild_rollups()) == 1
+        assert rebuild_rollups(verify_only=True) == {}
+
+def test_login_rehashes_with_new_work_factor_and_sheds_load(client, monkeypatch):
+    import passwords
+    monkeypatch.setattr(passwords, "_hasher", passwords.PasswordHasher(method="pbkdf2:sha256:1000", max_workers=1))
+    admin = create_admin(client)
+    user_id, _ = create_member(client, admin, "shift@test.com", "employee")
+    with app.app_context():
+        assert db.session.get(User, user_id).password_hash.startswith("pbkdf2:sha256:1000$")
+
+    # Raising the work factor upgrades the stored hash on the next successful login only
+    monkeypatch.setattr(passwords, "_hasher", passwords.PasswordHasher(method="pbkdf2:sha256:2000", max_workers=1))
+    assert client.post("/auth/login", json={"email": "shift@test.com", "password": "wrong"}).status_code == 401
+    with app.app_context():
+        assert db.session.get(User, user_id).password_hash.startswith("pbkdf2:sha256:1000$")
+    assert client.post("/auth/login", json={"email": "shift@test.com", "password": "secret"}).status_code == 200
+    with app.app_context():
+        assert db.session.get(User, user_id).password_hash.startswith("pbkdf2:sha256:2000$")
+    assert client.post("/auth/login", json={"email": "shift@test.com", "password": "secret"}).status_code == 200
+
+    # With no free hashing slot the request is rejected immediately rather than queued
+    busy = passwords.PasswordHasher(method="pbkdf2:sha256:2000", max_pending=1)
+    busy._slots.acquire()
+    monkeypatch.setattr(passwords, "_hasher", busy)
+    res = client.post("/auth/login", json={"email": "shift@test.com", "password": "secret"})
+    assert res.status_code == 503 and res.headers["Retry-After"] == "1"
+
+    # A hash that outlives the timeout is answered the same way, not as a 500
+    import threading
+    stalled = passwords.PasswordHasher(method="pbkdf2:sha256:2000", max_workers=1, timeout=0.05)
+    release = threading.Event()
+    stalled._executor.submit(release.wait)
+    monkeypatch.setattr(passwords, "_hasher", stalled)
+    res = client.post("/auth/login", json={"email": "shift@test.com", "password": "secret"})
+    release.set()
+    assert res.status_code == 503 and res.headers["Retry-After"] == "1"
+
+    # max_pending=0 lifts the limit instead of refusing everything
+    monkeypatch.setattr(passwords, "_hasher", passwords.PasswordHasher(method="pbkdf2:sha256:2000", max_pending=0))
+    assert client.post("/auth/login", json={"email": "shift@test.com", "password": "secret"}).status_code == 200
+
+def test_identity_is_cached_and_revoked_on_change(client):
+    admin = create_admin(client)
+    user_id, emp = create_member(client, admin, "temp@test.com", "employee")
+    from flask_jwt_extended import decode_token
+    with app.app_context():
+        claims = decode_token(emp["Authorization"].split()[1])
+    assert (claims["role"], claims["tv"]) == ("employee", 0)
+
+    # Writes check the user once; later requests reuse the cached identity
+    client.post("/expenses", json={"amount": 4, "currency_code": "USD", "description": "Coffee"}, headers=emp)
+    with count_queries() as statements:
+        client.post("/expenses", json={"amount": 4, "currency_code": "USD", "description": "Coffee"}, headers=emp)
+    assert not any("FROM users" in s for s in statements)
+
+    # A role change bumps the token version; tokens carrying the old role stop working
+    assert client.patch(f"/users/{user_id}", json={"role": "manager"}, headers=admin).status_code == 200
+    assert client.get("/expenses", headers=emp).status_code == 401
+    assert client.post("/expenses", json={"amount": 1, "currency_code": "USD", "description": "Tea"}, headers=emp).status_code == 401
+    login = client.post("/auth/login", json={"email": "temp@test.com", "password": "secret"}).get_json()
+    fresh = {"Authorization": f"Bearer {login['access_token']}"}
+    assert client.get("/expenses", headers=fresh).status_code == 200
+
+    # Renaming does not revoke anything
+    assert client.patch(f"/users/{user_id}", json={"full_name": "Temp Lead"}, headers=admin).status_code == 200
+    assert client.get("/expenses", headers=fresh).status_code == 200
+
+    gone_id, gone = create_member(client, admin, "gone@test.com", "employee")
+    assert client.get("/expenses", headers=gone).status_code == 200
+    assert client.delete(f"/users/{gone_id}", headers=admin).status_code == 200
+    assert client.get("/expenses", headers=gone).status_code == 401
+
+    # A worker without a cached record checks the token version before trusting any claim
+    second_id, second = create_member(client, admin, "second@test.com", "admin")
+    third_id, third = create_member(client, admin, "third@test.com", "admin")
+    from identity import _identity_cache
+    _identity_cache.clear()
+    for url in ("/expenses/summary", "/audit/export", "/users"):
+        assert client.get(url, headers=second).status_code == 200
+    # Once cached, read-only requests do not query the user
+    with count_queries() as statements:
+        assert client.get("/users", headers=second).status_code == 200
+    assert not any("users.token_version" in s for s in statements)
+    assert client.patch(f"/users/{second_id}", json={"role": "employee"}, headers=admin).status_code == 200
+    _identity_cache.clear()
+    for url in ("/expenses/summary", "/audit/export", "/users", "/expenses"):
+        assert client.get(url, headers=second).status_code == 401
+    assert client.delete(f"/users/{second_id}", headers=admin).status_code == 200
+    _identity_cache.clear()
+    for url in ("/expenses/summary", "/audit/export", "/users"):
+        assert client.get(url, headers=second).status_code == 401
+
+    # A demotion made on another worker leaves this worker's cache stale until the TTL passes,
+    # but the company-wide reports read the record from the primary on every request
+    assert client.get("/users", headers=third).status_code == 200
+    with app.app_context():
+        db.session.execute(db.update(User).where(User.id == third_id).values(role="employee", token_version=User.token_version + 1))
+        db.session.commit()
+    assert client.get("/users", headers=third).status_code == 200
+    assert client.get("/expenses/summary", headers=third).status_code == 401
+    assert client.get("/audit/export", headers=third).status_code == 401
+
+def test_read_only_routes_use_replica_except_right_after_a_write(client, tmp_path):
+    import shutil
+    from database import _recent_writers
+    # A second app with a primary and a replica SQLite file
+    replicated = create_app({
+        "TESTING": True,
+        "AUDIT_LOG_MODE": "sync",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{tmp_path / 'primary.db'}",
+        "SQLALCHEMY_REPLICA_URI": f"sqlite:///{tmp_path / 'replica.db'}",
+    }, with_migrations=False)
+    with replicated.app_context():
+        db.create_all()
+
+    writer = replicated.test_client()
+    res = writer.post("/auth/signup", json={"email": "ro@test.com", "password": "secret", "full_name": "Ro",
+                                            "company_name": "ReplicaCo", "country_code": "US"})
+    headers = {"Authorization": f"Bearer {res.get_json()['access_token']}"}
+    # "Replicate" the signup, then leave the replica lagging behind the next write
+    with replicated.app_context():
+        db.session.remove()
+        replicated.extensions["replica_engine"].dispose()
+    shutil.copy(tmp_path / "primary.db", tmp_path / "replica.db")
+    assert writer.post("/expenses", json={"amount": 8, "currency_code": "USD", "description": "Lag"}, headers=headers).status_code == 201
+
+    # The writer reads its own write: sticky by cookie, and by user id for clients without cookies
+    assert len(writer.get("/expenses", headers=headers).get_json()["expenses"]) == 1
+    assert len(replicated.test_client().get("/expenses", headers=headers).get_json()["expenses"]) == 1
+
+    # Once the sticky window has passed, listings come from the (lagging) replica
+    _recent_writers.clear()
+    assert replicated.test_client().get("/expenses", headers=headers).get_json()["expenses"] == []
+    # Writing routes always read the primary
+    res = replicated.test_client().post("/expenses/batch", json={"expenses": [{"amount": 1, "currency_code": "USD", "description": "x"}]}, headers=headers)
+    assert res.status_code == 201
+    _recent_writers.clear()
+
+def test_receipts_are_streamed_deduplicated_and_served_with_ranges(client, tmp_path, monkeypatch):
+    import hashlib
+    import io
+    from receipts import ReceiptStore
+    store = ReceiptStore(str(tmp_path / "receipts"), max_bytes=4096, chunk_size=256)
+    monkeypatch.setitem(app.extensions, "receipt_store", store)
+    admin = create_admin(client)
+    _, emp = create_member(client, admin, "clerk@test.com", "employee")
+    _, other = create_member(client, admin, "other@test.com", "employee")
+    first = client.post("/expenses", json={"amount": 7, "currency_code": "USD", "description": "Taxi"}, headers=emp).get_json()["expense"]["id"]
+    second = client.post("/expenses", json={"amount": 9, "currency_code": "USD", "description": "Taxi back"}, headers=emp).get_json()["expense"]["id"]
+    pdf = b"%PDF-1.4\n" + bytes(range(256)) * 8
+    digest = hashlib.sha256(pdf).hexdigest()
+
+    def upload(expense_id, body, headers, name="receipt.pdf"):
+        return client.post(f"/expenses/{expense_id}/receipt", headers=headers, content_type="multipart/form-data",
+                           data={"note": "lunch", "file": (io.BytesIO(body), name)})
+
+    res = upload(first, pdf, emp)
+    assert res.status_code == 200
+    assert res.get_json()["receipt"] == {"sha256": digest, "size": len(pdf), "content_type": "application/pdf", "filename": "receipt.pdf"}
+    # Same bytes on another expense are stored once
+    assert upload(second, pdf, emp, name="copy.pdf").status_code == 200
+    stored = [name for prefix in os.listdir(store.root) if prefix != "tmp" for name in os.listdir(os.path.join(store.root, prefix))]
+    assert stored == [digest[2:]]
+    assert {e["receipt_sha256"] for e in client.get("/expenses", headers=emp).get_json()["expenses"]} == {digest}
+
+    res = client.get(f"/expenses/{first}/receipt", headers=emp)
+    assert res.status_code == 200
+    assert res.data == pdf
+    assert res.headers["Content-Type"] == "application/pdf"
+    assert res.headers["ETag"] == f'"{digest}"'
+    assert client.get(f"/expenses/{first}/receipt", headers={**emp, "If-None-Match": f'"{digest}"'}).status_code == 304
+    res = client.get(f"/expenses/{first}/receipt", headers={**emp, "Range": "bytes=0-7"})
+    assert res.status_code == 206
+    assert res.data == pdf[:8]
+    assert client.get(f"/expenses/{first}/receipt", headers=admin).status_code == 200
+
+    # Outside the caller's scope the expense does not exist
+    assert client.get(f"/expenses/{first}/receipt", headers=other).status_code == 404
+    assert upload(first, pdf, other).status_code == 404
+
+    assert upload(first, b"<html><script>alert(1)</script></html>", emp, name="x.html").status_code == 415
+    assert upload(first, b"%PDF-" + b"x" * 5000, emp).status_code == 413
+    assert os.listdir(os.path.join(store.root, "tmp")) == []
+    assert client.get(f"/expenses/{first}/receipt", headers=emp).data == pdf
+
+    # Replacing the first receipt leaves the old file unreferenced once the second expense drops it too
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+    assert upload(first, png, emp, name="scan.png").status_code == 200
+    assert upload(second, png, emp, name="scan.png").status_code == 200
+    with app.app_context():
+        assert store.prune({hashlib.sha256(png).hexdigest()}, grace_seconds=0) == 1
+    assert client.get(f"/expenses/{second}/receipt", headers=emp).data == png
+
+def test_list_polls_revalidate_with_etags_and_large_responses_are_gzipped(client):
+    import gzip
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "boss@test.com", "manager")
+    emp_id, emp = create_member(client, admin, "emp@test.com", "employee", manager_id)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id], "rules": {}}}, headers=admin)
+    expense_id = client.post("/expenses", json={"amount": 5, "currency_code": "USD", "description": "Cab"}, headers=emp).get_json()["expense"]["id"]
+
+    def revalidate(url, headers):
+        first = client.get(url, headers=headers)
+        assert first.status_code == 200 and first.headers["ETag"].startswith('W/"')
+        with count_queries() as statements:
+            again = client.get(url, headers={**headers, "If-None-Match": first.headers["ETag"]})
+        assert again.status_code == 304 and again.data == b""
+        assert again.headers["ETag"] == first.headers["ETag"]
+        return first.headers["ETag"], len(statements)
+
+    # An unchanged collection is confirmed with one aggregate statement and no row fetch
+    etag, statements = revalidate("/expenses", manager)
+    assert statements == 1
+    assert "Last-Modified" in client.get("/expenses", headers=manager).headers
+    # A status change within the same second still changes the validator
+    assert client.post(f"/expenses/{expense_id}/approve", json={"decision": "approved"}, headers=manager).status_code == 200
+    res = client.get("/expenses", headers={**manager, "If-None-Match": etag})
+    assert res.status_code == 200 and res.headers["ETag"] != etag
+    # Each caller and query string has its own validator
+    assert revalidate("/expenses", emp)[0] != revalidate("/expenses", manager)[0]
+    assert revalidate("/expenses?status=approved", manager)[0] != revalidate("/expenses", manager)[0]
+    etag, _ = revalidate("/expenses?limit=1", manager)
+    client.post("/expenses", json={"amount": 6, "currency_code": "USD", "description": "Bus"}, headers=emp)
+    assert client.get("/expenses?limit=1", headers={**manager, "If-None-Match": etag}).status_code == 200
+
+    etag, statements = revalidate("/users", admin)
+    assert statements == 1
+    expenses_etag, _ = revalidate("/expenses", manager)
+    page_etag, _ = revalidate("/expenses?limit=1", manager)
+    assert client.patch(f"/users/{emp_id}", json={"full_name": "Renamed"}, headers=admin).status_code == 200
+    assert client.get("/users", headers={**admin, "If-None-Match": etag}).status_code == 200
+    # Renaming a submitter changes the expense listings that show their name
+    res = client.get("/expenses", headers={**manager, "If-None-Match": expenses_etag})
+    assert res.status_code == 200 and {e["submitter_name"] for e in res.get_json()["expenses"]} == {"Renamed"}
+    assert client.get("/expenses?limit=1", headers={**manager, "If-None-Match": page_etag}).status_code == 200
+    assert client.delete(f"/users/{create_member(client, admin, 'temp@test.com', 'employee')[0]}", headers=admin).status_code == 200
+    etag, _ = revalidate("/users", admin)
+
+    etag, _ = revalidate("/flows", admin)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id], "rules": {"percentage": 100}}}, headers=admin)
+    assert client.get("/flows", headers={**admin, "If-None-Match": etag}).status_code == 200
+
+    # Compression kicks in above COMPRESS_MIN_BYTES for clients that accept gzip
+    client.post("/expenses/batch", json={"expenses": [
+        {"amount": n + 1, "currency_code": "USD", "description": f"Item {n}"} for n in range(30)
+    ]}, headers=emp)
+    plain = client.get("/expenses", headers=emp)
+    assert "Content-Encoding" not in plain.headers and "Accept-Encoding" in plain.headers["Vary"]
+    zipped = client.get("/expenses", headers={**emp, "Accept-Encoding": "gzip"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert len(zipped.data) < len(plain.data)
+    assert json.loads(gzip.decompress(zipped.data)) == plain.get_json()
+    assert zipped.headers["ETag"] == plain.headers["ETag"]
+    small = client.get("/flows", headers={**admin, "Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers
+
+def test_search_ranks_matches_within_the_callers_scope(client):
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "boss@test.com", "manager")
+    _, emp = create_member(client, admin, "emp@test.com", "employee", manager_id)
+    _, outsider = create_member(client, admin, "solo@test.com", "employee")
+    def submit(headers, description):
+        return client.post("/expenses", json={"amount": 5, "currency_code": "USD", "description": description}, headers=headers).get_json()["expense"]["id"]
+    taxi_twice = submit(emp, "Taxi to the airport, taxi back")
+    taxi = submit(emp, "Airport parking and a taxi")
+    submit(emp, "Team lunch")
+    solo_taxi = submit(outsider, "Taxi home")
+
+    res = client.get("/expenses/search?q=taxi", headers=manager)
+    assert res.status_code == 200
+    results = res.get_json()["expenses"]
+    # Best match first; the outsider's expense is not in the manager's scope
+    assert [e["id"] for e in results] == [taxi_twice, taxi]
+    assert results[0]["rank"] >= results[1]["rank"]
+    assert {e["id"] for e in client.get("/expenses/search?q=taxi", headers=admin).get_json()["expenses"]} == {taxi_twice, taxi, solo_taxi}
+    assert [e["id"] for e in client.get("/expenses/search?q=taxi", headers=outsider).get_json()["expenses"]] == [solo_taxi]
+    # Every term must match, the last one as a prefix, and stemming finds plural forms
+    assert [e["id"] for e in client.get("/expenses/search?q=airport+park", headers=admin).get_json()["expenses"]] == [taxi]
+    assert len(client.get("/expenses/search?q=taxis", headers=admin).get_json()["expenses"]) == 3
+    # Query syntax in user input is treated as plain words
+    assert client.get('/expenses/search?q="taxi" OR NEAR(-lunch*', headers=admin).status_code == 200
+    assert client.get("/expenses/search?q=taxi&limit=1", headers=admin).get_json()["expenses"][0]["id"] in {taxi_twice, solo_taxi}
+    assert client.get("/expenses/search?q=+%21", headers=admin).status_code == 400
+
+    # The index follows updates made directly in the database
+    with app.app_context():
+        db.session.execute(db.update(Expense).where(Expense.id == taxi).values(description="Parking only"))
+        db.session.commit()
+    assert {e["id"] for e in client.get("/expenses/search?q=taxi", headers=admin).get_json()["expenses"]} == {taxi_twice, solo_taxi}
+    assert [e["id"] for e in client.get("/expenses/search?q=parking", headers=admin).get_json()["expenses"]] == [taxi]
+
+def test_expense_listing_filters_and_sorts_in_sql_with_keyset_pages(client):
+    admin = create_admin(client)
+    _, emp = create_member(client, admin, "emp@test.com", "employee")
+    client.post("/expenses/batch", json={"expenses": [
+        {"amount": amount, "currency_code": currency, "description": f"Item {amount}"}
+        for amount, currency in [(120, "USD"), (800, "USD"), (650, "USD"), (50, "USD"), (999, "USD"), (650, "USD")]
+    ]}, headers=emp)
+    with app.app_context():
+        # Spread created_at over two quarters
+        ids = [row.id for row in db.session.query(Expense.id).order_by(Expense.id)]
+        for n, expense_id in enumerate(ids):
+            db.session.execute(db.update(Expense).where(Expense.id == expense_id).values(created_at=datetime(2025, 2 + n, 10)))
+        db.session.execute(db.update(Expense).where(Expense.id == ids[4]).values(currency_code="EUR"))
+        db.session.commit()
+
+    def listed(query, headers=admin):
+        res = client.get(f"/expenses?{query}", headers=headers)
+        assert res.status_code == 200, res.get_json()
+        return res.get_json()
+
+    # Q1 2025 (from inclusive, to exclusive) and over 500
+    assert [e["id"] for e in listed("from=2025-01-01&to=2025-04-01&min_amount=500")["expenses"]] == [ids[1]]
+    assert [e["id"] for e in listed("from=2025-01-01&to=2025-04-01")["expenses"]] == [ids[1], ids[0]]
+    assert [e["id"] for e in listed("max_amount=120")["expenses"]] == [ids[3], ids[0]]
+    assert [e["id"] for e in listed("currency_code=eur")["expenses"]] == [ids[4]]
+    assert len(listed("currency_code=EUR&currency_code=USD")["expenses"]) == 6
+    # Ties on amount fall back to id, in the same direction
+    by_amount = [e["id"] for e in listed("sort=-amount_converted")["expenses"]]
+    assert by_amount == [ids[4], ids[1], ids[5], ids[2], ids[0], ids[3]]
+    assert [e["id"] for e in listed("sort=amount_converted")["expenses"]] == by_amount[::-1]
+    assert [e["id"] for e in listed("sort=created_at")["expenses"]] == ids
+
+    # Keyset pages follow the requested order and filters
+    for sort in ("-amount_converted", "amount_converted", "-created_at", "created_at"):
+        expected = [e["id"] for e in listed(f"sort={sort}&min_amount=100")["expenses"]]
+        seen, cursor = [], None
+        while True:
+            page = listed(f"sort={sort}&min_amount=100&limit=2" + (f"&cursor={cursor}" if cursor else ""))
+            seen += [e["id"] for e in page["expenses"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                break
+        assert seen == expected and len(expected) == 5
+    assert [e["id"] for e in listed("sort=-amount_converted&stream=1")["expenses"]] == by_amount
+    # Scoping still applies underneath the filters
+    assert len(listed("min_amount=0", headers=create_member(client, admin, "solo@test.com", "employee")[1])["expenses"]) == 0
+
+    for query in ("sort=description", "from=yesterday", "min_amount=lots", "max_amount=NaN"):
+        assert client.get(f"/expenses?{query}", headers=admin).status_code == 400
+
+def test_benchmark_org_is_deterministic_and_regressions_fail_the_run(client):
+    from benchmarks.datagen import OrgParams, generate_org
+    from benchmarks.api_benchmark import compare_to_baseline, run_scenarios
+    params = OrgParams(depth=3, fanout=2, expenses_per_user=3, flow_steps=2, seed=7)
+
+    def generated_rows():
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            (actors,) = generate_org(params)
+            users = db.session.query(User.email, User.role, User.manager_id).order_by(User.id).all()
+            expenses = db.session.query(
+                Expense.submitter_id, Expense.amount, Expense.currency_code, Expense.status, Expense.description, Expense.created_at
+            ).order_by(Expense.id).all()
+            return actors, users, expenses
+
+    first_actors, *first = generated_rows()
+    actors, *second = generated_rows()
+    assert first == second and first_actors == actors
+    users, expenses = second
+    # Admin, two approvers, then a 3-level tree of 2 + 4 reports with 3 expenses each
+    assert len(users) == 9 and len(expenses) == 18
+    assert actors.pending_expense_ids
+
+    results = run_scenarios(app, actors, requests=2, warmup=1, only={"list_expenses_employee_all", "create_expense"})
+    assert list(results) == ["list_expenses_employee_all", "create_expense"]
+    assert results["list_expenses_employee_all"]["queries"] == 1
+
+    baseline = {name: dict(result) for name, result in results.items()}
+    assert compare_to_baseline(results, baseline, latency_tolerance=0.5, slack_ms=2.0) == []
+    baseline["create_expense"]["queries"] -= 1
+    baseline["list_expenses_employee_all"]["p95_ms"] = results["list_expenses_employee_all"]["p95_ms"] / 10
+    failures = compare_to_baseline(results, baseline, latency_tolerance=0.5, slack_ms=0)
+    assert len(failures) == 2
+    assert failures[0].startswith("list_expenses_employee_all: p95") and failures[1].startswith("create_expense:")
+
+def test_csv_import_keeps_history_and_resumes_after_an_interruption(client):
+    from expense_import import run_import
+    from models import ImportJob, ImportStatus
+    from utils import rebuild_rollups
+    admin = create_admin(client)
+    manager_id, manager = create_member(client, admin, "boss@test.com", "manager")
+    create_member(client, admin, "rep@test.com", "employee", manager_id)
+    client.post("/flows", json={"user_id": manager_id, "config": {"sequence": [manager_id], "rules": {}}}, headers=admin)
+
+    lines = [
+        "Submitter_Email,amount,currency_code,created_at,status,description,amount_converted\n",
+        "rep@test.com,120.00,USD,2021-03-04T10:00:00,approved,Hotel,\n",
+        "REP@test.com,80,EUR,2021-03-05,rejected,\"Dinner, team\",88.00\n",
+        "rep@test.com,15.5,USD,2021-04-01T09:30:00+02:00,pending,Taxi,\n",
+        "ghost@test.com,10,USD,2021-04-02,approved,Unknown,\n",
+        "rep@test.com,-3,USD,2021-04-03,approved,Refund,\n",
+        "rep@test.com,40,EUR,2021-04-04,approved,No rate,\n",
+        "rep@test.com,9,USD,2021-05-01,,Parking,\n",
+    ]
+
+    # The connection drops while the third chunk is being read; the first two are already committed
+    def interrupted():
+        yield from lines[:6]
+        raise ConnectionError("client went away")
+    with app.app_context():
+        job = ImportJob(company_id=1, status=ImportStatus.running)
+        db.session.add(job)
+        db.session.commit()
+        with pytest.raises(ConnectionError):
+            run_import(job, interrupted(), chunk_size=2)
+        assert (job.status, job.rows_done, job.imported_rows, job.failed_rows) == (ImportStatus.failed, 4, 3, 1)
+        job_id = job.id
+
+    csv_body = "".join(lines)
+    res = client.post("/expenses/import?job_id=999", data=csv_body, content_type="text/csv", headers=admin)
+    assert res.status_code == 404
+    # A different file cannot continue the job
+    res = client.post(f"/expenses/import?job_id={job_id}", data=csv_body.replace("Hotel", "Motel"), content_type="text/csv", headers=admin)
+    assert res.status_code == 409
+    res = client.post(f"/expenses/import?job_id={job_id}", data=csv_body, content_type="text/csv", headers=admin)
+    assert res.status_code == 200, res.get_json()
+    job = res.get_json()["import"]
+    assert (job["status"], job["rows_done"], job["imported_rows"], job["failed_rows"]) == ("completed", 7, 4, 3)
+    assert [(e["line"], e["error"]) for e in job["errors"]] == [
+        (5, "no user ghost@test.com in this company"),
+        (6, "amount must be a positive number"),
+        (7, "no exchange rate from EUR to USD on 2021-04-04"),
+    ]
+    assert client.get(f"/expenses/import/{job_id}", headers=admin).get_json()["import"] == job
+    assert client.post(f"/expenses/import?job_id={job_id}", data=csv_body, content_type="text/csv", headers=admin).status_code == 409
+
+    with app.app_context():
+        rows = db.session.query(Expense.description, Expense.status, Expense.amount_converted, Expense.created_at).order_by(Expense.id).all()
+        assert [(d, s.value, str(a), c) for d, s, a, c in rows] == [
+            ("Hotel", "approved", "120.00", datetime(2021, 3, 4, 10)),
+            ("Dinner, team", "rejected", "88.00", datetime(2021, 3, 5)),
+            ("Taxi", "pending", "15.50", datetime(2021, 4, 1, 7, 30)),
+            ("Parking", "pending", "9.00", datetime(2021, 5, 1)),
+        ]
+        # Decided history is not re-run through the policy; pending rows wait on the first approver
+        assert db.session.query(Approval.approver_id).count() == 2
+        assert rebuild_rollups(verify_only=True) == {}
+    assert len(client.get("/approvals/pending", headers=manager).get_json()["approvals"]) == 2
+
+    assert client.post("/expenses/import", data=csv_body, content_type="text/csv", headers=manager).status_code == 403
+    assert client.post("/expenses/import", data=csv_body, headers=admin).status_code == 415
+    res = client.post("/expenses/import", data="email,amount\n", content_type="text/csv", headers=admin)
+    assert res.status_code == 400 and res.get_json()["error"].startswith("Missing columns")
@@ -1,110 +1,454 @@
-import requests
 import os
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, Company, User, Expense, Approval, ApprovalFlow, AuditLog, UserRole, ExpenseStatus, ApprovalDecision
+import json
+import base64
+import binascii
+import time
+from dataclasses import dataclass
+from typing import Optional
+from sqlalchemy.orm import aliased
+from models import db, Company, User, UserHierarchy, Expense, ExpenseRollup, Approval, ApprovalFlow, UserRole, ExpenseStatus, ApprovalDecision
+from audit import record_audit_logs
 from datetime import datetime
+from decimal import Decimal
 
-def get_currency_from_country(country_code):
-    """Get currency code from country code using RestCountries API"""
+def subtree_ids_query(manager_id):
+    """Select the ids of a manager and everyone reporting to them, directly or indirectly"""
+    return db.select(UserHierarchy.descendant_id).where(UserHierarchy.ancestor_id == manager_id)
+
+def is_in_subtree(manager_id, user_id):
+    """Check whether user_id is manager_id or reports to them at any depth (single PK lookup)"""
+    row = db.session.execute(
+        db.select(UserHierarchy.depth).where(
+            UserHierarchy.ancestor_id == manager_id,
+            UserHierarchy.descendant_id == user_id
+        )
+    ).first()
+    return row is not None
+
+def subtree_members(manager_id, user_ids):
+    """Return the subset of user_ids that are manager_id or report to them, in one indexed query"""
+    rows = db.session.execute(
+        db.select(UserHierarchy.descendant_id).where(
+            UserHierarchy.ancestor_id == manager_id,
+            UserHierarchy.descendant_id.in_(list(user_ids))
+        )
+    )
+    return {row.descendant_id for row in rows}
+
+def add_to_hierarchy(user):
+    """Insert closure rows for a newly flushed user: the self row plus one per ancestor of its manager"""
+    db.session.execute(
+        db.insert(UserHierarchy).values(ancestor_id=user.id, descendant_id=user.id, depth=0)
+    )
+    if user.manager_id:
+        db.session.execute(
+            db.insert(UserHierarchy).from_select(
+                ['ancestor_id', 'descendant_id', 'depth'],
+                db.select(
+                    UserHierarchy.ancestor_id,
+                    db.literal(user.id),
+                    UserHierarchy.depth + 1
+                ).where(UserHierarchy.descendant_id == user.manager_id)
+            )
+        )
+
+def _detach_subtree(user_id, include_self):
+    """Delete the links between a user's subtree and the user's ancestors"""
+    ancestors = db.select(UserHierarchy.ancestor_id).where(UserHierarchy.descendant_id == user_id)
+    if not include_self:
+        ancestors = ancestors.where(UserHierarchy.depth > 0)
+    db.session.execute(
+        db.delete(UserHierarchy).where(
+            UserHierarchy.descendant_id.in_(subtree_ids_query(user_id)),
+            UserHierarchy.ancestor_id.in_(ancestors)
+        ).execution_options(synchronize_session=False)
+    )
+
+def move_in_hierarchy(user_id, new_manager_id):
+    """Re-parent a user (and their whole subtree) under new_manager_id"""
+    db.session.flush()
+    _detach_subtree(user_id, include_self=False)
+    if new_manager_id:
+        above = aliased(UserHierarchy)
+        below = aliased(UserHierarchy)
+        db.session.execute(
+            db.insert(UserHierarchy).from_select(
+                ['ancestor_id', 'descendant_id', 'depth'],
+                db.select(
+                    above.ancestor_id,
+                    below.descendant_id,
+                    above.depth + below.depth + 1
+                ).where(
+                    above.descendant_id == new_manager_id,
+                    below.ancestor_id == user_id
+                )
+            )
+        )
+
+def remove_from_hierarchy(user_id):
+    """Drop every closure row that references a user; their reports become roots of their own subtrees"""
+    db.session.flush()
+    _detach_subtree(user_id, include_self=True)
+
+def rebuild_hierarchy():
+    """Recompute the whole closure table from users.manager_id"""
+    parents = dict(db.session.execute(db.select(User.id, User.manager_id)).all())
+    rows = []
+    for user_id in parents:
+        depth = 0
+        ancestor = user_id
+        seen = set()
+        while ancestor is not None and ancestor not in seen:
+            seen.add(ancestor)
+            rows.append({'ancestor_id': ancestor, 'descendant_id': user_id, 'depth': depth})
+            ancestor = parents.get(ancestor)
+            depth += 1
+    db.session.execute(db.delete(UserHierarchy))
+    if rows:
+        db.session.execute(db.insert(UserHierarchy), rows)
+    db.session.commit()
+    return len(rows)
+
+def encode_cursor(*values):
+    """Encode keyset pagination values as an opaque URL-safe token"""
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a token produced by encode_cursor; raises ValueError when malformed"""
     try:
-        api_url = os.getenv('RESTCOUNTRIES_API_URL', 'https://restcountries.com/v3.1')
-        response = requests.get(f"{api_url}/alpha/{country_code}")
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                currencies = data[0].get('currencies', {})
-                if currencies:
-                    # Get the first currency code
-                    return list(currencies.keys())[0]
-    except Exception as e:
-        print(f"Error fetching currency: {e}")
-    
-    # Default to USD if API fails
-    return 'USD'
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid cursor') from e
+    if not isinstance(values, list):
+        raise ValueError('invalid cursor')
+    return values
+
+def cursor_value(value):
+    """JSON-safe form of a sort value for encode_cursor"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+def _sqlite_timestamp_after(column, id_column, value, last_id, descending):
+    # SQLite keeps timestamps as text: CURRENT_TIMESTAMP defaults have no fraction, SQLAlchemy writes
+    # six digits. A whole second can be spelled both ways, so the comparison brackets both spellings.
+    if value.microsecond:
+        forms = [value.strftime('%Y-%m-%d %H:%M:%S.%f')]
+    else:
+        forms = [value.strftime('%Y-%m-%d %H:%M:%S'), value.strftime('%Y-%m-%d %H:%M:%S.000000')]
+    tie = db.or_(*[column == db.literal(form, db.String) for form in forms])
+    if descending:
+        return db.or_(column < db.literal(forms[0], db.String), db.and_(tie, id_column < last_id))
+    return db.or_(column > db.literal(forms[-1], db.String), db.and_(tie, id_column > last_id))
+
+def keyset_after(model, sort_key, sort_value, last_id, descending=True):
+    """Filter for rows that come after (sort_value, last_id) in (sort_key, id) order.
+
+    Both values come from the cursor, so the next page is still right when the
+    row the previous page ended on has since been deleted. Raises ValueError
+    when sort_value does not fit the column.
+    """
+    column = getattr(model, sort_key)
+    try:
+        if isinstance(column.type, db.DateTime):
+            value = datetime.fromisoformat(sort_value)
+            if db.session.get_bind().dialect.name == 'sqlite':
+                return _sqlite_timestamp_after(column, model.id, value, last_id, descending)
+        elif isinstance(column.type, db.Numeric):
+            value = Decimal(sort_value)
+        else:
+            value = sort_value
+    except (TypeError, ValueError, ArithmeticError):
+        raise ValueError('Invalid cursor')
+    if descending:
+        return db.or_(column < value, db.and_(column == value, model.id < last_id))
+    return db.or_(column > value, db.and_(column == value, model.id > last_id))
+
+def month_bucket(column):
+    """'YYYY-MM' string for a timestamp column, in the current dialect"""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return db.func.to_char(column, 'YYYY-MM')
+    return db.func.strftime('%Y-%m', column)
+
+def upsert(model, rows, index_elements, update=None):
+    """Bulk INSERT ... ON CONFLICT DO UPDATE on Postgres and SQLite.
+
+    update maps a column name to callable(table, excluded) giving its new value;
+    by default a conflicting row takes the incoming value of every other column.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f'upsert is not supported on {dialect}')
+    table = model.__table__
+    statement = insert(table)
+    if update is None:
+        values = {column: statement.excluded[column] for column in rows[0] if column not in index_elements}
+    else:
+        values = {column: build(table, statement.excluded) for column, build in update.items()}
+    db.session.execute(statement.on_conflict_do_update(index_elements=index_elements, set_=values), rows)
 
 def create_audit_log(expense_id, user_id, action, details=None):
-    """Create an audit log entry"""
-    audit_log = AuditLog(
-        expense_id=expense_id,
-        user_id=user_id,
-        action=action,
-        details=details or {}
-    )
-    db.session.add(audit_log)
+    """Record an audit log entry for the current unit of work (see audit.record_audit_logs)"""
+    record_audit_logs([{'expense_id': expense_id, 'user_id': user_id, 'action': action, 'details': details}])
+
+def rollup_period(created_at):
+    """Rollup bucket of an expense; the Python twin of month_bucket"""
+    return created_at.strftime('%Y-%m')
+
+def update_rollups(changes):
+    """Stage incremental expense_rollups updates for (company_id, status, created_at, amount_converted, sign) changes.
+
+    sign is +1 when an expense enters a status bucket and -1 when it leaves one.
+    Changes are netted per bucket and applied with one upsert in the caller's
+    transaction, in key order so concurrent requests lock rollup rows consistently.
+    """
+    deltas = {}
+    for company_id, status, created_at, amount, sign in changes:
+        key = (company_id, status.value, rollup_period(created_at))
+        count, total = deltas.get(key, (0, Decimal(0)))
+        deltas[key] = (count + sign, total + sign * Decimal(str(amount or 0)))
+    rows = [
+        {'company_id': company_id, 'status': ExpenseStatus(status), 'period': period, 'expense_count': count, 'total_amount': total}
+        for (company_id, status, period), (count, total) in sorted(deltas.items())
+        if count or total
+    ]
+    if rows:
+        upsert(ExpenseRollup, rows, ['company_id', 'status', 'period'], update={
+            'expense_count': lambda table, excluded: table.c.expense_count + excluded.expense_count,
+            'total_amount': lambda table, excluded: table.c.total_amount + excluded.total_amount,
+        })
+
+def compute_rollups():
+    """{(company_id, status, period): (count, total)} recomputed from the expenses table"""
+    period = month_bucket(Expense.created_at)
+    rows = db.session.query(
+        Expense.company_id,
+        Expense.status,
+        period,
+        db.func.count(),
+        db.func.coalesce(db.func.sum(Expense.amount_converted), 0)
+    ).group_by(Expense.company_id, Expense.status, period)
+    return {
+        (company_id, status, period): (count, Decimal(str(total)).quantize(Decimal('0.01')))
+        for company_id, status, period, count, total in rows
+    }
+
+def rebuild_rollups(verify_only=False):
+    """Recompute expense_rollups from scratch and compare with the incrementally maintained rows.
+
+    Returns {bucket: (stored, expected)} for every bucket that had drifted. Unless
+    verify_only is set the table is then replaced with the recomputed values.
+    """
+    if not verify_only and db.session.get_bind().dialect.name == 'postgresql':
+        # Incremental writers queue behind the rebuild instead of racing the snapshot
+        db.session.execute(db.text('LOCK TABLE expense_rollups IN EXCLUSIVE MODE'))
+    expected = compute_rollups()
+    stored = {
+        (row.company_id, row.status, row.period): (row.expense_count, Decimal(str(row.total_amount)).quantize(Decimal('0.01')))
+        for row in ExpenseRollup.query
+    }
+    empty = (0, Decimal('0.00'))
+    drift = {
+        key: (stored.get(key), expected.get(key))
+        for key in set(stored) | set(expected)
+        if stored.get(key, empty) != expected.get(key, empty)
+    }
+    if verify_only:
+        db.session.rollback()
+        return drift
+    db.session.query(ExpenseRollup).delete()
+    if expected:
+        db.session.execute(db.insert(ExpenseRollup), [
+            {'company_id': company_id, 'status': status, 'period': period, 'expense_count': count, 'total_amount': total}
+            for (company_id, status, period), (count, total) in expected.items()
+        ])
     db.session.commit()
-    return audit_log
+    return drift
 
-def evaluate_policy(expense_id):
-    """Policy engine to evaluate approval rules"""
-    expense = Expense.query.get(expense_id)
-    if not expense:
-        return False
-    
-    flow = ApprovalFlow.query.filter_by(company_id=expense.company_id).first()
-    if not flow:
-        # Default sequential approval if no flow exists
-        return False
-    
-    rules = flow.config.get("rules", {})
-    approvals = Approval.query.filter_by(expense_id=expense_id).all()
-    
+@dataclass(frozen=True)
+class CompiledPolicy:
+    """Immutable, pre-parsed form of an ApprovalFlow config"""
+    flow_id: int
+    sequence: tuple
+    sequence_set: frozenset
+    specific_id: Optional[int]
+    percentage: Optional[float]
+
+def compile_policy(flow):
+    """Parse and validate a flow config once; raises ValueError on a malformed config"""
+    config = flow.config or {}
+    rules = config.get("rules") or {}
+    sequence = config.get("sequence") or []
+    if not isinstance(rules, dict):
+        raise ValueError("rules must be a JSON object")
+    if not isinstance(sequence, list):
+        raise ValueError("sequence must be a list of user ids")
+    try:
+        sequence = tuple(int(approver_id) for approver_id in sequence)
+        specific_id = int(rules["specific"]) if rules.get("specific") is not None else None
+        percentage = float(rules["percentage"]) if rules.get("percentage") is not None else None
+    except (TypeError, ValueError):
+        raise ValueError("sequence, specific and percentage must be numeric")
+    return CompiledPolicy(
+        flow_id=flow.id,
+        sequence=sequence,
+        sequence_set=frozenset(sequence),
+        specific_id=specific_id,
+        percentage=percentage
+    )
+
+# company_id -> (expires_at, CompiledPolicy or None when the company has no flow)
+_policy_cache = {}
+POLICY_CACHE_TTL = float(os.getenv('POLICY_CACHE_TTL', '60'))
+
+def get_policy(company_id):
+    """Return the company's compiled policy, compiling and caching it on first use.
+
+    create_flow invalidates the local entry; the TTL bounds how long other
+    worker processes can serve a superseded flow.
+    """
+    cached = _policy_cache.get(company_id)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return cached[1]
+    flow = ApprovalFlow.query.filter_by(company_id=company_id).first()
+    policy = compile_policy(flow) if flow else None
+    _policy_cache[company_id] = (now + POLICY_CACHE_TTL, policy)
+    return policy
+
+def invalidate_policy(company_id):
+    _policy_cache.pop(company_id, None)
+
+def approval_counts(policy, expense_ids):
+    """Aggregate approval decisions per expense in one GROUP BY instead of loading every Approval"""
+    approved = Approval.decision == ApprovalDecision.approved
+    rejected = Approval.decision == ApprovalDecision.rejected
+    columns = [
+        Approval.expense_id,
+        db.func.sum(db.case((rejected, 1), else_=0)).label('rejected'),
+        db.func.sum(db.case((approved, 1), else_=0)).label('approved'),
+        db.func.sum(db.case((Approval.decision != ApprovalDecision.pending, 1), else_=0)).label('decided'),
+    ]
+    if policy.specific_id is not None:
+        columns.append(db.func.sum(db.case(
+            (db.and_(approved, Approval.approver_id == policy.specific_id), 1), else_=0
+        )).label('specific_approved'))
+    else:
+        columns.append(db.literal(0).label('specific_approved'))
+    if policy.sequence_set:
+        columns.append(db.func.count(db.distinct(db.case(
+            (db.and_(approved, Approval.approver_id.in_(policy.sequence_set)), Approval.approver_id)
+        ))).label('sequence_approved'))
+    else:
+        columns.append(db.literal(0).label('sequence_approved'))
+    rows = db.session.query(*columns).filter(
+        Approval.expense_id.in_(expense_ids)
+    ).group_by(Approval.expense_id).all()
+    return {row.expense_id: row for row in rows}
+
+def assign_first_approvers(policy, expense_ids):
+    """Set-based equivalent of evaluate_policy for freshly created expenses.
+
+    A new expense has no approvals yet, so the only possible outcome is a
+    pending approval for the first approver in the sequence.
+    """
+    if not policy or not policy.sequence or not expense_ids:
+        return None
+    approver_id = policy.sequence[0]
+    db.session.execute(db.insert(Approval), [
+        {'expense_id': expense_id, 'approver_id': approver_id, 'decision': ApprovalDecision.pending}
+        for expense_id in expense_ids
+    ])
+    record_audit_logs([
+        {'expense_id': expense_id, 'user_id': None, 'action': 'approval_assigned', 'details': {'approver_id': approver_id}}
+        for expense_id in expense_ids
+    ])
+    return approver_id
+
+def _policy_outcome(policy, counts):
+    """Decide the terminal status for one expense from its aggregated counts, or None if still open"""
+    if not counts:
+        return None
     # Check if expense is already rejected
-    if any(a.decision == ApprovalDecision.rejected for a in approvals):
-        expense.status = ExpenseStatus.rejected
-        db.session.commit()
-        create_audit_log(expense_id, None, "expense_rejected", {"reason": "policy_evaluation"})
-        return True
-    
+    if counts.rejected:
+        return ExpenseStatus.rejected, "expense_rejected", "policy_evaluation"
     # Specific approver rule
-    if "specific" in rules:
-        specific_id = rules["specific"]
-        for approval in approvals:
-            if approval.approver_id == specific_id and approval.decision == ApprovalDecision.approved:
-                expense.status = ExpenseStatus.approved
-                db.session.commit()
-                create_audit_log(expense_id, None, "expense_approved", {"reason": "specific_approver"})
-                return True
-    
+    if counts.specific_approved:
+        return ExpenseStatus.approved, "expense_approved", "specific_approver"
     # Percentage rule
-    if "percentage" in rules:
-        total_approvals = len([a for a in approvals if a.decision != ApprovalDecision.pending])
-        approved_count = len([a for a in approvals if a.decision == ApprovalDecision.approved])
-        if total_approvals > 0 and (approved_count / total_approvals) >= rules["percentage"]:
-            expense.status = ExpenseStatus.approved
-            db.session.commit()
-            create_audit_log(expense_id, None, "expense_approved", {"reason": "percentage_rule"})
-            return True
+    if policy.percentage is not None and counts.decided > 0 and (counts.approved / counts.decided) >= policy.percentage:
+        return ExpenseStatus.approved, "expense_approved", "percentage_rule"
+    # Sequential rule: all required approvers have approved
+    if policy.sequence and counts.sequence_approved == len(policy.sequence_set):
+        return ExpenseStatus.approved, "expense_approved", "sequential_approval"
+    return None
+
+def evaluate_policies(expenses):
+    """Policy engine to evaluate approval rules for expenses of one company in a single pass.
+
+    Decision counts come from one aggregate query and the next sequential
+    approvers from one more; new approvals and audit entries are bulk
+    inserted and status changes are folded into expense_rollups. Only stages changes on the session; the calling route commits
+    once for the whole request so a failure part way through leaves nothing
+    half-written. Returns {expense_id: True if the expense reached a final status}.
+    """
+    results = {expense.id: False for expense in expenses}
+    if not expenses:
+        return results
+    policy = get_policy(expenses[0].company_id)
+    if not policy:
+        # Default sequential approval if no flow exists
+        return results
+    
+    counts = approval_counts(policy, list(results))
+    audit_rows = []
+    open_expenses = []
+    rollup_changes = []
+    for expense in expenses:
+        outcome = _policy_outcome(policy, counts.get(expense.id))
+        if outcome:
+            if expense.status != outcome[0]:
+                rollup_changes.append((expense.company_id, expense.status, expense.created_at, expense.amount_converted, -1))
+                rollup_changes.append((expense.company_id, outcome[0], expense.created_at, expense.amount_converted, 1))
+            expense.status, action, reason = outcome
+            audit_rows.append({'expense_id': expense.id, 'user_id': None, 'action': action, 'details': {'reason': reason}})
+            results[expense.id] = True
+        elif policy.sequence:
+            open_expenses.append(expense)
     
-    # Sequential rule (default)
-    sequence = flow.config.get("sequence", [])
-    if sequence:
-        # Check if all required approvers have approved
-        sequence_approvals = [a for a in approvals if a.approver_id in sequence]
-        approved_sequence = [a for a in sequence_approvals if a.decision == ApprovalDecision.approved]
-        
-        if len(approved_sequence) == len(sequence):
-            expense.status = ExpenseStatus.approved
-            db.session.commit()
-            create_audit_log(expense_id, None, "expense_approved", {"reason": "sequential_approval"})
-            return True
-        
-        # Find next approver in sequence
-        for approver_id in sequence:
-            if not any(a.approver_id == approver_id for a in approvals):
+    # Find next approver in sequence for every expense still open
+    approval_rows = []
+    if open_expenses:
+        assigned = {}
+        with_approvals = [expense.id for expense in open_expenses if expense.id in counts]
+        if with_approvals:
+            for row in db.session.query(Approval.expense_id, Approval.approver_id).filter(
+                Approval.expense_id.in_(with_approvals),
+                Approval.approver_id.in_(policy.sequence_set)
+            ):
+                assigned.setdefault(row.expense_id, set()).add(row.approver_id)
+        for expense in open_expenses:
+            taken = assigned.get(expense.id, ())
+            next_approver = next((a for a in policy.sequence if a not in taken), None)
+            if next_approver is not None:
                 # Create pending approval for next approver
-                next_approval = Approval(
-                    expense_id=expense.id,
-                    approver_id=approver_id
-                )
-                db.session.add(next_approval)
-                db.session.commit()
-                create_audit_log(expense_id, None, "approval_assigned", {"approver_id": approver_id})
-                return False
+                approval_rows.append({'expense_id': expense.id, 'approver_id': next_approver, 'decision': ApprovalDecision.pending})
+                audit_rows.append({'expense_id': expense.id, 'user_id': None, 'action': 'approval_assigned', 'details': {'approver_id': next_approver}})
     
-    return False
+    if approval_rows:
+        db.session.execute(db.insert(Approval), approval_rows)
+    record_audit_logs(audit_rows)
+    update_rollups(rollup_changes)
+    return results
 
-def convert_currency(amount, from_currency, to_currency):
-    """Simple currency conversion - in production, use a proper currency API"""
-    # This is a placeholder - in production, integrate with a currency conversion API
-    # For now, return the same amount
-    return float(amount)
+def evaluate_policy(expense):
+    """Evaluate approval rules for a single expense (see evaluate_policies)"""
+    return evaluate_policies([expense])[expense.id]